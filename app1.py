@@ -1,24 +1,71 @@
 # app1.py (v52.0 - 改用 xlwt 輸出 .xls 格式以相容舊系統)
+from __future__ import annotations
 
 import os
 import time
-import requests
 import json
+import re
+import unicodedata
 import traceback
-from datetime import datetime
-from flask import Flask, request, render_template, jsonify, Response
-import google.generativeai as genai
+from datetime import datetime, timedelta, timezone
+from flask import Flask, request, render_template, jsonify, Response, stream_with_context, g
 from mimetypes import guess_type
-import fitz  # PyMuPDF
 import io
+import importlib
+import functools
 import csv
+import zipfile
+import itertools
+import bisect
+import contextlib
+import contextvars
+from xml.sax.saxutils import escape
+import sys
+import uuid
+import socket
+import sqlite3
+import hashlib
+import mmap
+import shutil
+import struct
+from array import array
+import heapq
+import random
+import tempfile
+import queue
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, TimeoutError as FutureTimeoutError, as_completed, wait as wait_futures
+
+# --- 重量級套件延遲載入 ---
+# Gemini SDK、PyMuPDF、pandas、Drive 用戶端等合計要載入 1 秒以上，首頁完全用不到；
+# 改為第一次取用屬性時才 import，冷啟動只需載入 Flask (另可於啟動後在背景預熱，見 warm_up)。
+class LazyModule:
+    """第一次取用屬性時才 import 的模組代理"""
+
+    def __init__(self, name: str):
+        self._name = name; self._module = None
+
+    def load(self):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+requests = LazyModule("requests")
+genai = LazyModule("google.generativeai")
+fitz = LazyModule("fitz")  # PyMuPDF
 
 # --- Google Drive API 相關套件 ---
-from google.auth.transport.requests import Request as GoogleRequest
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+google_auth_requests = LazyModule("google.auth.transport.requests")
+google_oauth2_credentials = LazyModule("google.oauth2.credentials")
+google_auth_oauthlib_flow = LazyModule("google_auth_oauthlib.flow")
+googleapiclient_discovery = LazyModule("googleapiclient.discovery")
+googleapiclient_http = LazyModule("googleapiclient.http")
+httplib2 = LazyModule("httplib2")
+google_auth_httplib2 = LazyModule("google_auth_httplib2")
 
 # --- 環境變數管理套件 ---
 from dotenv import load_dotenv
@@ -27,16 +74,114 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # --- 函式庫 (更換為 xlwt) ---
-import pandas as pd
-import xlwt  # <--- 改用這個套件來產生 .xls
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+xlwt = LazyModule("xlwt")  # <--- 改用這個套件來產生 .xls
+
+# 背景預熱時依序載入 (最常用、最慢的放前面)
+LAZY_MODULES = (fitz, genai, requests, np, pd, xlwt, httplib2, google_auth_httplib2, google_auth_requests,
+                google_oauth2_credentials, google_auth_oauthlib_flow, googleapiclient_discovery, googleapiclient_http)
 
 # --- 設定 ---
 INPUT_FOLDER = "uploads"
 PDF_CONVERSION_DPI = 300
+# 兩階段辨識: PDF 頁面先以 OCR_FAST_DPI 轉圖辨識，結果未通過本機檢查 (發票號碼、統編檢查碼、日期、金額) 的頁面
+# 才以 PDF_CONVERSION_DPI 重新轉圖、放寬影像長邊與大小上限後再辨識一次 (0 = 關閉，一律以 PDF_CONVERSION_DPI 辨識)
+OCR_FAST_DPI = int(os.getenv('OCR_FAST_DPI', '150'))
+OCR_RETRY_LONG_EDGE = int(os.getenv('OCR_RETRY_LONG_EDGE', '0'))
+OCR_RETRY_MAX_BYTES = int(os.getenv('OCR_RETRY_MAX_BYTES', str(4 * 1024 * 1024)))
+# 同時送往 Gemini 的最大請求數 (所有請求共用同一個執行緒池)
+OCR_MAX_WORKERS = int(os.getenv('OCR_MAX_WORKERS', '8'))
+# Gemini 多圖批次模式 (預設關閉): 一次請求最多幾張圖、圖片總大小上限，以及未湊滿時最多等待幾秒就送出
+# 可用環境變數開啟，或在請求加上 ?gemini_batch=<張數>
+GEMINI_BATCH_MAX_IMAGES = int(os.getenv('GEMINI_BATCH_MAX_IMAGES', '0'))
+GEMINI_BATCH_MAX_BYTES = int(os.getenv('GEMINI_BATCH_MAX_BYTES', str(8 * 1024 * 1024)))
+GEMINI_BATCH_MAX_WAIT = float(os.getenv('GEMINI_BATCH_MAX_WAIT', '0.5'))
+# Gemini 配額排程: 每分鐘請求數 / token 數上限 (0 = 不限制)；token 以「Prompt 字數 + 每張圖片估計值 + 預估輸出」預扣，
+# 收到回應後再依實際用量校正。每個程序各自計算額度，因此把配額拆開分配，加總不超過上限：
+# 網站程序使用 1 - GEMINI_JOB_BUDGET_SHARE，背景工作程序共用 GEMINI_JOB_BUDGET_SHARE (每個程序再平分為 1 / JOB_WORKER_PROCESSES；
+# 另外以 `python app1.py worker` 啟動時，請把 JOB_WORKER_PROCESSES 設為工作程序總數)；完全不使用背景工作時可將 SHARE 設為 0
+GEMINI_MAX_RPM = int(os.getenv('GEMINI_MAX_RPM', '0'))
+GEMINI_MAX_TPM = int(os.getenv('GEMINI_MAX_TPM', '0'))
+GEMINI_TOKENS_PER_IMAGE = int(os.getenv('GEMINI_TOKENS_PER_IMAGE', '1120'))
+GEMINI_OUTPUT_TOKENS_ESTIMATE = int(os.getenv('GEMINI_OUTPUT_TOKENS_ESTIMATE', '600'))
+GEMINI_JOB_BUDGET_SHARE = float(os.getenv('GEMINI_JOB_BUDGET_SHARE', '0.5'))
+# Gemini 可重試錯誤 (429 / 5xx / 逾時 / 回應無 JSON) 的重試次數與指數退避秒數 (第 n 次重試最多等 BASE * 2^n，上限 MAX，實際等待隨機抖動)
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '4'))
+GEMINI_BACKOFF_BASE = float(os.getenv('GEMINI_BACKOFF_BASE', '1'))
+GEMINI_BACKOFF_MAX = float(os.getenv('GEMINI_BACKOFF_MAX', '32'))
+# 送給 Gemini 的影像: 長邊像素上限、最小長邊、每張大小上限 (超過時再縮小)，以及編碼格式
+# auto = JPEG 與 PNG 取較小者 (掃描文件 PNG 常較小，照片 JPEG 較小)；original = 不處理，照舊送原檔 / 300 DPI PNG
+GEMINI_IMAGE_LONG_EDGE = int(os.getenv('GEMINI_IMAGE_LONG_EDGE', '2048'))
+GEMINI_IMAGE_MIN_LONG_EDGE = int(os.getenv('GEMINI_IMAGE_MIN_LONG_EDGE', '1024'))
+GEMINI_IMAGE_MAX_BYTES = int(os.getenv('GEMINI_IMAGE_MAX_BYTES', str(1024 * 1024)))
+GEMINI_IMAGE_FORMAT = os.getenv('GEMINI_IMAGE_FORMAT', 'auto')
+GEMINI_IMAGE_QUALITY = int(os.getenv('GEMINI_IMAGE_QUALITY', '80'))
+# 彩色像素 (RGB 最大最小值差距超過 48) 佔比低於此值時轉為灰階；有紅色印章等彩色內容時保留彩色 (0 = 一律保留彩色)
+GEMINI_IMAGE_COLOR_RATIO = float(os.getenv('GEMINI_IMAGE_COLOR_RATIO', '0.002'))
+# PDF 轉圖: 使用的子程序數、同時存在於記憶體中的頁面影像上限 (含等待 / 進行辨識中的頁面)，
+# 以及頁數達到多少才改用子程序並行轉圖 (頁數少時直接在本執行緒轉，省去程序間傳輸)
+RASTER_MAX_PROCESSES = int(os.getenv('RASTER_MAX_PROCESSES', str(os.cpu_count() or 1)))
+RASTER_MAX_PAGES_IN_MEMORY = int(os.getenv('RASTER_MAX_PAGES_IN_MEMORY', str(OCR_MAX_WORKERS * 2)))
+RASTER_PARALLEL_MIN_PAGES = int(os.getenv('RASTER_PARALLEL_MIN_PAGES', '4'))
+# PDF 文字層快速路徑: 頁面文字至少幾個字才嘗試以規則解析 (0 = 關閉，一律轉圖辨識)
+PDF_TEXT_MIN_CHARS = int(os.getenv('PDF_TEXT_MIN_CHARS', '20'))
+# Google Drive 並行下載數，以及「已下載但尚未送進 OCR」最多可暫存的檔案數 (背壓)
+DRIVE_DOWNLOAD_WORKERS = int(os.getenv('DRIVE_DOWNLOAD_WORKERS', '4'))
+DRIVE_MAX_PENDING_DOWNLOADS = int(os.getenv('DRIVE_MAX_PENDING_DOWNLOADS', '8'))
+# 上傳 / 下載檔案在記憶體中暫存的上限，超過才寫入 uploads/ 下唯一命名的暫存檔
+UPLOAD_SPOOL_MAX_BYTES = int(os.getenv('UPLOAD_SPOOL_MAX_BYTES', str(32 * 1024 * 1024)))
+# 本機快取 / 資料庫檔案存放位置
+CACHE_FOLDER = os.getenv('CACHE_FOLDER', 'cache')
+# 公司查詢快取: 查得資料保留 30 天；查無資料或連線失敗僅保留 1 小時，之後重新查詢
+COMPANY_CACHE_TTL = int(os.getenv('COMPANY_CACHE_TTL', str(30 * 24 * 3600)))
+COMPANY_CACHE_NEGATIVE_TTL = int(os.getenv('COMPANY_CACHE_NEGATIVE_TTL', '3600'))
+COMPANY_CACHE_LRU_SIZE = int(os.getenv('COMPANY_CACHE_LRU_SIZE', '4096'))
+# 公司查詢 (財政部 / g0v) 的並行數與每秒請求上限 (取代原本每筆固定 sleep 0.5 秒)
+REGISTRY_MAX_WORKERS = int(os.getenv('REGISTRY_MAX_WORKERS', '4'))
+REGISTRY_MAX_REQUESTS_PER_SEC = float(os.getenv('REGISTRY_MAX_REQUESTS_PER_SEC', '4'))
+# 財政部 / g0v 查詢網址 (可改指向本機測試伺服器) 與逾時秒數
+FIA_API_URL = os.getenv('FIA_API_URL', 'https://eip.fia.gov.tw/OAI/api/businessRegistration/{vat}')
+G0V_API_URL = os.getenv('G0V_API_URL', 'https://company.g0v.ronny.tw/api/show/{vat}')
+FIA_API_TIMEOUT = float(os.getenv('FIA_API_TIMEOUT', '5'))
+G0V_API_TIMEOUT = float(os.getenv('G0V_API_TIMEOUT', '10'))
+# 離線稅籍索引檔 (由 `python app1.py import-registry <CSV>` 產生)；檔案更新後最多經過幾秒會自動重新開啟
+REGISTRY_INDEX_PATH = os.getenv('REGISTRY_INDEX_PATH', os.path.join(CACHE_FOLDER, 'registry_index.bin'))
+REGISTRY_INDEX_RECHECK_SECONDS = float(os.getenv('REGISTRY_INDEX_RECHECK_SECONDS', '30'))
+# 斷路器: 連續失敗達門檻後，該來源暫停使用一段冷卻時間 (秒)
+REGISTRY_BREAKER_THRESHOLD = int(os.getenv('REGISTRY_BREAKER_THRESHOLD', '3'))
+REGISTRY_BREAKER_COOLDOWN = float(os.getenv('REGISTRY_BREAKER_COOLDOWN', '60'))
+# 對沖查詢: 財政部超過此秒數未回應就同時查 g0v，採用先取得的有效名稱 (0 = 關閉，依序查詢)
+REGISTRY_HEDGE_DELAY = float(os.getenv('REGISTRY_HEDGE_DELAY', '0'))
+# 辨識結果快取: 依圖片內容雜湊保存 Gemini 結果，超過上限時淘汰最久未使用的資料
+OCR_CACHE_MAX_ENTRIES = int(os.getenv('OCR_CACHE_MAX_ENTRIES', '20000'))
+# 串流 / 背景工作: 最前面的檔案辨識完成時，連同其後已完成的檔案 (最多幾個) 一起整理，公司查詢與統編修正跨檔案合併為一批
+ENRICH_WINDOW_FILES = int(os.getenv('ENRICH_WINDOW_FILES', '16'))
+# 統一編號修正: 候選最多同時替換幾個易混淆數字 (超過 1 個或含 '9' 的候選需經公司快取 / 離線稅籍索引確認才採用)
+VAT_MAX_SUBSTITUTIONS = int(os.getenv('VAT_MAX_SUBSTITUTIONS', '2'))
+# 背景工作佇列: 網站程序內自動啟動的工作程序數 (0 = 只用 `python app1.py worker` 另外啟動)
+JOB_WORKER_PROCESSES = int(os.getenv('JOB_WORKER_PROCESSES', '1'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+# 執行中的工作超過此秒數沒有回報進度，視為工作程序已中斷，可由其他程序接手重跑；
+# 執行中的工作每隔 JOB_HEARTBEAT_INTERVAL 秒由背景執行緒更新一次 heartbeat (與是否有檔案完成無關)
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', '900'))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', str(max(JOB_STALE_SECONDS / 10, 1))))
+# 辨識結果集: 伺服器端保存辨識結果供匯出時以 ID 取用，超過此秒數自動失效
+RESULT_SET_TTL = int(os.getenv('RESULT_SET_TTL', str(24 * 3600)))
+RESULT_STORE_LRU_SIZE = int(os.getenv('RESULT_STORE_LRU_SIZE', '16'))
+# GV 匯出: .xls 每張工作表最多 65536 列 (含表頭)，超過時自動換到下一張 PURDATA 工作表或下一個檔案
+XLS_MAX_ROWS = 65536
+GV_ROWS_PER_SHEET = min(int(os.getenv('GV_ROWS_PER_SHEET', str(XLS_MAX_ROWS - 1))), XLS_MAX_ROWS - 1)
+# CSV / xlsx 串流匯出時每次送出的列數
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '2000'))
+# 啟動後背景預熱: 等待 STARTUP_WARMUP_DELAY 秒 (讓伺服器先開始接受連線) 再載入延遲載入的套件 (0 = 關閉)
+STARTUP_WARMUP = int(os.getenv('STARTUP_WARMUP', '1'))
+STARTUP_WARMUP_DELAY = float(os.getenv('STARTUP_WARMUP_DELAY', '1'))
 app = Flask(__name__)
 
 app.config['UPLOAD_FOLDER'] = INPUT_FOLDER
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(CACHE_FOLDER, exist_ok=True)
 
 # --- API Key 設定 ---
 GEMINI_API_KEY = os.getenv('GOOGLE_API_KEY')
@@ -45,10 +190,13 @@ if not GEMINI_API_KEY:
     print("⚠️ 嚴重警告：未偵測到 GOOGLE_API_KEY！程式將無法辨識發票。")
 else:
     os.environ['GOOGLE_API_KEY'] = GEMINI_API_KEY
-    genai.configure(api_key=GEMINI_API_KEY)
 
 # --- Google Drive 權限設定 ---
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
+DRIVE_TOKEN_FILE = 'token.json'
+DRIVE_CREDENTIALS_FILE = 'credentials.json'
+# 存取權杖剩餘效期低於此秒數時即主動更新，避免請求中途過期
+DRIVE_TOKEN_REFRESH_MARGIN = int(os.getenv('DRIVE_TOKEN_REFRESH_MARGIN', '300'))
 
 # --- 統一發票字軌設定 ---
 INVOICE_PREFIX_MAP_2025 = { 
@@ -67,67 +215,311 @@ INVOICE_PREFIX_MAP_2026 = {
     'VY': '22', 'YA': '22', 'AC': '22', 'CF': '22', 'EH': '22', 'GK': '22'
 }
 
-# --- Google Drive 輔助函式 ---
-def get_drive_service():
-    """取得 Google Drive Service (OAuth 2.0)"""
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(GoogleRequest())
-        else:
-            if os.path.exists('credentials.json'):
-                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-                creds = flow.run_local_server(port=0)
+# --- 效能指標 (各階段耗時直方圖與計數器，/metrics 以 Prometheus 文字格式輸出) ---
+# 主要階段: drive_list、drive_download、text_layer、encode、rasterize、gemini_throttle、gemini、registry_fia、registry_g0v、registry_rate_limit、enrich、export_*
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    """執行緒安全的計數器與延遲直方圖，以 (指標名稱, 標籤) 為鍵；只記錄本程序 (背景工作程序另有自己的一份)"""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self._counters = {}; self._histograms = {}  # (name, labels) -> 值 / [各區間次數, 總和, 次數]
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None: histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds; histogram[2] += 1
+
+    def render(self, extra_counters: dict = None) -> str:
+        """輸出 Prometheus 文字格式；extra_counters 為 {(name, labels): 值}，供外部既有統計 (如快取命中數) 併入"""
+        def fmt_labels(labels, extra=()):
+            pairs = [*labels, *extra]
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+        with self._lock:
+            counters = dict(self._counters); counters.update(extra_counters or {})
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+        lines = []; seen = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen: lines.append(f"# TYPE {name} counter"); seen.add(name)
+            lines.append(f"{name}{fmt_labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            if name not in seen: lines.append(f"# TYPE {name} histogram"); seen.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{fmt_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {total}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_LATENCY_BUCKETS)
+
+class RequestTiming:
+    """單一請求的各階段耗時累計 (?timing=1 時附在回應中)；工作執行緒透過 contextvars 找到所屬請求"""
+
+    def __init__(self):
+        self.stages = {}; self._lock = threading.Lock(); self.started = time.perf_counter()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            entry = self.stages.setdefault(stage, [0, 0.0]); entry[0] += 1; entry[1] += seconds
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            stages = {stage: {"count": count, "seconds": round(seconds, 4)} for stage, (count, seconds) in self.stages.items()}
+        return {"total_seconds": round(time.perf_counter() - self.started, 4), "stages": stages}
+
+    def server_timing_header(self) -> str:
+        with self._lock:
+            return ", ".join(f'{stage};dur={seconds * 1000:.1f};desc="{count}x"' for stage, (count, seconds) in self.stages.items())
+
+_request_timing = contextvars.ContextVar("request_timing", default=None)
+
+@contextlib.contextmanager
+def stage_timer(stage: str):
+    """量測一個處理階段的耗時，記入 invoice_stage_duration_seconds 直方圖與目前請求的 timing"""
+    start = time.perf_counter()
+    try: yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("invoice_stage_duration_seconds", elapsed, stage=stage)
+        timing = _request_timing.get()
+        if timing is not None: timing.add(stage, elapsed)
+
+def timed_chunks(stage: str, chunks):
+    """串流回應用：把整個產生器的執行時間記為一個階段"""
+    with stage_timer(stage): yield from chunks
+
+def submit_in_context(executor, fn, *args) -> Future:
+    """送入執行緒池時帶上目前的 contextvars (讓工作執行緒的階段耗時記到發出請求的那次請求上)"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def with_timing(payload: dict) -> dict:
+    """請求有開啟 timing 時，在 JSON 回應中附上各階段耗時"""
+    timing = _request_timing.get()
+    if timing is not None: payload["timing"] = timing.as_dict()
+    return payload
+
+# --- 上傳檔案暫存 (記憶體優先，不落地) ---
+class SpooledUpload:
+    """單一上傳 / 下載檔案的內容容器：小檔案只存在記憶體，超過門檻才寫入唯一命名的暫存檔。
+    不再以原始檔名存到 uploads/，同名檔案 (如 scan.pdf) 的並行請求不會互相覆蓋或刪除。"""
+
+    def __init__(self, filename: str, max_memory: int = UPLOAD_SPOOL_MAX_BYTES):
+        self.filename = filename; self.max_memory = max_memory
+        self.mime_type = guess_type(filename)[0]
+        self.size = 0; self.path = None
+        self._buffer = io.BytesIO(); self._file = None
+        self._refs = 1; self._lock = threading.Lock()
+
+    @classmethod
+    def from_bytes(cls, filename: str, data: bytes):
+        upload = cls(filename); upload.write(data)
+        return upload
+
+    @classmethod
+    def from_stream(cls, filename: str, stream, chunk_size: int = 1024 * 1024):
+        upload = cls(filename)
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk: break
+            upload.write(chunk)
+        return upload
+
+    def write(self, data) -> int:
+        if self._file is None and self.size + len(data) > self.max_memory:
+            suffix = os.path.splitext(self.filename)[1]
+            self._file = tempfile.NamedTemporaryFile(dir=app.config['UPLOAD_FOLDER'], suffix=suffix, delete=False)
+            self.path = self._file.name
+            self._file.write(self._buffer.getbuffer()); self._buffer = None
+        (self._file or self._buffer).write(data)
+        self.size += len(data)
+        return len(data)
+
+    def _flush(self):
+        if self._file is not None: self._file.flush()
+
+    def getvalue(self) -> bytes:
+        if self._file is None: return self._buffer.getvalue()
+        self._flush()
+        with open(self.path, "rb") as f: return f.read()
+
+    def sha256(self) -> str:
+        if self._file is None: return hashlib.sha256(self._buffer.getbuffer()).hexdigest()
+        self._flush(); digest = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""): digest.update(chunk)
+        return digest.hexdigest()
+
+    def ensure_path(self) -> str:
+        """確保內容已寫入暫存檔並回傳路徑 (供子程序直接開檔，避免在程序間複製整份檔案)"""
+        with self._lock:
+            if self._file is None:
+                self.max_memory = 0; data = self._buffer.getvalue()
+                self._buffer = io.BytesIO(); self.size = 0
+                self.write(data)
+            self._flush()
+            return self.path
+
+    def open_pdf(self):
+        """以 PyMuPDF 開啟：記憶體中的檔案走 stream=，已寫入暫存檔的大檔案直接開檔"""
+        if self._file is None: return fitz.open(stream=self._buffer.getvalue(), filetype="pdf")
+        self._flush()
+        return fitz.open(self.path)
+
+    def retain(self):
+        """延後釋放：之後還需要讀取內容的工作 (例如高解析度重試) 先 retain()，用完再 close()；最後一次 close() 才真正釋放"""
+        with self._lock: self._refs += 1
+
+    def close(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0: return
+        if self._file is not None:
+            self._file.close()
+            if os.path.exists(self.path): os.remove(self.path)
+            self._file = None; self.path = None
+        self._buffer = None
+
+# --- Google Drive 用戶端管理 ---
+class DriveClientManager:
+    """整個程序共用的 Google Drive 用戶端 (執行緒安全)：
+    憑證只從 token.json 讀取一次並常駐記憶體，到期前主動更新；每個執行緒各自持有一個 AuthorizedHttp
+    (保留連線重複使用) 與以內建 discovery 文件建立的 Drive service，不再每次請求重新 build。"""
+
+    def __init__(self, token_path: str, credentials_path: str, refresh_margin: int):
+        self.token_path = token_path; self.credentials_path = credentials_path
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._creds = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _load_credentials(self):
+        creds = None
+        if os.path.exists(self.token_path):
+            creds = google_oauth2_credentials.Credentials.from_authorized_user_file(self.token_path, SCOPES)
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(google_auth_requests.Request())
             else:
-                print("❌ 錯誤：找不到 credentials.json，無法使用 Google Drive 功能")
-                return None
-        with open('token.json', 'w') as token:
+                if os.path.exists(self.credentials_path):
+                    flow = google_auth_oauthlib_flow.InstalledAppFlow.from_client_secrets_file(self.credentials_path, SCOPES)
+                    creds = flow.run_local_server(port=0)
+                else:
+                    print("❌ 錯誤：找不到 credentials.json，無法使用 Google Drive 功能")
+                    return None
+            self._save(creds)
+        return creds
+
+    def _save(self, creds):
+        with open(self.token_path, 'w') as token:
             token.write(creds.to_json())
-    return build('drive', 'v3', credentials=creds)
+
+    def _expiring(self, creds) -> bool:
+        if not creds.valid: return True
+        if creds.expiry is None: return False
+        now = datetime.now(timezone.utc).replace(tzinfo=None)  # google-auth 的 expiry 為 naive UTC
+        return creds.expiry - now < self.refresh_margin
+
+    def get_credentials(self):
+        """取得有效憑證；找不到 credentials.json 時回傳 None"""
+        with self._lock:
+            if self._creds is None: self._creds = self._load_credentials()
+            creds = self._creds
+            if creds is not None and creds.refresh_token and self._expiring(creds):
+                creds.refresh(google_auth_requests.Request()); self._save(creds)
+                print("Google Drive 存取權杖已更新")
+            return creds
+
+    def get_service(self):
+        """取得目前執行緒專用的 Drive service"""
+        creds = self.get_credentials()
+        if creds is None: return None
+        local = self._local
+        if getattr(local, 'service', None) is None or local.creds is not creds:
+            http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+            local.service = googleapiclient_discovery.build('drive', 'v3', http=http, cache_discovery=False, static_discovery=True)
+            local.creds = creds
+        return local.service
+
+drive_clients = DriveClientManager(DRIVE_TOKEN_FILE, DRIVE_CREDENTIALS_FILE, DRIVE_TOKEN_REFRESH_MARGIN)
+
+# --- Google Drive 輔助函式 ---
+def get_drive_service():
+    """取得 Google Drive Service (OAuth 2.0)；每個執行緒重複使用同一個已授權的用戶端"""
+    return drive_clients.get_service()
+
+DRIVE_FILE_QUERY = "'{folder_id}' in parents and (mimeType contains 'image/' or mimeType = 'application/pdf') and trashed = false"
+
+def list_drive_folder_files(service, folder_id: str) -> list:
+    """列出資料夾內所有圖片 / PDF (依 nextPageToken 逐頁讀取，不會在 1000 筆截斷)"""
+    items = []; page_token = None
+    while True:
+        with stage_timer("drive_list"):
+            results = service.files().list(q=DRIVE_FILE_QUERY.format(folder_id=folder_id), pageSize=1000, pageToken=page_token,
+                                           fields="nextPageToken, files(id, name, mimeType)").execute()
+        items.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token: return items
 
 def download_file_by_id(service, file_id, file_name):
-    """下載單一檔案"""
-    save_path = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
+    """下載單一檔案到 SpooledUpload (不寫入 uploads/)"""
     request = service.files().get_media(fileId=file_id)
-    fh = io.FileIO(save_path, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
+    upload = SpooledUpload(file_name)
+    try:
+        with stage_timer("drive_download"):
+            downloader = googleapiclient_http.MediaIoBaseDownload(upload, request)
+            done = False
+            while done is False:
+                status, done = downloader.next_chunk()
+    except Exception:
+        metrics.inc("invoice_upstream_failures_total", upstream="drive")
+        upload.close(); raise
+    metrics.inc("invoice_drive_download_bytes_total", upload.size)
     print(f"已下載: {file_name}")
-    return file_name
+    return upload
 
-def download_files_from_drive_folder(folder_id):
-    """(舊逻辑保留) 從指定 Drive 資料夾下載所有圖片"""
-    service = get_drive_service()
-    if not service: return []
+# 所有請求共用的下載執行緒池：執行緒長駐，各自的 Drive 用戶端 (與其連線) 可跨請求重複使用
+drive_executor = ThreadPoolExecutor(max_workers=DRIVE_DOWNLOAD_WORKERS, thread_name_prefix="drive")
 
-    print(f"正在讀取雲端資料夾 ID: {folder_id} ...")
-    query = f"'{folder_id}' in parents and (mimeType contains 'image/' or mimeType = 'application/pdf') and trashed = false"
-    results = service.files().list(q=query, fields="files(id, name, mimeType)").execute()
-    items = results.get('files', [])
-
-    downloaded_files = []
-    if not items:
-        print("資料夾內沒有檔案。")
-        return []
+def download_drive_item(item: dict):
+    # 每個下載執行緒各自呼叫 get_drive_service() 取得專屬的用戶端 (httplib2 不是執行緒安全的)
+    return download_file_by_id(get_drive_service(), item['id'], item['name'])
 
-    print(f"找到 {len(items)} 個檔案，開始下載...")
-    for item in items:
-        downloaded_files.append(download_file_by_id(service, item['id'], item['name']))
-    
-    return downloaded_files
+def iter_drive_downloads(items: list, max_pending: int = DRIVE_MAX_PENDING_DOWNLOADS):
+    """並行下載 items ([{'id': '...', 'name': '...'}, ...])，依原始順序逐一產生 SpooledUpload，下載失敗的檔案略過。
+    下載在共用的 drive_executor 上執行；每次呼叫最多只有 max_pending 個檔案處於下載中或已下載待取用，
+    呼叫端 (OCR) 較慢時下載會自動暫停。"""
+    queued = iter(items); window = deque()
+    try:
+        while True:
+            while len(window) < max(max_pending, 1):
+                item = next(queued, None)
+                if item is None: break
+                window.append((item, submit_in_context(drive_executor, download_drive_item, item)))
+            if not window: return
+            item, future = window.popleft()
+            try: upload = future.result()
+            except Exception as e:
+                print(f"下載失敗 {item['name']}: {e}"); continue
+            yield upload
+    finally:
+        # 呼叫端提前結束時，取消尚未開始的下載並釋放已下載的內容
+        for _, future in window:
+            if not future.cancel() and future.exception() is None: future.result().close()
 
 # --- 核心函式 (Prompt 嚴禁更動) ---
-def extract_data_with_gemini_vision(image_bytes: bytes, mime_type: str) -> list:
-    if not GEMINI_API_KEY:
-        print("[Error] 缺少 API Key，跳過辨識。")
-        return []
-
-    image_part = {"mime_type": mime_type, "data": image_bytes}
-    prompt = f"""
+GEMINI_MODEL_NAME = "gemini-3-flash-preview"
+GEMINI_PROMPT = f"""
     你是一位頂尖的台灣發票資料分析師。你的任務是從眼前的發票圖片中，精準地擷取結構化資訊。
 
     **最終輸出指示 (非常重要):**
@@ -154,131 +546,2128 @@ def extract_data_with_gemini_vision(image_bytes: bytes, mime_type: str) -> list:
       ]
     }}
     """
+
+# 多圖批次模式附加的說明 (不更動上方 Prompt，只在其後補充圖片編號規則)
+GEMINI_BATCH_INSTRUCTION = """
+    **批次模式補充說明:** 本次請求共附上 {count} 張發票圖片，每張圖片前都有「圖片編號 N」標示 (N 從 0 開始)。
+    請對每一張圖片分別依照上述規則擷取，並在每一筆 receipt 物件中額外加入整數欄位 "image_index"，填入該筆發票所在圖片的編號。
+    所有圖片的結果都放在同一個 `{{ "receipts": [...] }}` 陣列中。
+    """
+
+_gemini_model = None
+_gemini_model_lock = threading.Lock()
+
+def get_gemini_model():
+    """整個程序共用同一個 GenerativeModel，不再每次呼叫重新建立"""
+    global _gemini_model
+    with _gemini_model_lock:
+        if _gemini_model is None:
+            # 第一次使用時才設定 API Key 並建立模型 (不在 import 時載入 Gemini SDK)
+            if GEMINI_API_KEY: genai.configure(api_key=GEMINI_API_KEY)
+            _gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        return _gemini_model
+
+def parse_receipts_response(response_text: str) -> list:
+    """從 Gemini 回應擷取 JSON 物件中的 receipts；找不到 JSON 時回傳 None"""
+    cleaned_response_text = response_text.strip()
+    json_start = cleaned_response_text.find('{')
+    json_end = cleaned_response_text.rfind('}')
+    if json_start != -1 and json_end != -1:
+        json_str = cleaned_response_text[json_start:json_end+1]
+        data = json.loads(json_str)
+        return data.get("receipts", [])
+    print("[Gemini Vision Warning] 回應中未找到有效的 JSON 物件。")
+    return None
+
+# --- Gemini 呼叫排程 (配額、優先順序、重試) ---
+# 所有 Gemini 請求都經過同一個排程器：RPM / TPM 以 token bucket 控制，額度不足時等待中的請求依優先順序取得額度，
+# 網站上的即時上傳優先於 Drive 資料夾匯入，背景工作最後。優先順序放在 ContextVar，隨 submit_in_context 帶進 OCR 執行緒。
+GEMINI_PRIORITY_INTERACTIVE = 0
+GEMINI_PRIORITY_DRIVE = 1
+GEMINI_PRIORITY_BULK = 2
+_gemini_priority = contextvars.ContextVar("gemini_priority", default=GEMINI_PRIORITY_INTERACTIVE)
+# 視為暫時性、值得重試的 HTTP 狀態碼與例外類別名稱 (google.api_core 延遲載入，以名稱判斷)
+GEMINI_RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+GEMINI_RETRYABLE_ERRORS = ("ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+                           "DeadlineExceeded", "GatewayTimeout", "Aborted", "RetryError")
+
+class GeminiExtractionError(Exception):
+    """Gemini 辨識最終失敗 (不可重試的錯誤或重試次數用盡)；由呼叫端標記為該頁 / 該檔案辨識失敗"""
+
+class GeminiScheduler:
+    """RPM / TPM 兩個 token bucket；等待中的請求依 (優先順序, 到達順序) 排隊，只有排在最前面的請求可以取得額度。
+    任何請求收到 429 時整個排程暫停一段時間，避免所有執行緒同時重試再次撞上配額"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self._cond = threading.Condition()
+        self._waiting = []  # (優先順序, 序號) 的 heap
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self.configure(rpm, tpm)
+
+    def configure(self, rpm: float, tpm: float):
+        with self._cond:
+            self.rpm = rpm; self.tpm = tpm
+            self._requests = float(rpm); self._tokens = float(tpm); self._updated = time.monotonic()
+            self._cond.notify_all()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated; self._updated = now
+        if self.rpm: self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm: self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, now: float, tokens: int) -> float:
+        wait = self._paused_until - now
+        if self.rpm and self._requests < 1: wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+        # 單次請求超過整分鐘額度時，只要求 bucket 全滿，否則會永遠等不到
+        needed = min(tokens, self.tpm)
+        if self.tpm and self._tokens < needed: wait = max(wait, (needed - self._tokens) * 60 / self.tpm)
+        return wait
+
+    def acquire(self, tokens: int, priority: int = GEMINI_PRIORITY_INTERACTIVE):
+        """等待並取得一次請求的額度 (預扣 tokens)"""
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            if not self.rpm and not self.tpm and not self._waiting and self._paused_until <= time.monotonic(): return
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic(); self._refill(now)
+                    wait = self._wait_time(now, tokens)
+                    if self._waiting[0] == ticket:
+                        if wait <= 0: break
+                        self._cond.wait(timeout=wait)
+                    else:
+                        self._cond.wait()
+                if self.rpm: self._requests -= 1
+                if self.tpm: self._tokens -= tokens
+            finally:
+                self._waiting.remove(ticket); heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def settle(self, estimated: int, actual: int):
+        """依回應的實際 token 用量校正預扣值 (可能讓 bucket 暫時為負，後續請求會等待補回)"""
+        if not self.tpm: return
+        with self._cond: self._tokens -= actual - estimated
+
+    def pause(self, seconds: float):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+def gemini_budget(limit: int, share: float) -> float:
+    """依比例分配 RPM / TPM 上限；limit 為 0 (不限制) 時維持不限制，分到的額度至少保留 1，避免變成 0 (= 不限制)"""
+    return max(limit * share, 1) if limit else 0
+
+# 網站程序 (即時上傳、Drive 匯入) 的額度；背景工作程序啟動時在 run_job_worker 改為自己的份額
+gemini_scheduler = GeminiScheduler(gemini_budget(GEMINI_MAX_RPM, 1 - GEMINI_JOB_BUDGET_SHARE), gemini_budget(GEMINI_MAX_TPM, 1 - GEMINI_JOB_BUDGET_SHARE))
+
+def gemini_error_status(error: Exception):
+    """取出例外的 HTTP 狀態碼 (google.api_core 例外的 code 屬性)；沒有時回傳 None"""
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+def is_retryable_gemini_error(error: Exception) -> bool:
+    if isinstance(error, (ConnectionError, TimeoutError)): return True
+    status = gemini_error_status(error)
+    if status is not None: return status in GEMINI_RETRYABLE_STATUS
+    return type(error).__name__ in GEMINI_RETRYABLE_ERRORS
+
+def gemini_backoff_delay(attempt: int) -> float:
+    """第 attempt 次重試前的等待秒數 (full jitter: 0 ~ min(MAX, BASE * 2^attempt) 之間隨機)"""
+    return random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+
+def call_gemini(parts: list, image_count: int, mode: str):
+    """經排程器送出一次 Gemini 請求並解析 receipts；可重試的錯誤依指數退避重試，最終失敗時拋出 GeminiExtractionError"""
+    estimated = sum(len(part) for part in parts if isinstance(part, str)) + image_count * GEMINI_TOKENS_PER_IMAGE + GEMINI_OUTPUT_TOKENS_ESTIMATE
+    priority = _gemini_priority.get()
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        with stage_timer("gemini_throttle"): gemini_scheduler.acquire(estimated, priority)
+        try:
+            with stage_timer("gemini"): response = get_gemini_model().generate_content(parts)
+            usage = getattr(response, "usage_metadata", None)
+            actual = getattr(usage, "total_token_count", None)
+            if isinstance(actual, int) and actual > 0: gemini_scheduler.settle(estimated, actual)
+            try: response_text = response.text
+            except ValueError as e: raise GeminiExtractionError(f"Gemini 未回傳內容 (可能被安全機制攔截): {e}") from e
+            receipts = parse_receipts_response(response_text)
+            if receipts is None: raise ValueError("回應中未找到有效的 JSON 物件")
+            return receipts
+        except GeminiExtractionError:
+            metrics.inc("invoice_upstream_failures_total", upstream="gemini"); raise
+        except Exception as e:
+            metrics.inc("invoice_upstream_failures_total", upstream="gemini")
+            # 無法解析的回應通常是偶發的格式錯誤，同樣重試
+            retryable = isinstance(e, ValueError) or is_retryable_gemini_error(e)
+            if not retryable or attempt == GEMINI_MAX_RETRIES:
+                print(f"[Gemini Vision Error] {'批次' if mode == 'batch' else ''}辨識失敗 (共嘗試 {attempt + 1} 次): {e}")
+                raise GeminiExtractionError(str(e)) from e
+            delay = gemini_backoff_delay(attempt)
+            # 429 代表整個帳號的配額用完，暫停所有請求而不只是本執行緒
+            if gemini_error_status(e) == 429 or type(e).__name__ in ("ResourceExhausted", "TooManyRequests"): gemini_scheduler.pause(delay)
+            metrics.inc("invoice_gemini_retries_total", mode=mode)
+            print(f"[Gemini Retry] 第 {attempt + 1} 次請求失敗 ({e})，{delay:.1f} 秒後重試")
+            time.sleep(delay)
+
+def extract_data_with_gemini_vision(image_bytes: bytes, mime_type: str) -> list:
+    """辨識單張圖片；Gemini 最終失敗時拋出 GeminiExtractionError，不再以空結果掩蓋"""
+    if not GEMINI_API_KEY:
+        print("[Error] 缺少 API Key，跳過辨識。")
+        return []
+
+    image_part = {"mime_type": mime_type, "data": image_bytes}
+    prompt = GEMINI_PROMPT
+    metrics.inc("invoice_gemini_calls_total", mode="single"); metrics.inc("invoice_gemini_images_total")
+    metrics.inc("invoice_gemini_image_bytes_total", len(image_bytes))
+    return call_gemini([prompt, image_part], 1, "single")
+
+def extract_data_with_gemini_vision_batch(images: list):
+    """一次請求送出多張圖片 (images 為 (bytes, mime_type) 串列)，依 image_index 拆回每張圖片的 receipts 串列。
+    批次請求失敗或回應無法對應回圖片時回傳 None，由呼叫端改為逐張辨識。"""
+    if not GEMINI_API_KEY:
+        print("[Error] 缺少 API Key，跳過辨識。")
+        return [[] for _ in images]
+
+    parts = [GEMINI_PROMPT, GEMINI_BATCH_INSTRUCTION.format(count=len(images))]
+    for index, (image_bytes, mime_type) in enumerate(images):
+        parts.append(f"圖片編號 {index}")
+        parts.append({"mime_type": mime_type, "data": image_bytes})
+    metrics.inc("invoice_gemini_calls_total", mode="batch"); metrics.inc("invoice_gemini_images_total", len(images))
+    metrics.inc("invoice_gemini_image_bytes_total", sum(len(image_bytes) for image_bytes, _ in images))
     try:
-        model = genai.GenerativeModel("gemini-3-flash-preview") 
-        response = model.generate_content([prompt, image_part])
-        cleaned_response_text = response.text.strip()
-        json_start = cleaned_response_text.find('{')
-        json_end = cleaned_response_text.rfind('}')
-        if json_start != -1 and json_end != -1:
-            json_str = cleaned_response_text[json_start:json_end+1]
-            data = json.loads(json_str)
-            return data.get("receipts", [])
-        else:
-            print("[Gemini Vision Warning] 回應中未找到有效的 JSON 物件。")
-            return []
+        receipts = call_gemini(parts, len(images), "batch")
+    except GeminiExtractionError:
+        return None
+
+    per_image = [[] for _ in images]
+    for receipt in receipts:
+        try: index = int(receipt.pop("image_index"))
+        except (KeyError, ValueError, TypeError): index = -1
+        if not 0 <= index < len(images):
+            print("[Gemini Vision Warning] 批次回應缺少有效的 image_index，改為逐張辨識。")
+            return None
+        per_image[index].append(receipt)
+    return per_image
+
+# --- 辨識結果快取 (依內容雜湊，Prompt 或模型變更時自動失效) ---
+OCR_PROMPT_VERSION = hashlib.sha256(f"{GEMINI_MODEL_NAME}\n{GEMINI_PROMPT}\n{GEMINI_BATCH_INSTRUCTION}".encode("utf-8")).hexdigest()[:16]
+
+class OcrResultCache:
+    """以內容雜湊為鍵保存 receipts 串列的 SQLite 快取，附命中 / 未命中計數"""
+
+    def __init__(self, db_path: str, max_entries: int):
+        self.db_path = db_path; self.max_entries = max_entries
+        self.hits = 0; self.misses = 0
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS ocr_cache (
+                key TEXT PRIMARY KEY, receipts TEXT NOT NULL, last_used REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_used ON ocr_cache (last_used)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """組合快取鍵；一律帶入 Prompt / 模型版本"""
+        return hashlib.sha256("|".join([OCR_PROMPT_VERSION, *map(str, parts)]).encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT receipts FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+                if row: conn.execute("UPDATE ocr_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            print(f"[OCR Cache Warning] 讀取快取失敗: {e}"); row = None
+        with self._lock:
+            if row: self.hits += 1
+            else: self.misses += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, receipts: list):
+        if not receipts or key is None: return  # 空結果可能是辨識失敗，不快取；key 為 None 表示尚未確定的結果 (兩階段辨識的第一階段)
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO ocr_cache (key, receipts, last_used) VALUES (?, ?, ?)",
+                             (key, json.dumps(receipts, ensure_ascii=False), time.time()))
+                excess = conn.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    conn.execute("DELETE FROM ocr_cache WHERE key IN (SELECT key FROM ocr_cache ORDER BY last_used LIMIT ?)", (excess,))
+        except sqlite3.Error as e:
+            print(f"[OCR Cache Warning] 寫入快取失敗: {e}")
+
+    def stats(self) -> dict:
+        with self._lock: return {"hits": self.hits, "misses": self.misses}
+
+ocr_cache = OcrResultCache(os.path.join(CACHE_FOLDER, 'ocr_cache.db'), OCR_CACHE_MAX_ENTRIES)
+
+def extract_data_with_cache(cache_key: str, image_bytes: bytes, mime_type: str) -> list:
+    """呼叫 Gemini 並將結果寫入快取"""
+    receipts = extract_data_with_gemini_vision(image_bytes, mime_type)
+    ocr_cache.put(cache_key, receipts)
+    return receipts
+
+def completed_future(value) -> Future:
+    future = Future(); future.set_result(value)
+    return future
+
+# --- 並行 OCR 執行引擎 ---
+# 每張圖片 / 每頁 PDF 皆為獨立的 Gemini 請求，交給共用的執行緒池並行送出，
+# 再依「檔案順序 -> 頁碼順序」取回結果，確保輸出順序與逐一處理時完全相同。
+ocr_executor = ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS, thread_name_prefix="ocr")
+
+class GeminiBatcher:
+    """多圖批次模式：收集待辨識的圖片，湊滿 max_images 張 / max_bytes 大小 (或等待超過 max_wait 秒) 就合併成一次
+    Gemini 請求送出，再把結果分派回每張圖片各自的 future。單張超過大小上限的圖片直接單獨送出。"""
+
+    def __init__(self, max_images: int, max_bytes: int = GEMINI_BATCH_MAX_BYTES, max_wait: float = GEMINI_BATCH_MAX_WAIT):
+        self.max_images = max_images; self.max_bytes = max_bytes; self.max_wait = max_wait
+        self._items = []; self._bytes = 0; self._timer = None
+        self._lock = threading.Lock()
+        # 計時器執行緒沒有發出請求時的 contextvars (優先順序、timing)，送出批次時一律使用建立當下的版本
+        self._context = contextvars.copy_context()
+
+    def submit(self, cache_key: str, image_bytes: bytes, mime_type: str) -> Future:
+        if len(image_bytes) > self.max_bytes:
+            return submit_in_context(ocr_executor, extract_data_with_cache, cache_key, image_bytes, mime_type)
+        future = Future()
+        with self._lock:
+            if self._items and self._bytes + len(image_bytes) > self.max_bytes: self._flush_locked()
+            self._items.append((cache_key, image_bytes, mime_type, future)); self._bytes += len(image_bytes)
+            if len(self._items) >= self.max_images: self._flush_locked()
+            elif self._timer is None:
+                # 避免湊不滿的圖片一直佔住轉圖名額：等待超過 max_wait 就先送出
+                self._timer = threading.Timer(self.max_wait, self.flush); self._timer.daemon = True; self._timer.start()
+        return future
+
+    def flush(self):
+        with self._lock: self._flush_locked()
+
+    def _flush_locked(self):
+        if self._timer is not None: self._timer.cancel(); self._timer = None
+        if not self._items: return
+        items = self._items; self._items = []; self._bytes = 0
+        ocr_executor.submit(self._context.copy().run, run_gemini_batch, items)
+
+def run_gemini_batch(items: list):
+    """執行一個批次並設定每張圖片的 future；批次失敗時改為逐張辨識，個別圖片的失敗只記在該圖片的 future"""
+    try:
+        per_image = extract_data_with_gemini_vision_batch([(image_bytes, mime_type) for _, image_bytes, mime_type, _ in items]) if len(items) > 1 else None
     except Exception as e:
-        print(f"[Gemini Vision Error] 解析失敗: {e}")
-        return []
+        for _, _, _, future in items: future.set_exception(e)
+        return
+    for index, (cache_key, image_bytes, mime_type, future) in enumerate(items):
+        try:
+            if per_image is None:
+                receipts = extract_data_with_cache(cache_key, image_bytes, mime_type)
+            else:
+                receipts = per_image[index]; ocr_cache.put(cache_key, receipts)
+            future.set_result(receipts)
+        except Exception as e:
+            future.set_exception(e)
+
+def submit_extraction(cache_key: str, image_bytes: bytes, mime_type: str, batcher: GeminiBatcher = None) -> Future:
+    """送出一張圖片的辨識；有 batcher 時交給批次模式"""
+    if batcher is not None: return batcher.submit(cache_key, image_bytes, mime_type)
+    return submit_in_context(ocr_executor, extract_data_with_cache, cache_key, image_bytes, mime_type)
+
+# --- 送出前的影像處理 (縮圖、灰階、重新編碼) ---
+# 手機照片動輒 4~12 MB、300 DPI 的 PNG 頁面也有好幾 MB，上傳時間比辨識本身還久。這裡以 PyMuPDF 將每張圖縮到
+# GEMINI_IMAGE_LONG_EDGE 長邊、幾乎沒有色彩時轉灰階、重新編碼 (同時去除 EXIF 等中繼資料，轉向資訊先套用到影像上)，
+# 超過 GEMINI_IMAGE_MAX_BYTES 時再逐步縮小。
+IMAGE_COLOR_DELTA = 48
+IMAGE_FILETYPES = {"image/jpeg": "jpeg", "image/png": "png", "image/webp": "webp"}
+# 影像設定不同時送出的影像就不同 (辨識結果也可能不同)，一併納入辨識快取鍵，調整設定後不會沿用舊設定的結果
+OCR_IMAGE_SETTINGS = (f"{GEMINI_IMAGE_FORMAT}:{GEMINI_IMAGE_LONG_EDGE}:{GEMINI_IMAGE_MIN_LONG_EDGE}:{GEMINI_IMAGE_MAX_BYTES}:"
+                      f"{GEMINI_IMAGE_QUALITY}:{GEMINI_IMAGE_COLOR_RATIO}")
+
+def is_mostly_gray(pix) -> bool:
+    """以 64x64 縮圖估計彩色像素佔比"""
+    if GEMINI_IMAGE_COLOR_RATIO <= 0 or pix.n < 3: return pix.n < 3
+    thumb = fitz.Pixmap(pix, 64, 64, None); samples = thumb.samples; n = thumb.n
+    colored = sum(1 for i in range(0, len(samples), n) if max(samples[i:i + 3]) - min(samples[i:i + 3]) > IMAGE_COLOR_DELTA)
+    return colored < GEMINI_IMAGE_COLOR_RATIO * (len(samples) // n)
+
+def encode_pixmap(pix) -> tuple:
+    """依 GEMINI_IMAGE_FORMAT 編碼，回傳 (bytes, mime_type)；auto 時 JPEG / PNG 取較小者"""
+    candidates = []
+    if GEMINI_IMAGE_FORMAT in ("auto", "jpeg"): candidates.append((pix.tobytes("jpg", jpg_quality=GEMINI_IMAGE_QUALITY), "image/jpeg"))
+    if GEMINI_IMAGE_FORMAT in ("auto", "png") or not candidates: candidates.append((pix.tobytes("png"), "image/png"))
+    return min(candidates, key=lambda candidate: len(candidate[0]))
+
+def encode_page_image(page, zoom: float, long_edge_limit: int = GEMINI_IMAGE_LONG_EDGE, max_bytes: int = GEMINI_IMAGE_MAX_BYTES) -> tuple:
+    """將 PDF 頁面 (或開啟成文件的圖片) 以 zoom 倍率為上限轉成要送出的影像，回傳 (bytes, mime_type)"""
+    if GEMINI_IMAGE_FORMAT == "original": return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).tobytes("png"), "image/png"
+    long_edge = max(page.rect.width, page.rect.height)
+    if long_edge_limit > 0: zoom = min(zoom, long_edge_limit / long_edge)
+    colorspace = None
+    while True:
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace or fitz.csRGB, alpha=False)
+        if colorspace is None:
+            colorspace = fitz.csGRAY if is_mostly_gray(pix) else fitz.csRGB
+            if colorspace is fitz.csGRAY: pix = fitz.Pixmap(fitz.csGRAY, pix)
+        payload = encode_pixmap(pix)
+        if len(payload[0]) <= max_bytes or long_edge * zoom * 0.75 < GEMINI_IMAGE_MIN_LONG_EDGE: return payload
+        zoom *= 0.75
+
+def prepare_upload_image(image_bytes: bytes, mime_type: str) -> tuple:
+    """上傳圖片的送出版本，回傳 (bytes, mime_type)；無法解碼或重新編碼後反而較大時送原檔"""
+    if GEMINI_IMAGE_FORMAT == "original": return image_bytes, mime_type
+    try:
+        with stage_timer("encode"):
+            doc = fitz.open(stream=image_bytes, filetype=IMAGE_FILETYPES[mime_type])
+            try:
+                page = doc[0]; info = page.get_image_info()
+                # 圖片文件的頁面大小依圖片 DPI 換算，以原始像素數為倍率上限 (不放大)
+                native_long_edge = max(info[0]["width"], info[0]["height"]) if info else max(page.rect.width, page.rect.height)
+                payload = encode_page_image(page, native_long_edge / max(page.rect.width, page.rect.height))
+            finally:
+                doc.close()
+    except Exception as e:
+        print(f"[Image Warning] 圖片無法重新編碼，改送原檔: {e}")
+        return image_bytes, mime_type
+    return payload if len(payload[0]) < len(image_bytes) else (image_bytes, mime_type)
+
+# --- PDF 轉圖 (子程序並行、限制記憶體中的頁數) ---
+# 轉圖是 CPU 密集工作，交給 ProcessPoolExecutor 才不會佔住 GIL 拖慢其他請求執行緒；
+# 每頁影像在轉圖前先取得 raster_page_slots 名額，辨識完成後才歸還，整個程序同時最多只保留
+# RASTER_MAX_PAGES_IN_MEMORY 頁影像，數百頁的對帳單也不會撐爆容器記憶體。
+raster_page_slots = threading.BoundedSemaphore(RASTER_MAX_PAGES_IN_MEMORY)
+_raster_pool = None
+_raster_pool_lock = threading.Lock()
+
+def get_raster_pool():
+    """取得共用的轉圖程序池；設定為單程序或本身是背景工作程序 (daemon 不能再開子程序) 時回傳 None"""
+    global _raster_pool
+    if RASTER_MAX_PROCESSES <= 1 or multiprocessing.current_process().daemon: return None
+    with _raster_pool_lock:
+        if _raster_pool is None:
+            _raster_pool = ProcessPoolExecutor(max_workers=RASTER_MAX_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return _raster_pool
+
+_raster_docs = {}  # 子程序內: (路徑, 檔案雜湊) -> 已開啟的 PDF，同一份檔案只開一次
+
+def render_pdf_page(path: str, file_hash: str, page_num: int, dpi: int,
+                    long_edge_limit: int = GEMINI_IMAGE_LONG_EDGE, max_bytes: int = GEMINI_IMAGE_MAX_BYTES) -> tuple:
+    """(在轉圖子程序中執行) 將 PDF 單頁轉為要送出的影像，回傳 (bytes, mime_type)"""
+    key = (path, file_hash)
+    doc = _raster_docs.get(key)
+    if doc is None:
+        for old_doc in _raster_docs.values(): old_doc.close()
+        _raster_docs.clear()
+        doc = _raster_docs[key] = fitz.open(path)
+    return encode_page_image(doc[page_num], dpi / 72, long_edge_limit, max_bytes)
+
+def iter_pdf_page_images(upload: SpooledUpload, page_numbers: list, dpi: int = PDF_CONVERSION_DPI):
+    """依頁序逐頁產生 (頁碼, 影像 bytes, mime_type)。每頁佔用一個 raster_page_slots 名額，呼叫端用完後必須 release()"""
+    pool = get_raster_pool() if len(page_numbers) >= RASTER_PARALLEL_MIN_PAGES else None
+    if pool is None:
+        doc = upload.open_pdf()
+        try:
+            for page_num in page_numbers:
+                raster_page_slots.acquire()
+                try:
+                    with stage_timer("rasterize"): img_bytes, img_mime = encode_page_image(doc[page_num], dpi / 72)
+                except Exception:
+                    raster_page_slots.release(); raise
+                yield page_num, img_bytes, img_mime
+        finally:
+            doc.close()
+        return
+
+    path = upload.ensure_path(); file_hash = upload.sha256()
+    pages = iter(page_numbers); in_flight = deque(); waiting = None  # waiting: 取不到名額、下一輪再送出的頁碼
+    try:
+        while True:
+            # 預先送出後續頁面；手上已有轉圖中的頁面時不等待名額，避免自己卡住自己
+            while len(in_flight) < RASTER_MAX_PROCESSES * 2:
+                page_num = next(pages, None) if waiting is None else waiting
+                if page_num is None: break
+                waiting = None
+                if not raster_page_slots.acquire(blocking=not in_flight):
+                    waiting = page_num; break
+                in_flight.append((page_num, pool.submit(render_pdf_page, path, file_hash, page_num, dpi)))
+            if not in_flight: break
+            page_num, future = in_flight.popleft()
+            # 子程序轉圖與本程序其他工作重疊，這裡記錄的是「等待轉圖結果」的時間
+            try:
+                with stage_timer("rasterize"): img_bytes, img_mime = future.result()
+            except Exception:
+                raster_page_slots.release(); raise
+            yield page_num, img_bytes, img_mime
+    finally:
+        for _, future in in_flight:
+            future.cancel(); raster_page_slots.release()
+
+# --- PDF 文字層快速路徑 ---
+# 軟體產生的電子發票 / 對帳單 PDF 本身就有文字層，直接以固定規則解析即可，不必轉圖也不必呼叫 Gemini。
+# 只有欄位齊全 (發票號碼、日期、賣方統編、總計) 且通過檢查 (字軌、統編檢查碼、日期) 時才採用，否則該頁照常走影像辨識。
+TEXT_INVOICE_NUMBER_PATTERN = re.compile(r'(?<![A-Z])([A-Z]{2})[ -]?(\d{8})(?!\d)')
+TEXT_INVOICE_LABEL_PATTERN = re.compile(r'發票號碼|發票字軌|統一發票')
+# 西元 2025-05-27 / 2025/5/27 / 2025年5月27日，民國 114-05-27 / 114年5月27日；後面接「月」的是期別 (114年05-06月)，不是日期
+TEXT_DATE_PATTERN = re.compile(r'(?<!\d)(\d{4}|\d{2,3})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})(?!\d)(?!\s*月)')
+TEXT_TIME_PATTERN = re.compile(r'(?<![\d:])([01]?\d|2[0-3]):([0-5]\d)(?::([0-5]\d))?(?![\d:])')
+TEXT_VAT_PATTERN = re.compile(r'(?<!\d)(\d{8})(?!\d)')
+TEXT_SELLER_LABELS = ("賣方", "賣 方", "營業人")
+TEXT_BUYER_LABELS = ("買方", "買 方", "買受人")
+# 金額標籤依 Prompt 規則 7 的優先順序: 總計 > 合計 > 應收金額
+TEXT_TOTAL_LABELS = (("總計", "縂計"), ("合計",), ("應收金額",))
+TEXT_TOTAL_PATTERN = re.compile(r'(總計|縂計|合計|應收金額)\s*[:：]?\s*(?:NT\$|\$|新臺幣|新台幣)?\s*(\d{1,3}(?:,\d{3})+|\d+)(?![\d,])')
+
+def _text_date(text: str):
+    """第一個合理的日期 (民國年自動轉西元)，回傳 (YYYY-MM-DD, YYYYMMDD)；找不到時回傳 None"""
+    for match in TEXT_DATE_PATTERN.finditer(text):
+        year, month, day = (int(part) for part in match.groups())
+        if year < 1000: year += 1911
+        try: dt = datetime(year, month, day)
+        except ValueError: continue
+        if 2000 <= dt.year <= 2100: return dt.strftime('%Y-%m-%d'), dt.strftime('%Y%m%d')
+    return None
+
+def _text_total(text: str) -> int:
+    found = {}
+    for match in TEXT_TOTAL_PATTERN.finditer(text): found[match.group(1)] = int(match.group(2).replace(",", ""))
+    for labels in TEXT_TOTAL_LABELS:
+        # 同一標籤出現多次時取最後一個 (明細小計在前、總計在後)
+        amounts = [found[label] for label in labels if label in found]
+        if amounts: return amounts[-1]
+    return 0
+
+def parse_invoice_text(text: str):
+    """以規則解析單頁文字，回傳與 Gemini 相同格式的 receipts 串列；欄位不齊或無法確定時回傳 None (改走影像辨識)"""
+    text = unicodedata.normalize("NFKC", text)
+    date = _text_date(text)
+    total = _text_total(text)
+    if date is None or total <= 0: return None
+    selected_map = INVOICE_PREFIX_MAP_2026 if date[0].startswith("2026") else INVOICE_PREFIX_MAP_2025
+
+    invoice_numbers = set(); invoice_spans = []
+    for match in TEXT_INVOICE_NUMBER_PATTERN.finditer(text):
+        labelled = TEXT_INVOICE_LABEL_PATTERN.search(text, max(match.start() - 12, 0), match.start()) is not None
+        # 字軌必須是本年度已知的字軌，或緊接在「發票號碼」標籤之後
+        if match.group(1) in selected_map or labelled:
+            invoice_numbers.add(match.group(1) + match.group(2)); invoice_spans.append(match.span(2))
+    # 一頁有多張發票 (例如對帳單明細) 時無法確定金額對應，交給影像辨識
+    if len(invoice_numbers) != 1: return None
+
+    seller_vats = []; buyer_vats = []; other_vats = []
+    for match in TEXT_VAT_PATTERN.finditer(text):
+        vat = match.group(1)
+        if vat == date[1] or not is_valid_vat_number(vat): continue
+        if any(start <= match.start() < end for start, end in invoice_spans): continue
+        context = text[max(match.start() - 12, 0):match.start()]
+        if any(label in context for label in TEXT_BUYER_LABELS): buyer_vats.append(vat)
+        elif any(label in context for label in TEXT_SELLER_LABELS): seller_vats.append(vat)
+        else: other_vats.append(vat)
+    buyer_vats = list(dict.fromkeys(buyer_vats))
+    seller_vats = list(dict.fromkeys(seller_vats)) or [vat for vat in dict.fromkeys(other_vats) if vat not in buyer_vats]
+    if len(seller_vats) != 1 or len(buyer_vats) > 1: return None
+
+    time_match = TEXT_TIME_PATTERN.search(text)
+    return [{
+        "invoice_number": invoice_numbers.pop(), "date": date[0],
+        "time": f"{int(time_match.group(1)):02d}:{time_match.group(2)}:{time_match.group(3) or '00'}" if time_match else "",
+        "seller_vat": seller_vats[0], "buyer_vat": buyer_vats[0] if buyer_vats else "N/A", "total_amount": total,
+    }]
+
+def parse_pdf_text_layer(doc) -> dict:
+    """逐頁嘗試文字層解析，回傳 {頁碼: receipts}；只包含解析成功的頁面"""
+    parsed = {}
+    if PDF_TEXT_MIN_CHARS <= 0: return parsed
+    with stage_timer("text_layer"):
+        for page_num in range(doc.page_count):
+            text = doc[page_num].get_text("text", sort=True)
+            if len(text.strip()) < PDF_TEXT_MIN_CHARS:
+                metrics.inc("invoice_text_layer_pages_total", result="no_text"); continue
+            receipts = parse_invoice_text(text)
+            metrics.inc("invoice_text_layer_pages_total", result="incomplete" if receipts is None else "parsed")
+            if receipts is not None: parsed[page_num] = receipts
+    return parsed
+
+def release_page_slot(_future):
+    raster_page_slots.release()
+
+# --- 兩階段辨識 (低解析度先辨識，未通過檢查才以高解析度重試) ---
+OCR_INVOICE_NUMBER_PATTERN = re.compile(r'[A-Z]{2}\d{8}')
+
+def receipts_pass_validation(receipts: list) -> bool:
+    """低解析度結果的本機檢查：至少一筆，且每筆的發票號碼格式、統編檢查碼、日期、金額都合理才採用"""
+    if not receipts: return False
+    for receipt in receipts:
+        if not OCR_INVOICE_NUMBER_PATTERN.fullmatch(str(receipt.get("invoice_number", ""))): return False
+        if not is_valid_vat_number(str(receipt.get("seller_vat", ""))): return False
+        buyer_vat = str(receipt.get("buyer_vat", "N/A"))
+        if buyer_vat != "N/A" and not is_valid_vat_number(buyer_vat): return False
+        try:
+            datetime.strptime(str(receipt.get("date", "")), '%Y-%m-%d')
+            if int(receipt.get("total_amount")) <= 0: return False
+        except (ValueError, TypeError): return False
+    return True
+
+# 重試頁面的轉圖在這裡等待 raster_page_slots 名額與轉圖子程序，不佔用 OCR 執行緒 (名額要等 OCR 完成才會歸還)
+ocr_retry_executor = ThreadPoolExecutor(max_workers=max(RASTER_MAX_PROCESSES, 1), thread_name_prefix="ocr-retry")
+
+def render_retry_page(upload: SpooledUpload, file_hash: str, page_num: int) -> tuple:
+    """以 PDF_CONVERSION_DPI 重新轉圖單頁 (先取得一個 raster_page_slots 名額，呼叫端辨識完成後必須 release())。
+    有轉圖程序池時交給子程序直接開暫存檔，否則在本執行緒轉圖；回傳 (bytes, mime_type)"""
+    raster_page_slots.acquire()
+    try:
+        pool = get_raster_pool()
+        with stage_timer("rasterize"):
+            if pool is not None:
+                return pool.submit(render_pdf_page, upload.ensure_path(), file_hash, page_num, PDF_CONVERSION_DPI,
+                                   OCR_RETRY_LONG_EDGE, OCR_RETRY_MAX_BYTES).result()
+            doc = upload.open_pdf()
+            try: return encode_page_image(doc[page_num], PDF_CONVERSION_DPI / 72, OCR_RETRY_LONG_EDGE, OCR_RETRY_MAX_BYTES)
+            finally: doc.close()
+    except Exception:
+        raster_page_slots.release(); raise
+
+def submit_adaptive_retry(fast_future: Future, cache_key: str, upload: SpooledUpload, file_hash: str, page_num: int) -> Future:
+    """第一階段 (低解析度) 結果通過檢查就直接採用並寫入快取；否則以 PDF_CONVERSION_DPI 重新轉圖 (同樣經過轉圖程序池與
+    raster_page_slots) 後再送入 OCR 執行緒池辨識。upload 保留到該頁有最終結果為止；回傳該頁最終結果的 future"""
+    result = Future(); filename = upload.filename
+    upload.retain(); result.add_done_callback(lambda _: upload.close())
+    context = contextvars.copy_context()  # 完成回呼可能在計時器 / 批次執行緒上執行，優先順序與 timing 一律沿用送出時的版本
+
+    def on_high_done(future: Future):
+        try: receipts = future.result()
+        except Exception as e:
+            metrics.inc("invoice_ocr_pass_pages_total", stage="retry", result="failed")
+            result.set_exception(e); return
+        metrics.inc("invoice_ocr_pass_pages_total", stage="retry", result="accepted" if receipts_pass_validation(receipts) else "rejected")
+        result.set_result(receipts)
+
+    def run_high_pass():
+        try: img_bytes, img_mime = render_retry_page(upload, file_hash, page_num)
+        except Exception as e:
+            metrics.inc("invoice_ocr_pass_pages_total", stage="retry", result="failed")
+            result.set_exception(e); return
+        metrics.inc("invoice_image_payload_bytes_total", len(img_bytes), source="pdf")
+        future = submit_extraction(cache_key, img_bytes, img_mime)
+        future.add_done_callback(release_page_slot); future.add_done_callback(on_high_done)
+
+    def on_fast_done(future: Future):
+        try: receipts = future.result()
+        except GeminiExtractionError as e: receipts = None; print(f"PDF '{filename}' 的第 {page_num + 1} 頁低解析度辨識失敗: {e}")
+        except Exception as e: result.set_exception(e); return
+        if receipts_pass_validation(receipts):
+            metrics.inc("invoice_ocr_pass_pages_total", stage="fast", result="accepted")
+            ocr_cache.put(cache_key, receipts); result.set_result(receipts); return
+        metrics.inc("invoice_ocr_pass_pages_total", stage="fast", result="rejected")
+        print(f"PDF '{filename}' 的第 {page_num + 1} 頁低解析度結果未通過檢查，改以 {PDF_CONVERSION_DPI} DPI 重新辨識")
+        ocr_retry_executor.submit(context.copy().run, run_high_pass)
+
+    fast_future.add_done_callback(on_fast_done)
+    return result
+
+def submit_ocr_jobs(upload: SpooledUpload, batcher: GeminiBatcher = None):
+    """將單一檔案送入 OCR 執行緒池，回傳依頁序排列的 futures；不支援的格式回傳 None
+    命中辨識快取的圖片 / 頁面直接回傳已完成的 future，PDF 頁面命中時連轉檔都省略；文字層可解析的 PDF 頁面也一樣"""
+    filename = upload.filename; mime_type = upload.mime_type
+    if mime_type in ["image/jpeg", "image/png", "image/webp"]:
+        image_bytes = upload.getvalue()
+        cache_key = ocr_cache.make_key("image", hashlib.sha256(image_bytes).hexdigest(), OCR_IMAGE_SETTINGS)
+        cached = ocr_cache.get(cache_key)
+        if cached is not None: return [completed_future(cached)]
+        payload, payload_mime = prepare_upload_image(image_bytes, mime_type)
+        metrics.inc("invoice_image_source_bytes_total", len(image_bytes), source="upload")
+        metrics.inc("invoice_image_payload_bytes_total", len(payload), source="upload")
+        print(f"圖片 '{filename}' 送出 {len(payload) // 1024} KB (原檔 {len(image_bytes) // 1024} KB)")
+        return [submit_extraction(cache_key, payload, payload_mime, batcher)]
+    if mime_type == "application/pdf":
+        file_hash = upload.sha256()
+        doc = upload.open_pdf(); page_count = doc.page_count
+        try: text_receipts = parse_pdf_text_layer(doc)
+        finally: doc.close()
+        futures = [None] * page_count; cache_keys = {}
+        for page_num in range(page_count):
+            if page_num in text_receipts:
+                print(f"PDF '{filename}' 的第 {page_num + 1} 頁以文字層解析完成")
+                futures[page_num] = completed_future(text_receipts[page_num]); continue
+            cache_key = ocr_cache.make_key("pdf", file_hash, page_num, PDF_CONVERSION_DPI, OCR_IMAGE_SETTINGS,
+                                           OCR_FAST_DPI, OCR_RETRY_LONG_EDGE, OCR_RETRY_MAX_BYTES)
+            cached = ocr_cache.get(cache_key)
+            if cached is not None:
+                print(f"PDF '{filename}' 的第 {page_num + 1} 頁命中辨識快取")
+                futures[page_num] = completed_future(cached)
+            else:
+                cache_keys[page_num] = cache_key
+        adaptive = 0 < OCR_FAST_DPI < PDF_CONVERSION_DPI
+        for page_num, img_bytes, img_mime in iter_pdf_page_images(upload, list(cache_keys), OCR_FAST_DPI if adaptive else PDF_CONVERSION_DPI):
+            print(f"處理 PDF '{filename}' 的第 {page_num + 1} 頁 ({len(img_bytes) // 1024} KB)...")
+            metrics.inc("invoice_image_payload_bytes_total", len(img_bytes), source="pdf")
+            future = submit_extraction(None if adaptive else cache_keys[page_num], img_bytes, img_mime, batcher)
+            future.add_done_callback(release_page_slot)
+            if adaptive: future = submit_adaptive_retry(future, cache_keys[page_num], upload, file_hash, page_num)
+            futures[page_num] = future
+        return futures
+    return None
+
+def submit_ocr_entry(upload: SpooledUpload, batcher: GeminiBatcher = None, skip_unsupported: bool = False) -> tuple:
+    """送出單一檔案並釋放暫存內容，回傳 (檔名, futures, 錯誤)；略過的不支援檔案 futures 與錯誤皆為 None"""
+    filename = upload.filename
+    try:
+        futures = submit_ocr_jobs(upload, batcher)
+        if futures is None:
+            if skip_unsupported: print(f"略過非支援檔案: {filename}"); return filename, None, None
+            raise Exception(f"不支援的檔案格式: {upload.mime_type}")
+        return filename, futures, None
+    except Exception as e:
+        print(f"--- 處理檔案 {filename} 時發生嚴重錯誤 ---"); traceback.print_exc()
+        return filename, None, e
+    finally:
+        upload.close()
+
+def submit_ocr_batch(entries: list, skip_unsupported: bool = False, batch_images: int = GEMINI_BATCH_MAX_IMAGES) -> list:
+    """entries 為 SpooledUpload 串列；逐一送入 OCR 執行緒池並釋放暫存內容，回傳 (檔名, futures, 錯誤) 串列
+    skip_unsupported=True 時略過不支援的檔案，否則記錄為處理失敗；batch_images > 1 時啟用多圖批次模式"""
+    batcher = GeminiBatcher(batch_images) if batch_images > 1 else None
+    pending = []
+    for upload in entries:
+        item = submit_ocr_entry(upload, batcher, skip_unsupported)
+        if item[1] is not None or item[2] is not None: pending.append(item)
+    if batcher is not None: batcher.flush()
+    return pending
+
+_SUBMIT_DONE = object()
+
+def start_ocr_submitter(entries, skip_unsupported: bool = False, batch_images: int = GEMINI_BATCH_MAX_IMAGES) -> tuple:
+    """在背景執行緒逐一送出 entries (下載、轉圖、送入 OCR 執行緒池)，每送出一個檔案就把 (檔名, futures, 錯誤) 放進佇列，
+    略過的檔案 futures 與錯誤皆為 None，全部送出後放入 _SUBMIT_DONE。回傳 (佇列, stop)：設定 stop 後，
+    背景執行緒在目前檔案送出後停止，並關閉其餘尚未送出的檔案 / 下載"""
+    submitted = queue.Queue(); stop = threading.Event()
+
+    def produce():
+        batcher = GeminiBatcher(batch_images) if batch_images > 1 else None
+        try:
+            for upload in entries:
+                if stop.is_set(): upload.close(); break
+                submitted.put(submit_ocr_entry(upload, batcher, skip_unsupported))
+        except Exception as e:
+            print(f"讀取待處理檔案時發生錯誤: {e}"); traceback.print_exc()
+            submitted.put(("", None, e))
+        finally:
+            if batcher is not None: batcher.flush()
+            if hasattr(entries, "close"): entries.close()  # 例如 iter_drive_downloads: 取消尚未開始的下載
+            submitted.put(_SUBMIT_DONE)
+
+    # 送出執行緒沿用呼叫端的 contextvars (Gemini 優先順序、timing)
+    threading.Thread(target=contextvars.copy_context().run, args=(produce,), name="ocr-submit", daemon=True).start()
+    return submitted, stop
+
+def ocr_item_done(item: tuple) -> bool:
+    return item[1] is None or all(future.done() for future in item[1])
+
+def iter_finished_ocr(entries, skip_unsupported: bool = False, batch_images: int = GEMINI_BATCH_MAX_IMAGES, max_files: int = ENRICH_WINDOW_FILES):
+    """背景送出 entries，依檔案順序產生已辨識完成的檔案群組 [(檔名, futures, 錯誤), ...]：最前面的檔案一完成就產生，
+    並一起帶上緊接其後、同樣已完成的檔案 (最多 max_files 個)，讓呼叫端把整組交給 finalize_ocr_files 合併查詢公司資料。
+    呼叫端不必等整批送出就能開始取得結果；略過的檔案也會出現在群組中 (futures 與錯誤皆為 None)"""
+    submitted, stop = start_ocr_submitter(entries, skip_unsupported, batch_images)
+    buffered = deque(); finished = False
+    try:
+        while True:
+            if not buffered:
+                if finished: return
+                item = submitted.get()
+                if item is _SUBMIT_DONE: return
+                buffered.append(item)
+            if buffered[0][1] is not None: wait_futures(buffered[0][1])
+            while not finished:
+                try: item = submitted.get_nowait()
+                except queue.Empty: break
+                if item is _SUBMIT_DONE: finished = True
+                else: buffered.append(item)
+            group = []
+            while buffered and len(group) < max(max_files, 1) and ocr_item_done(buffered[0]): group.append(buffered.popleft())
+            yield group
+    finally:
+        stop.set()
+
+def collect_ocr_results(futures) -> tuple:
+    """依頁序合併各頁辨識結果，回傳 (receipts, [(頁碼, 錯誤)])；多頁檔案中個別頁面辨識失敗時不影響其他頁，
+    單張圖片 (只有一個 future) 失敗時直接拋出，整個檔案記為失敗"""
+    raw_receipts = []; page_errors = []
+    for page, future in enumerate(futures, 1):
+        try: raw_receipts.extend(future.result())
+        except GeminiExtractionError as e:
+            if len(futures) == 1: raise
+            page_errors.append((page, e))
+    return raw_receipts, page_errors
+
+def finalize_ocr_files(pending: list, batch_id: str = None) -> list:
+    """pending 為 (檔名, futures, 錯誤) 的串列；先依檔案順序收齊 OCR 結果，再整批查詢公司資料 (batch_id 為所屬結果集)，
+    回傳與 pending 對應的每個檔案的結果串列"""
+    collected = []
+    for filename, futures, error in pending:
+        try:
+            if error is not None: raise error
+            raw_receipts, page_errors = collect_ocr_results(futures)
+            for page, page_error in page_errors: print(f"檔案 {filename} 第 {page} 頁辨識失敗: {page_error}")
+            collected.append((filename, raw_receipts, page_errors, None))
+        except Exception as e:
+            if error is None: print(f"處理檔案 {filename} 時發生錯誤: {e}"); traceback.print_exc()
+            collected.append((filename, None, [], e))
+
+    ok = [(raw_receipts, filename) for filename, raw_receipts, _, error in collected if error is None]
+    try:
+        finalized = iter(enrich_and_finalize_batch(ok, batch_id))
+    except Exception as e:
+        print(f"查詢公司資料時發生錯誤: {e}"); traceback.print_exc()
+        collected = [(filename, None, [], error or e) for filename, _, _, error in collected]
+        finalized = iter([])
+
+    per_file = []
+    for filename, raw_receipts, page_errors, error in collected:
+        if error is None:
+            # 辨識失敗的頁面逐頁列出，不會因為其他頁成功就被忽略
+            per_file.append(next(finalized) + [failed_result(filename, page_error, page) for page, page_error in page_errors])
+        else: per_file.append([failed_result(filename, error)])
+    return per_file
+
+def finalize_ocr_batch(pending: list, batch_id: str = None) -> list:
+    """同 finalize_ocr_files，但回傳整批攤平後的結果串列"""
+    return [result for file_results in finalize_ocr_files(pending, batch_id) for result in file_results]
+
+def failed_result(filename: str, error, page: int = None) -> dict:
+    if page is not None: error = f"第 {page} 頁辨識失敗: {error}"
+    return {"來源檔案": filename, "統一發票號碼": f"處理失敗: {error}",}
+
+def is_failed_result(result: dict) -> bool:
+    return "金額總計" not in result and str(result.get("統一發票號碼", "")).startswith("處理失敗: ")
+
+# --- 串流輸出 (NDJSON / SSE) ---
+# 每完成一個檔案就送出該檔案的發票 (type=result) 或錯誤 (type=error)，並附上進度 (type=progress)，
+# 最後送出 type=done。伺服器端不累積整批結果，前端也能在第一個檔案完成時就開始顯示。
+STREAM_MIMETYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+def get_stream_format(json_data=None):
+    """由 ?stream=ndjson|sse、表單 / JSON 的 stream 欄位或 Accept 標頭決定串流格式；不串流時回傳 None"""
+    fmt = request.args.get('stream') or request.form.get('stream') or (json_data or {}).get('stream')
+    if not fmt:
+        accept = request.headers.get('Accept', '')
+        if 'text/event-stream' in accept: fmt = 'sse'
+        elif 'application/x-ndjson' in accept: fmt = 'ndjson'
+    return fmt if fmt in STREAM_MIMETYPES else None
+
+def get_gemini_batch_size(json_data=None) -> int:
+    """?gemini_batch=<張數> (或表單 / JSON 欄位) 可針對單次請求開啟多圖批次模式，未指定時使用環境變數設定"""
+    value = request.args.get('gemini_batch') or request.form.get('gemini_batch') or (json_data or {}).get('gemini_batch')
+    try: return int(value) if value else GEMINI_BATCH_MAX_IMAGES
+    except (ValueError, TypeError): return GEMINI_BATCH_MAX_IMAGES
+
+def encode_stream_event(event: dict, fmt: str) -> str:
+    data = json.dumps(event, ensure_ascii=False)
+    if fmt == "sse": return f"event: {event['type']}\ndata: {data}\n\n"
+    return data + "\n"
+
+def stream_ocr_results(entries, fmt: str, skip_unsupported: bool = False, batch_images: int = GEMINI_BATCH_MAX_IMAGES, total: int = None):
+    """背景送出 OCR 的同時，依檔案順序在檔案辨識完成時立即整理結果 (已完成的相鄰檔案合併查詢公司資料) 並產生串流事件。
+    total 為預計檔案數 (entries 為串列時自動計算)，略過的檔案會從中扣除"""
+    if total is None and hasattr(entries, "__len__"): total = len(entries)
+    count = 0; done = 0
+    # 結果同時寫入伺服器端結果集，匯出時只需送 result_set_id
+    result_set_id = result_store.create()
+    yield encode_stream_event({"type": "progress", "done": 0, "total": total, "result_set_id": result_set_id}, fmt)
+    for group in iter_finished_ocr(entries, skip_unsupported=skip_unsupported, batch_images=batch_images):
+        if total is not None: total -= sum(1 for _, futures, error in group if futures is None and error is None)
+        group = [item for item in group if item[1] is not None or item[2] is not None]
+        for (filename, _, _), file_results in zip(group, finalize_ocr_files(group, result_set_id)):
+            result_store.append(result_set_id, file_results)
+            for result in file_results:
+                failed = is_failed_result(result)
+                if not failed: count += 1
+                yield encode_stream_event({"type": "error" if failed else "result", "result": result}, fmt)
+            done += 1
+            yield encode_stream_event({"type": "progress", "done": done, "total": total, "file": filename}, fmt)
+    result_store.finish(result_set_id)
+    yield encode_stream_event(with_timing({"type": "done", "count": count, "total": done, "result_set_id": result_set_id}), fmt)
+
+def stream_response(entries, fmt: str, skip_unsupported: bool = False, batch_images: int = GEMINI_BATCH_MAX_IMAGES, total: int = None) -> Response:
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(stream_ocr_results(entries, fmt, skip_unsupported, batch_images, total)),
+                    mimetype=STREAM_MIMETYPES[fmt], headers=headers)
+
+# --- 統一編號檢查與修正 ---
+# 檢查碼規則: 各位數乘上 1,2,1,2,1,2,4,1 後取「十位數 + 個位數」加總，總和可被 10 整除即有效；
+# 第 7 位為 7 時，總和 + 1 可被 10 整除也算有效。每一位、每個數字的貢獻值事先算好查表即可。
+VAT_MULTIPLIERS = (1, 2, 1, 2, 1, 2, 4, 1)
+VAT_DIGIT_CONTRIBUTIONS = tuple(tuple((d * m) // 10 + (d * m) % 10 for d in range(10)) for m in VAT_MULTIPLIERS)
+
+@functools.lru_cache(maxsize=None)
+def vat_contribution_array():
+    """VAT_DIGIT_CONTRIBUTIONS 的 NumPy 版 (第一次批次修正時才建立)"""
+    return np.array(VAT_DIGIT_CONTRIBUTIONS, dtype=np.int16)
+# 斜線 '0' 常被看成 '8'、'6' 或 '9' (見 Prompt 規則 1)；數字為替換成本，'9' 較少見所以成本較高
+VAT_CONFUSABLE_DIGITS = {'8': (('0', 1.0),), '6': (('0', 1.0),), '9': (('0', 1.5),)}
+# 不經確認就直接採用的候選: 只替換 1 個數字且成本不超過此值 (即舊版的 '8' / '6' -> '0')；其餘候選可能把
+# 原本就無效的統編改成另一家公司的有效統編，只有公司快取或離線稅籍索引中確認存在時才採用 (見 correct_batch_vats)
+VAT_UNCONFIRMED_MAX_COST = 1.0
+
+def _vat_checksum_ok(total: int, seventh_digit: str) -> bool:
+    return total % 10 == 0 or (seventh_digit == '7' and (total + 1) % 10 == 0)
 
 def is_valid_vat_number(vat: str) -> bool:
     if not vat or not vat.isdigit() or len(vat) != 8: return False
-    multipliers = [1, 2, 1, 2, 1, 2, 4, 1]; total = 0
-    for i in range(8): product = int(vat[i]) * multipliers[i]; total += (product // 10) + (product % 10)
-    if total % 10 == 0: return True
-    if vat[6] == '7' and (total + 1) % 10 == 0: return True
-    return False
+    total = sum(VAT_DIGIT_CONTRIBUTIONS[i][int(vat[i])] for i in range(8))
+    return _vat_checksum_ok(total, vat[6])
+
+def vat_correction_candidates(vat: str) -> list:
+    """列出最多替換 VAT_MAX_SUBSTITUTIONS 個易混淆數字後能通過檢查碼的統編，依替換成本排序 (成本相同時依位置先後)。
+    本身有效時回傳 [vat]；不是 8 位數字時回傳 []"""
+    return correct_vat_numbers([vat])[0][1]
 
 def correct_vat_number(vat: str) -> str:
-    if is_valid_vat_number(vat): return vat
-    error_indices = [i for i, char in enumerate(vat) if char in ('8', '6')]
-    for i in error_indices:
-        temp_vat_list = list(vat); temp_vat_list[i] = '0'
-        corrected_vat = "".join(temp_vat_list)
-        if is_valid_vat_number(corrected_vat): print(f"統一編號修正成功: {vat} -> {corrected_vat}"); return corrected_vat
-    return vat
+    corrected = correct_vat_numbers([vat])[0][0]
+    if corrected != vat: print(f"統一編號修正成功: {vat} -> {corrected}")
+    return corrected
+
+def correct_vat_numbers(vats: list) -> list:
+    """批次版：以 NumPy 一次驗證整批統編，只對無效者展開候選，所有候選再一次向量化驗證。
+    回傳與 vats 對應的 (修正後統編, 候選串列) 串列；候選已依成本排序，供 enrich 階段比對公司快取。
+    修正後統編只採用不需確認的候選 (單一 '8' / '6' -> '0'，與舊版結果相同)，沒有時維持原值"""
+    results = [(vat, []) for vat in vats]
+    indices = [k for k, vat in enumerate(vats) if isinstance(vat, str) and len(vat) == 8 and vat.isascii() and vat.isdigit()]
+    if not indices: return results
+    digits = np.frombuffer("".join(vats[k] for k in indices).encode("ascii"), dtype=np.uint8).reshape(-1, 8) - ord('0')
+    contributions = vat_contribution_array()
+    totals = contributions[np.arange(8), digits].sum(axis=1)
+    valid = (totals % 10 == 0) | ((digits[:, 6] == 7) & ((totals + 1) % 10 == 0))
+
+    expanded = []  # (原索引, 成本, 替換數, 位置, 候選)
+    for k, ok in zip(indices, valid):
+        if ok: results[k] = (vats[k], [vats[k]]); continue
+        expanded.extend((k, *candidate) for candidate in _enumerate_vat_substitutions(vats[k], VAT_MAX_SUBSTITUTIONS))
+    if expanded:
+        cand_digits = np.frombuffer("".join(e[4] for e in expanded).encode("ascii"), dtype=np.uint8).reshape(-1, 8) - ord('0')
+        cand_totals = contributions[np.arange(8), cand_digits].sum(axis=1)
+        cand_valid = (cand_totals % 10 == 0) | ((cand_digits[:, 6] == 7) & ((cand_totals + 1) % 10 == 0))
+        per_vat = {}
+        for entry, ok in zip(expanded, cand_valid):
+            if ok: per_vat.setdefault(entry[0], []).append(entry[1:])
+        for k, found in per_vat.items():
+            found.sort()
+            corrected = next((candidate for cost, count, _, candidate in found if count == 1 and cost <= VAT_UNCONFIRMED_MAX_COST), vats[k])
+            results[k] = (corrected, [candidate for _, _, _, candidate in found])
+    return results
+
+def _enumerate_vat_substitutions(vat: str, max_substitutions: int):
+    """產生所有 1 ~ max_substitutions 個易混淆數字替換 (不檢查檢查碼)：(成本, 替換數, 位置, 候選)"""
+    options = [(i, r, cost) for i, c in enumerate(vat) for r, cost in VAT_CONFUSABLE_DIGITS.get(c, ())]
+
+    def walk(start: int, chars: list, cost: float, used: tuple):
+        if used: yield cost, len(used), used, "".join(chars)
+        if len(used) >= max_substitutions: return
+        for k in range(start, len(options)):
+            i, r, c = options[k]
+            if used and used[-1] == i: continue
+            original = chars[i]; chars[i] = r
+            yield from walk(k + 1, chars, cost + c, used + (i,))
+            chars[i] = original
+
+    return walk(0, list(vat), 0.0, ())
+
+# --- 公司查詢快取 (記憶體 LRU + SQLite) ---
+COMPANY_NOT_FOUND_NAME = "查無資料(連線失敗)"
+
+class CompanyInfoCache:
+    """以統一編號為鍵的公司資料快取；前面是程序內 LRU，後面是可跨程序共用的 SQLite 檔案"""
+
+    def __init__(self, db_path: str, ttl: int, negative_ttl: int, lru_size: int):
+        self.db_path = db_path; self.ttl = ttl; self.negative_ttl = negative_ttl; self.lru_size = lru_size
+        self._lru = OrderedDict()  # vat -> (info, expires_at)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS company_cache (
+                vat TEXT PRIMARY KEY, name TEXT NOT NULL, address TEXT NOT NULL,
+                found INTEGER NOT NULL, expires_at REAL NOT NULL)""")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _remember(self, vat: str, info: dict, expires_at: float):
+        with self._lock:
+            self._lru[vat] = (info, expires_at); self._lru.move_to_end(vat)
+            while len(self._lru) > self.lru_size: self._lru.popitem(last=False)
+
+    def get(self, vat: str):
+        """回傳未過期的快取資料，沒有則回傳 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(vat)
+            if entry is not None:
+                if entry[1] > now:
+                    self._lru.move_to_end(vat)
+                    return dict(entry[0])
+                del self._lru[vat]
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT name, address, expires_at FROM company_cache WHERE vat = ?", (vat,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"[Company Cache Warning] 讀取快取失敗: {e}"); return None
+        if not row or row[2] <= now: return None
+        info = {"name": row[0], "address": row[1]}
+        self._remember(vat, info, row[2])
+        return dict(info)
+
+    def put(self, vat: str, info: dict):
+        found = info.get("name") not in ("", "N/A", COMPANY_NOT_FOUND_NAME)
+        expires_at = time.time() + (self.ttl if found else self.negative_ttl)
+        info = {"name": info.get("name", ""), "address": info.get("address", "")}
+        self._remember(vat, info, expires_at)
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO company_cache (vat, name, address, found, expires_at) VALUES (?, ?, ?, ?, ?)",
+                             (vat, info["name"], info["address"], int(found), expires_at))
+        except sqlite3.Error as e:
+            print(f"[Company Cache Warning] 寫入快取失敗: {e}")
+
+company_cache = CompanyInfoCache(os.path.join(CACHE_FOLDER, 'company_cache.db'),
+                                 COMPANY_CACHE_TTL, COMPANY_CACHE_NEGATIVE_TTL, COMPANY_CACHE_LRU_SIZE)
+
+class RateLimiter:
+    """最小間隔限流器 (執行緒安全)：每次 wait() 之間至少相隔 1 / rate 秒"""
+
+    def __init__(self, rate_per_sec: float):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(self._next_at, now)
+            self._next_at = start_at + self.interval
+        if start_at > now: time.sleep(start_at - now)
+
+registry_rate_limiter = RateLimiter(REGISTRY_MAX_REQUESTS_PER_SEC)
+registry_executor = ThreadPoolExecutor(max_workers=REGISTRY_MAX_WORKERS, thread_name_prefix="registry")
+
+# --- 離線稅籍索引 (財政部「全國營業(稅籍)登記資料集」) ---
+# 將數百萬筆的 CSV 轉成依統編排序的固定寬度索引檔，版面為:
+#   檔頭 (魔術字 + 筆數) | 統編 uint32[n] | 字串位移 uint32[n] | 字串長度 uint16[n] | 字串區 (名稱 \x1f 地址，UTF-8)
+# 查詢時以 mmap 開啟、在統編陣列上二分搜尋 (O(log n)、不連網)；gunicorn 各 worker 共用作業系統的頁面快取，
+# 不會各自複製一份。索引查不到 (新設立、資料集尚未收錄) 的統編才改查公司快取與線上 API。
+REGISTRY_INDEX_MAGIC = b"INVREG01"
+REGISTRY_INDEX_HEADER = struct.Struct("<8sQ")
+# 資料集欄位名稱
+REGISTRY_CSV_COLUMNS = ("統一編號", "營業人名稱", "營業地址")
+
+def import_registry_csv(csv_path: str, index_path: str = REGISTRY_INDEX_PATH, encoding: str = "utf-8-sig") -> int:
+    """將稅籍登記 CSV 轉為索引檔 (先寫暫存檔再原子替換，服務中的程序會在下次檢查時改用新檔)；回傳收錄筆數。
+    字串先依讀取順序寫入暫存檔，記憶體中只保留統編與位移，排序後同一統編保留第一筆"""
+    vats = array("I"); offsets = array("I"); lengths = array("H"); position = 0
+    with open(csv_path, newline="", encoding=encoding, errors="replace") as f, tempfile.TemporaryFile() as strings:
+        reader = csv.reader(f)
+        # 資料集開頭可能有標題說明列，以含有「統一編號」的列為表頭
+        for header in reader:
+            if REGISTRY_CSV_COLUMNS[0] in header: break
+        else:
+            raise ValueError(f"找不到表頭欄位: {REGISTRY_CSV_COLUMNS[0]}")
+        try: vat_col, name_col, address_col = (header.index(column) for column in REGISTRY_CSV_COLUMNS)
+        except ValueError as e: raise ValueError(f"CSV 缺少必要欄位 {REGISTRY_CSV_COLUMNS}") from e
+        for row in reader:
+            if len(row) <= max(vat_col, name_col, address_col): continue
+            vat = row[vat_col].strip()
+            if len(vat) != 8 or not vat.isdigit(): continue
+            data = f"{row[name_col].strip()}\x1f{row[address_col].strip()}".encode("utf-8")
+            # 字串長度上限 64 KB；截斷時退回完整字元的邊界，避免切在多位元組字元中間
+            if len(data) > 0xFFFF: data = data[:0xFFFF].decode("utf-8", "ignore").encode("utf-8")
+            # 位移以 uint32 保存，先檢查再寫入 (array('I') 溢位時只會拋出 OverflowError)
+            if position > 0xFFFFFFFF: raise ValueError("資料集過大，字串區超過 4 GB")
+            strings.write(data); vats.append(int(vat)); offsets.append(position); lengths.append(len(data))
+            position += len(data)
+
+        vat_array = np.frombuffer(vats, dtype=np.uint32)
+        order = np.argsort(vat_array, kind="stable")
+        sorted_vats = vat_array[order]
+        keep = np.ones(len(order), dtype=bool); keep[1:] = sorted_vats[1:] != sorted_vats[:-1]
+        order = order[keep]
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as out:
+            out.write(REGISTRY_INDEX_HEADER.pack(REGISTRY_INDEX_MAGIC, len(order)))
+            out.write(vat_array[order].astype("<u4").tobytes())
+            out.write(np.frombuffer(offsets, dtype=np.uint32)[order].astype("<u4").tobytes())
+            out.write(np.frombuffer(lengths, dtype=np.uint16)[order].astype("<u2").tobytes())
+            strings.seek(0); shutil.copyfileobj(strings, out)
+    os.replace(tmp_path, index_path)
+    return len(order)
+
+class RegistryIndex:
+    """唯讀的離線稅籍索引 (mmap)；每 REGISTRY_INDEX_RECHECK_SECONDS 秒檢查一次檔案是否被重新匯入"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._state = None  # (mtime, mmap, 統編陣列, 位移陣列, 長度陣列, 字串區起點)
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < REGISTRY_INDEX_RECHECK_SECONDS: return self._state
+        with self._lock:
+            self._checked_at = now
+            try: mtime = os.stat(self.path).st_mtime_ns
+            except OSError: self._state = None; return None
+            if self._state is not None and self._state[0] == mtime: return self._state
+            try:
+                with open(self.path, "rb") as f: mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, count = REGISTRY_INDEX_HEADER.unpack_from(mm, 0)
+                if magic != REGISTRY_INDEX_MAGIC: raise ValueError("檔案格式不符")
+                start = REGISTRY_INDEX_HEADER.size
+                vats = np.frombuffer(mm, dtype="<u4", count=count, offset=start)
+                offsets = np.frombuffer(mm, dtype="<u4", count=count, offset=start + 4 * count)
+                lengths = np.frombuffer(mm, dtype="<u2", count=count, offset=start + 8 * count)
+            except (OSError, ValueError, struct.error) as e:
+                print(f"[Registry Index Warning] 無法開啟離線稅籍索引 {self.path}: {e}"); self._state = None; return None
+            # 舊的 mmap 可能仍有執行緒在讀取，不主動關閉，交給垃圾回收
+            self._state = (mtime, mm, vats, offsets, lengths, start + 10 * count)
+            print(f"離線稅籍索引已載入: {count} 筆")
+            return self._state
+
+    def get(self, vat_number: str):
+        """回傳 {"name", "address"}；索引不存在或查無此統編時回傳 None"""
+        if not vat_number or len(vat_number) != 8 or not vat_number.isdigit(): return None
+        state = self._open()
+        if state is None: return None
+        _, mm, vats, offsets, lengths, strings_start = state
+        key = int(vat_number)
+        # key 轉成與陣列相同型別，否則 searchsorted 會先把整個陣列轉型複製一份
+        index = int(np.searchsorted(vats, vats.dtype.type(key)))
+        if index >= len(vats) or vats[index] != key:
+            metrics.inc("invoice_registry_offline_requests_total", result="miss"); return None
+        metrics.inc("invoice_registry_offline_requests_total", result="hit")
+        start = strings_start + int(offsets[index])
+        name, _, address = mm[start:start + int(lengths[index])].decode("utf-8", "ignore").partition("\x1f")
+        return {"name": name, "address": address}
+
+registry_index = RegistryIndex(REGISTRY_INDEX_PATH)
+
+def lookup_company_info(vat_number: str):
+    """查詢公司資料，回傳 (資料, 是否命中快取)"""
+    if not vat_number or vat_number == 'N/A' or not vat_number.isdigit():
+        return {"name": "N/A", "address": ""}, True
+    offline = registry_index.get(vat_number)
+    if offline is not None: return offline, True
+    cached = company_cache.get(vat_number)
+    if cached is not None:
+        metrics.inc("invoice_registry_cache_requests_total", result="hit"); return cached, True
+    metrics.inc("invoice_registry_cache_requests_total", result="miss")
+    with stage_timer("registry_rate_limit"): registry_rate_limiter.wait()
+    info = fetch_company_info_from_registry(vat_number)
+    company_cache.put(vat_number, info)
+    return info, False
 
-# --- 增強版公司查詢 (含備援) ---
 def get_company_info_from_fia_api(vat_number: str) -> dict:
-    if not vat_number or vat_number == 'N/A' or not vat_number.isdigit(): 
-        return {"name": "N/A", "address": ""}
-    
-    headers = {"User-Agent": "Mozilla/5.0"}
-    
-    # --- 策略 A: 財政部官方 API ---
-    try:
-        api_url = f"https://eip.fia.gov.tw/OAI/api/businessRegistration/{vat_number}"
-        response = requests.get(api_url, headers=headers, timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            company_name = data.get("businessNm", "")
-            company_address = data.get("businessAddress", "")
-            if company_name:
-                full_width_chars = "０１２３４５６７８９ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏpqrstuvwxyz"
-                half_width_chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-                translation_table = str.maketrans(full_width_chars, half_width_chars)
-                return {
-                    "name": company_name.translate(translation_table), 
-                    "address": company_address.translate(translation_table)
-                }
-    except Exception: pass
-
-    # --- 策略 B: g0v API (通用解析版) ---
+    return lookup_company_info(vat_number)[0]
+
+def is_known_company(vat_number: str) -> bool:
+    """只查離線索引與快取 (不連線)：此統編是否已確認有稅籍資料"""
+    info = registry_index.get(vat_number) or company_cache.get(vat_number)
+    return info is not None and info.get("name") not in ("", "N/A", COMPANY_NOT_FOUND_NAME)
+
+def resolve_company_infos(vat_numbers) -> dict:
+    """批次查詢：相同統編只查一次，不同統編交給限流的執行緒池並行查詢，回傳 {統編: 資料}"""
+    futures = {vat: submit_in_context(registry_executor, get_company_info_from_fia_api, vat) for vat in dict.fromkeys(vat_numbers)}
+    return {vat: future.result() for vat, future in futures.items()}
+
+# --- 增強版公司查詢 (含備援) ---
+# 每個執行緒一個 requests.Session (保留 keep-alive 連線，不再每次重新 TLS 交握)，
+# 每個來源各有一個斷路器，財政部掛掉時不必讓每張發票都等滿逾時。
+REGISTRY_HEADERS = {"User-Agent": "Mozilla/5.0"}
+FULL_WIDTH_TRANSLATION = str.maketrans(
+    "０１２３４５６７８９ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏpqrstuvwxyz",
+    "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+
+_registry_local = threading.local()
+
+def registry_session() -> requests.Session:
+    session = getattr(_registry_local, 'session', None)
+    if session is None:
+        session = _registry_local.session = requests.Session()
+        session.headers.update(REGISTRY_HEADERS)
+    return session
+
+class CircuitBreaker:
+    """連續失敗 threshold 次後進入開路狀態 cooldown 秒，期間直接略過該來源；冷卻結束後放行一次試探請求"""
+
+    def __init__(self, name: str, threshold: int, cooldown: float, upstream: str):
+        self.name = name; self.threshold = threshold; self.cooldown = cooldown; self.upstream = upstream  # upstream: 指標標籤
+        self.failures = 0; self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None: return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                self.opened_at = time.monotonic()  # 半開: 放行這一次，其餘請求繼續等待冷卻
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock: self.failures = 0; self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None: print(f"[Registry] {self.name} 連續失敗 {self.failures} 次，暫停使用 {self.cooldown:.0f} 秒")
+                self.opened_at = time.monotonic()
+
+fia_breaker = CircuitBreaker("財政部 API", REGISTRY_BREAKER_THRESHOLD, REGISTRY_BREAKER_COOLDOWN, "fia")
+g0v_breaker = CircuitBreaker("g0v API", REGISTRY_BREAKER_THRESHOLD, REGISTRY_BREAKER_COOLDOWN, "g0v")
+registry_hedge_executor = ThreadPoolExecutor(max_workers=max(REGISTRY_MAX_WORKERS * 2, 2), thread_name_prefix="registry-hedge")
+
+def query_fia(vat_number: str):
+    """策略 A: 財政部官方 API；查無資料回傳 None，連線失敗或 5xx 拋出例外"""
+    response = registry_session().get(FIA_API_URL.format(vat=vat_number), timeout=FIA_API_TIMEOUT)
+    if response.status_code >= 500: raise requests.HTTPError(f"HTTP {response.status_code}")
+    if response.status_code == 200:
+        data = response.json()
+        company_name = data.get("businessNm", "")
+        company_address = data.get("businessAddress", "")
+        if company_name:
+            return {
+                "name": company_name.translate(FULL_WIDTH_TRANSLATION), 
+                "address": company_address.translate(FULL_WIDTH_TRANSLATION)
+            }
+    return None
+
+def query_g0v(vat_number: str):
+    """策略 B: g0v API (通用解析版)；查無資料回傳 None，連線失敗或 5xx 拋出例外"""
+    response = registry_session().get(G0V_API_URL.format(vat=vat_number), timeout=G0V_API_TIMEOUT)
+    if response.status_code >= 500: raise requests.HTTPError(f"HTTP {response.status_code}")
+    if response.status_code == 200:
+        result = response.json()
+
+        # g0v 回傳的結構通常是 {"data": { "來源A": {...}, "來源B": {...} }}
+        if "data" in result and isinstance(result["data"], dict):
+            all_sources = result["data"]
+
+            # 我們遍歷所有來源 (例如 "財政部", "經濟部商業司"...)
+            for source_name, info in all_sources.items():
+                if isinstance(info, dict):
+                    # 嘗試抓取各種可能的名稱欄位
+                    name = (info.get("公司名稱") or 
+                            info.get("商業名稱") or 
+                            info.get("營業人名稱") or  # <--- 針對普客二四這種財政部資料
+                            info.get("名稱"))
+
+                    if name:
+                        return {"name": name, "address": ""}
+    return None
+
+def query_with_breaker(query, breaker: CircuitBreaker, vat_number: str):
+    """經斷路器呼叫查詢來源；來源暫停中或失敗時回傳 None"""
+    if not breaker.allow():
+        metrics.inc("invoice_registry_breaker_skips_total", upstream=breaker.upstream); return None
     try:
-        # print(f"g0v 查詢: {vat_number}")
-        g0v_url = f"https://company.g0v.ronny.tw/api/show/{vat_number}"
-        response = requests.get(g0v_url, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            result = response.json()
-            
-            # g0v 回傳的結構通常是 {"data": { "來源A": {...}, "來源B": {...} }}
-            if "data" in result and isinstance(result["data"], dict):
-                all_sources = result["data"]
-                
-                # 我們遍歷所有來源 (例如 "財政部", "經濟部商業司"...)
-                for source_name, info in all_sources.items():
-                    if isinstance(info, dict):
-                        # 嘗試抓取各種可能的名稱欄位
-                        name = (info.get("公司名稱") or 
-                                info.get("商業名稱") or 
-                                info.get("營業人名稱") or  # <--- 針對普客二四這種財政部資料
-                                info.get("名稱"))
-                        
-                        if name:
-                            return {"name": name, "address": ""}
-                            
+        with stage_timer(f"registry_{breaker.upstream}"): info = query(vat_number)
     except Exception as e:
-        print(f"g0v 查詢失敗: {e}")
-
-    return {"name": "查無資料(連線失敗)", "address": ""}
+        metrics.inc("invoice_upstream_failures_total", upstream=breaker.upstream)
+        breaker.record_failure()
+        print(f"{breaker.name} 查詢失敗: {e}")
+        return None
+    breaker.record_success()
+    return info
+
+def fetch_company_info_from_registry(vat_number: str) -> dict:
+    """直接向財政部 / g0v 查詢 (不經快取)"""
+    if REGISTRY_HEDGE_DELAY > 0:
+        info = fetch_company_info_hedged(vat_number, REGISTRY_HEDGE_DELAY)
+    else:
+        info = query_with_breaker(query_fia, fia_breaker, vat_number) or query_with_breaker(query_g0v, g0v_breaker, vat_number)
+    return info or {"name": COMPANY_NOT_FOUND_NAME, "address": ""}
+
+def fetch_company_info_hedged(vat_number: str, hedge_delay: float):
+    """對沖查詢：先查財政部，hedge_delay 秒內沒有有效結果就同時查 g0v，回傳最先取得的有效資料"""
+    futures = [submit_in_context(registry_hedge_executor, query_with_breaker, query_fia, fia_breaker, vat_number)]
+    try:
+        info = futures[0].result(timeout=hedge_delay)
+        if info: return info
+    except FutureTimeoutError:
+        pass
+    futures.append(submit_in_context(registry_hedge_executor, query_with_breaker, query_g0v, g0v_breaker, vat_number))
+    for future in as_completed(futures):
+        info = future.result()
+        if info: return info
+    return None
+
+def build_receipt(raw_receipt: dict, source_filename: str, vat_corrections: dict = None) -> dict:
+    """整理單筆辨識結果 (金額、日期、格式代碼、統編修正)，公司名稱與地址留待 enrich 階段填入
+    vat_corrections 為整批預先算好的 {原統編: 修正後統編}，沒有時逐筆修正"""
+    try: total = int(raw_receipt.get("total_amount", 0))
+    except (ValueError, TypeError): total = 0
+    tax_exclusive_amount = round(total / 1.05) if total > 0 else 0; tax_amount = total - tax_exclusive_amount if total > 0 else 0
+    date_part = raw_receipt.get("date", "N/A"); day_of_week = "N/A"
+
+    selected_map = INVOICE_PREFIX_MAP_2025
+    if date_part != "N/A":
+        try: 
+            dt = datetime.strptime(date_part, '%Y-%m-%d')
+            weekdays = ["一", "二", "三", "四", "五", "六", "日"]
+            day_of_week = weekdays[dt.weekday()]
+            if dt.year == 2026: selected_map = INVOICE_PREFIX_MAP_2026
+        except ValueError: day_of_week = "格式錯誤"
+
+    seller_vat = raw_receipt.get("seller_vat", "N/A"); buyer_vat = raw_receipt.get("buyer_vat", "N/A")
+    if vat_corrections is None: vat_corrections = {}
+    corrected_seller_vat = vat_corrections.get(seller_vat) or correct_vat_number(seller_vat)
+    corrected_buyer_vat = vat_corrections.get(buyer_vat) or correct_vat_number(buyer_vat)
+    invoice_number = raw_receipt.get("invoice_number", "N/A"); prefix = invoice_number[:2].upper() if invoice_number and len(invoice_number) == 10 else ""
+
+    format_code_str = selected_map.get(prefix, '25');
+    try: format_code_int = int(format_code_str)
+    except (ValueError, TypeError): format_code_int = 25
+    return {
+        "統一發票號碼": invoice_number, "格式": format_code_int,
+        "交易日期": date_part, "星期": day_of_week, "交易時間": raw_receipt.get("time", ""),
+        "賣方統一編號": corrected_seller_vat, "賣方名稱": "", "賣方營業地址": "",
+        "買方統一編號": corrected_buyer_vat, "買方名稱": "", "買方營業地址": "",
+        "未稅金額": tax_exclusive_amount, "進項稅額": tax_amount, "金額總計": total, "來源檔案": source_filename,
+    }
+
+def enrich_receipts(receipts: list) -> list:
+    """批次補上買賣方公司名稱與地址：先收集不重複的統編，一次查完再分配回每張發票"""
+    company_infos = resolve_company_infos(
+        [r["賣方統一編號"] for r in receipts] + [r["買方統一編號"] for r in receipts])
+    for receipt in receipts:
+        seller_info = company_infos[receipt["賣方統一編號"]]; buyer_info = company_infos[receipt["買方統一編號"]]
+        receipt["賣方名稱"] = seller_info["name"]; receipt["賣方營業地址"] = seller_info["address"]
+        receipt["買方名稱"] = buyer_info["name"]; receipt["買方營業地址"] = buyer_info["address"]
+    return receipts
+
+def correct_batch_vats(batch: list) -> dict:
+    """整批統編一次修正：優先採用公司快取 / 離線稅籍索引中已確認存在的候選 (不額外連線查詢)；
+    都未確認時只採用不需確認的候選 (見 VAT_UNCONFIRMED_MAX_COST)，否則維持原值"""
+    raw_vats = list(dict.fromkeys(
+        vat for raw_receipts, _ in batch for raw_receipt in raw_receipts
+        for vat in (raw_receipt.get("seller_vat", "N/A"), raw_receipt.get("buyer_vat", "N/A"))))
+    corrections = {}
+    for vat, (corrected, candidates) in zip(raw_vats, correct_vat_numbers(raw_vats)):
+        if candidates and candidates[0] != vat:
+            corrected = next((c for c in candidates if is_known_company(c)), corrected)
+        if corrected != vat: print(f"統一編號修正成功: {vat} -> {corrected}")
+        corrections[vat] = corrected
+    return corrections
+
+def enrich_and_finalize_batch(batch: list, batch_id: str = None) -> list:
+    """batch 為 (raw_receipts, 來源檔名) 串列；整批一起查詢公司資料，回傳與 batch 對應的最終資料串列
+    已由其他結果集匯出的發票標記為重複並沿用索引中的公司資料 (batch_id 為所屬結果集)"""
+    with stage_timer("enrich"):
+        vat_corrections = correct_batch_vats(batch)
+        per_file = [[build_receipt(raw_receipt, source_filename, vat_corrections) for raw_receipt in raw_receipts] for raw_receipts, source_filename in batch]
+        fresh = apply_invoice_index([receipt for receipts in per_file for receipt in receipts], batch_id)
+        enrich_receipts(fresh)
+    return per_file
 
 def enrich_and_finalize_data(raw_receipts: list, source_filename: str) -> list:
-    final_receipts = []
-    for raw_receipt in raw_receipts:
-        try: total = int(raw_receipt.get("total_amount", 0))
-        except (ValueError, TypeError): total = 0
-        tax_exclusive_amount = round(total / 1.05) if total > 0 else 0; tax_amount = total - tax_exclusive_amount if total > 0 else 0
-        date_part = raw_receipt.get("date", "N/A"); day_of_week = "N/A"
-        
-        selected_map = INVOICE_PREFIX_MAP_2025
-        if date_part != "N/A":
-            try: 
-                dt = datetime.strptime(date_part, '%Y-%m-%d')
-                weekdays = ["一", "二", "三", "四", "五", "六", "日"]
-                day_of_week = weekdays[dt.weekday()]
-                if dt.year == 2026: selected_map = INVOICE_PREFIX_MAP_2026
-            except ValueError: day_of_week = "格式錯誤"
-        
-        seller_vat = raw_receipt.get("seller_vat", "N/A"); buyer_vat = raw_receipt.get("buyer_vat", "N/A")
-        corrected_seller_vat = correct_vat_number(seller_vat); corrected_buyer_vat = correct_vat_number(buyer_vat)
-        seller_info = get_company_info_from_fia_api(corrected_seller_vat); time.sleep(0.5); buyer_info = get_company_info_from_fia_api(corrected_buyer_vat)
-        invoice_number = raw_receipt.get("invoice_number", "N/A"); prefix = invoice_number[:2].upper() if invoice_number and len(invoice_number) == 10 else ""
-        
-        format_code_str = selected_map.get(prefix, '25');
-        try: format_code_int = int(format_code_str)
-        except (ValueError, TypeError): format_code_int = 25
-        receipt = {
-            "統一發票號碼": invoice_number, "格式": format_code_int,
-            "交易日期": date_part, "星期": day_of_week, "交易時間": raw_receipt.get("time", ""),
-            "賣方統一編號": corrected_seller_vat, "賣方名稱": seller_info["name"], "賣方營業地址": seller_info["address"],
-            "買方統一編號": corrected_buyer_vat, "買方名稱": buyer_info["name"], "買方營業地址": buyer_info["address"],
-            "未稅金額": tax_exclusive_amount, "進項稅額": tax_amount, "金額總計": total, "來源檔案": source_filename,
+    return enrich_and_finalize_batch([(raw_receipts, source_filename)])[0]
+
+# --- 發票索引 (跨批次重複偵測) ---
+# 以 (發票號碼, 賣方統編, 交易日期) 為鍵，在 GV / 費用報表「匯出成功」時記錄匯出的發票 (只辨識未匯出的批次不算)。
+# 之後其他批次再出現已匯出的發票時標記為重複，直接沿用索引中的公司名稱 / 地址 (不再查詢稅籍)，
+# 匯出時預設排除，避免進項稅額重複計算。誤匯出的批次可用 DELETE /invoice_index/<result_set_id> 從索引移除。
+# 直接送 results (沒有結果集) 的匯出以 batch_id 區分批次 (見 export_batch_id)。
+INVOICE_DUPLICATE_FIELD = "重複發票"
+INVOICE_INDEX_LOOKUP_CHUNK = 500
+
+def invoice_key(receipt: dict):
+    """回傳索引鍵 (發票號碼, 賣方統編, 交易日期)；發票號碼不完整或處理失敗的資料回傳 None"""
+    invoice_number = str(receipt.get("統一發票號碼", "")).strip().upper()
+    if not OCR_INVOICE_NUMBER_PATTERN.fullmatch(invoice_number): return None
+    return invoice_number, str(receipt.get("賣方統一編號", "")), str(receipt.get("交易日期", ""))
+
+class InvoiceIndex:
+    """已匯出發票的 SQLite 索引 (batch_id 為匯出時的結果集)；lookup_many 以分段的 row-value IN 查詢整批鍵值"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS invoice_index (
+                invoice_number TEXT NOT NULL, seller_vat TEXT NOT NULL, date TEXT NOT NULL,
+                seller_name TEXT NOT NULL, seller_address TEXT NOT NULL,
+                buyer_vat TEXT NOT NULL, buyer_name TEXT NOT NULL, buyer_address TEXT NOT NULL,
+                total INTEGER NOT NULL, source_file TEXT NOT NULL, batch_id TEXT, first_seen REAL NOT NULL,
+                PRIMARY KEY (invoice_number, seller_vat, date)) WITHOUT ROWID""")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def lookup_many(self, keys) -> dict:
+        """回傳 {鍵: 索引資料}，只包含已存在的鍵"""
+        keys = list(dict.fromkeys(keys)); found = {}
+        try:
+            with self._connect() as conn:
+                for start in range(0, len(keys), INVOICE_INDEX_LOOKUP_CHUNK):
+                    chunk = keys[start:start + INVOICE_INDEX_LOOKUP_CHUNK]
+                    rows = conn.execute(
+                        "SELECT invoice_number, seller_vat, date, seller_name, seller_address, buyer_vat, buyer_name, buyer_address, "
+                        "source_file, batch_id, first_seen FROM invoice_index WHERE (invoice_number, seller_vat, date) IN "
+                        f"(VALUES {', '.join(['(?, ?, ?)'] * len(chunk))})", [part for key in chunk for part in key]).fetchall()
+                    for row in rows:
+                        found[row[:3]] = {"seller_name": row[3], "seller_address": row[4], "buyer_vat": row[5], "buyer_name": row[6],
+                                          "buyer_address": row[7], "source_file": row[8], "batch_id": row[9], "first_seen": row[10]}
+        except sqlite3.Error as e:
+            print(f"[Invoice Index Warning] 讀取發票索引失敗: {e}")
+        return found
+
+    def record(self, receipts: list, batch_id: str = None):
+        """寫入已匯出的發票 (已存在的鍵保留第一次匯出的紀錄)"""
+        now = time.time(); rows = []
+        for receipt in receipts:
+            key = invoice_key(receipt)
+            if key is None: continue
+            rows.append((*key, str(receipt.get("賣方名稱", "")), str(receipt.get("賣方營業地址", "")), str(receipt.get("買方統一編號", "")),
+                         str(receipt.get("買方名稱", "")), str(receipt.get("買方營業地址", "")), int_or_zero(receipt.get("金額總計")),
+                         str(receipt.get("來源檔案", "")), batch_id, now))
+        if not rows: return
+        try:
+            with self._connect() as conn:
+                conn.executemany("INSERT OR IGNORE INTO invoice_index VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            print(f"[Invoice Index Warning] 寫入發票索引失敗: {e}")
+
+    def forget(self, batch_id: str) -> int:
+        """移除某次匯出 (結果集) 記錄的發票，回傳移除筆數"""
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM invoice_index WHERE batch_id = ?", (batch_id,)).rowcount
+
+invoice_index = InvoiceIndex(os.path.join(CACHE_FOLDER, 'invoice_index.db'))
+
+def is_exported_elsewhere(entry: dict, batch_id: str = None) -> bool:
+    """索引中的發票是否由其他批次匯出 (同一批次重新匯出不算重複；兩邊都沒有批次時也不算)"""
+    return entry["batch_id"] != batch_id
+
+def apply_invoice_index(receipts: list, batch_id: str = None) -> list:
+    """整批查詢發票索引：已匯出過的發票沿用索引中的公司資料，由其他結果集匯出者標記為重複；
+    同一批內重複出現的發票也標記。回傳仍需查詢公司資料的發票"""
+    keys = [invoice_key(receipt) for receipt in receipts]
+    known = invoice_index.lookup_many(key for key in keys if key is not None)
+    fresh = []; seen = {}
+    for receipt, key in zip(receipts, keys):
+        entry = known.get(key) if key is not None else None
+        if entry is not None:
+            if is_exported_elsewhere(entry, batch_id):
+                exported_at = datetime.fromtimestamp(entry["first_seen"]).strftime('%Y-%m-%d %H:%M')
+                receipt[INVOICE_DUPLICATE_FIELD] = f"已於 {exported_at} 匯出 ({entry['source_file']})"
+            receipt["賣方名稱"] = entry["seller_name"]; receipt["賣方營業地址"] = entry["seller_address"]
+            if entry["buyer_vat"] == str(receipt["買方統一編號"]):
+                receipt["買方名稱"] = entry["buyer_name"]; receipt["買方營業地址"] = entry["buyer_address"]; continue
+        elif key is not None:
+            if key in seen: receipt[INVOICE_DUPLICATE_FIELD] = f"{seen[key]} (同批)"
+            else: seen[key] = receipt["來源檔案"]
+        fresh.append(receipt)
+    if known: print(f"發票索引: {sum(1 for r in receipts if r.get(INVOICE_DUPLICATE_FIELD))} 張重複發票")
+    return fresh
+
+def exclude_duplicate_invoices(results: list, batch_id: str = None) -> list:
+    """匯出前排除已由其他結果集匯出的發票 (以匯出當下的索引為準，已從索引移除的批次不再排除)，
+    以及同一份匯出資料中相同鍵的後續資料；batch_id 為本次匯出的結果集"""
+    keys = [invoice_key(result) for result in results]
+    exported = invoice_index.lookup_many(key for key in keys if key is not None)
+    kept = []; seen = set()
+    for result, key in zip(results, keys):
+        if key is not None:
+            entry = exported.get(key)
+            if key in seen or (entry is not None and is_exported_elsewhere(entry, batch_id)): continue
+            seen.add(key)
+        kept.append(result)
+    if len(kept) < len(results): print(f"匯出時排除 {len(results) - len(kept)} 筆重複發票")
+    return kept
+
+# --- 辨識結果集 (SQLite) ---
+class ResultStore:
+    """以 SQLite 保存的辨識結果集：匯出時以 result_set_id 取回，不必由前端重新上傳整批結果。
+    已完成的結果集另外保留在程序內 LRU (已解析好的 list)，同一批多次匯出不必重新解析"""
+
+    def __init__(self, db_path: str, ttl: int, lru_size: int):
+        self.db_path = db_path; self.ttl = ttl; self.lru_size = lru_size
+        self._lru = OrderedDict()  # set_id -> (results, expires_at)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS result_sets (
+                    id TEXT PRIMARY KEY, complete INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL, expires_at REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS idx_result_sets_expires ON result_sets (expires_at);
+                CREATE TABLE IF NOT EXISTS result_rows (
+                    set_id TEXT NOT NULL, seq INTEGER NOT NULL, result TEXT NOT NULL,
+                    PRIMARY KEY (set_id, seq));
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def create(self, results: list = None, set_id: str = None) -> str:
+        """建立結果集 (同 ID 已存在時清空重建)；有 results 時直接寫入並標記為完成"""
+        set_id = set_id or uuid.uuid4().hex; now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # 順便清掉過期的結果集
+            expired = [row[0] for row in conn.execute("SELECT id FROM result_sets WHERE expires_at <= ?", (now,))]
+            conn.executemany("DELETE FROM result_rows WHERE set_id = ?", [(i,) for i in expired + [set_id]])
+            conn.executemany("DELETE FROM result_sets WHERE id = ?", [(i,) for i in expired + [set_id]])
+            conn.execute("INSERT INTO result_sets (id, complete, created_at, expires_at) VALUES (?, 0, ?, ?)", (set_id, now, now + self.ttl))
+            conn.execute("COMMIT")
+        with self._lock: self._lru.pop(set_id, None)
+        if results is not None:
+            self.append(set_id, results); self.finish(set_id)
+        return set_id
+
+    def append(self, set_id: str, results: list):
+        if not results: return
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            start = conn.execute("SELECT COUNT(*) FROM result_rows WHERE set_id = ?", (set_id,)).fetchone()[0]
+            conn.executemany("INSERT INTO result_rows (set_id, seq, result) VALUES (?, ?, ?)",
+                             [(set_id, start + i, json.dumps(r, ensure_ascii=False)) for i, r in enumerate(results)])
+            conn.execute("COMMIT")
+
+    def finish(self, set_id: str):
+        with self._connect() as conn:
+            conn.execute("UPDATE result_sets SET complete = 1 WHERE id = ?", (set_id,))
+
+    def get(self, set_id: str):
+        """回傳未過期結果集的結果串列 (尚未完成時為目前已有的部分)；找不到時回傳 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(set_id)
+            if entry is not None:
+                if entry[1] > now:
+                    self._lru.move_to_end(set_id)
+                    return entry[0]
+                del self._lru[set_id]
+        with self._connect() as conn:
+            row = conn.execute("SELECT complete, expires_at FROM result_sets WHERE id = ?", (set_id,)).fetchone()
+            if row is None or row[1] <= now: return None
+            results = [json.loads(r[0]) for r in conn.execute("SELECT result FROM result_rows WHERE set_id = ? ORDER BY seq", (set_id,))]
+        if row[0]:
+            with self._lock:
+                self._lru[set_id] = (results, row[1]); self._lru.move_to_end(set_id)
+                while len(self._lru) > self.lru_size: self._lru.popitem(last=False)
+        return results
+
+result_store = ResultStore(os.path.join(CACHE_FOLDER, 'results.db'), RESULT_SET_TTL, RESULT_STORE_LRU_SIZE)
+
+def apply_result_edits(results: list, edits=None, deleted=None, added=None) -> list:
+    """在結果集上套用前端的修改 (不改動原本的結果集)：
+    edits 為 {列索引: {欄位: 新值}}，deleted 為要刪除的列索引，added 為要附加的新列"""
+    edits = {int(index): changes for index, changes in (edits or {}).items()}
+    deleted = {int(index) for index in (deleted or [])}
+    for index in list(edits) + list(deleted):
+        if not 0 <= index < len(results): raise ValueError(f"列索引超出範圍: {index}")
+    if not edits and not deleted and not added: return results
+    edited = [{**row, **edits[i]} if i in edits else row for i, row in enumerate(results) if i not in deleted]
+    return edited + list(added or [])
+
+# --- 背景工作佇列 (SQLite) ---
+# 大批檔案改為送出工作後立即回傳 job_id，由獨立的工作程序 (非 Flask 請求執行緒) 執行，
+# 前端再以 /jobs/<job_id> 輪詢進度與已完成的部分結果。多個程序 / 執行個體可共用同一個佇列檔案。
+class JobClaimLostError(Exception):
+    """工作已逾時被其他工作程序接手 (claim_token 不符)；原本的工作程序應停止執行，不再寫入結果"""
+
+class JobQueue:
+    """以 SQLite 保存的工作佇列：jobs 記錄狀態，job_files 保存上傳檔案，job_results 逐筆保存結果，
+    job_done_files 記錄已完成的檔案序號。每次取出工作都會產生新的 claim_token，寫入進度時必須帶上，
+    逾時被接手後原工作程序的寫入一律被拒絕；同一檔案重複寫入時忽略，不會重複結果或多算進度"""
+
+    def __init__(self, db_path: str, stale_seconds: int):
+        self.db_path = db_path; self.stale_seconds = stale_seconds
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, payload TEXT NOT NULL,
+                    total INTEGER NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0, error TEXT,
+                    worker TEXT, heartbeat REAL, created_at REAL NOT NULL, updated_at REAL NOT NULL, claim_token TEXT);
+                CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id TEXT NOT NULL, seq INTEGER NOT NULL, filename TEXT NOT NULL, data BLOB NOT NULL,
+                    PRIMARY KEY (job_id, seq));
+                CREATE TABLE IF NOT EXISTS job_results (
+                    job_id TEXT NOT NULL, seq INTEGER NOT NULL, result TEXT NOT NULL,
+                    PRIMARY KEY (job_id, seq));
+                CREATE TABLE IF NOT EXISTS job_done_files (
+                    job_id TEXT NOT NULL, file_index INTEGER NOT NULL,
+                    PRIMARY KEY (job_id, file_index));
+            """)
+            # 舊版資料庫沒有 claim_token 欄位
+            if "claim_token" not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN claim_token TEXT")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def submit(self, kind: str, payload: dict, files=None) -> str:
+        """建立工作；files 為 (檔名, bytes) 串列 (僅本機上傳需要)"""
+        job_id = uuid.uuid4().hex; now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO jobs (id, kind, status, payload, total, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                         (job_id, kind, json.dumps(payload, ensure_ascii=False), len(files or []), now, now))
+            conn.executemany("INSERT INTO job_files (job_id, seq, filename, data) VALUES (?, ?, ?, ?)",
+                             [(job_id, seq, filename, data) for seq, (filename, data) in enumerate(files or [])])
+            conn.execute("COMMIT")
+        return job_id
+
+    def claim(self, worker_id: str):
+        """取出最早的待處理工作 (或已逾時中斷的工作) 並標記為執行中，回傳含 claim_token 的工作；沒有工作時回傳 None"""
+        now = time.time(); token = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("""SELECT id, kind, payload FROM jobs
+                                  WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?)
+                                  ORDER BY created_at LIMIT 1""", (now - self.stale_seconds,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT"); return None
+            # 接手中斷的工作時從頭重跑 (已辨識過的頁面會命中辨識快取)
+            conn.execute("DELETE FROM job_results WHERE job_id = ?", (row[0],))
+            conn.execute("DELETE FROM job_done_files WHERE job_id = ?", (row[0],))
+            conn.execute("UPDATE jobs SET status = 'running', done = 0, worker = ?, claim_token = ?, heartbeat = ?, updated_at = ? WHERE id = ?",
+                         (worker_id, token, now, now, row[0]))
+            conn.execute("COMMIT")
+        return {"id": row[0], "kind": row[1], "payload": json.loads(row[2]), "token": token}
+
+    def load_files(self, job_id: str) -> list:
+        with self._connect() as conn:
+            return conn.execute("SELECT filename, data FROM job_files WHERE job_id = ? ORDER BY seq", (job_id,)).fetchall()
+
+    def heartbeat(self, job_id: str, token: str) -> bool:
+        """更新 heartbeat；工作已被其他程序接手時回傳 False"""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET heartbeat = ?, updated_at = ? WHERE id = ? AND claim_token = ? AND status = 'running'",
+                                  (now, now, job_id, token))
+            return cursor.rowcount == 1
+
+    def _check_claim(self, conn, job_id: str, token: str):
+        row = conn.execute("SELECT claim_token, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row[0] != token or row[1] != 'running':
+            conn.execute("ROLLBACK")
+            raise JobClaimLostError(f"工作 {job_id} 已由其他工作程序接手")
+
+    def set_total(self, job_id: str, token: str, total: int):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE"); self._check_claim(conn, job_id, token)
+            conn.execute("UPDATE jobs SET total = ?, heartbeat = ?, updated_at = ? WHERE id = ?", (total, now, now, job_id))
+            conn.execute("COMMIT")
+
+    def append_results(self, job_id: str, token: str, file_index: int, results: list) -> bool:
+        """寫入第 file_index 個檔案的結果並推進進度 (同時更新 heartbeat)；該檔案已寫入過時不做任何事並回傳 False"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE"); self._check_claim(conn, job_id, token)
+            if conn.execute("INSERT OR IGNORE INTO job_done_files (job_id, file_index) VALUES (?, ?)", (job_id, file_index)).rowcount == 0:
+                conn.execute("COMMIT"); return False
+            start = conn.execute("SELECT COUNT(*) FROM job_results WHERE job_id = ?", (job_id,)).fetchone()[0]
+            conn.executemany("INSERT INTO job_results (job_id, seq, result) VALUES (?, ?, ?)",
+                             [(job_id, start + i, json.dumps(r, ensure_ascii=False)) for i, r in enumerate(results)])
+            conn.execute("""UPDATE jobs SET done = (SELECT COUNT(*) FROM job_done_files WHERE job_id = ?), heartbeat = ?, updated_at = ?
+                            WHERE id = ?""", (job_id, now, now, job_id))
+            conn.execute("COMMIT")
+        return True
+
+    def finish(self, job_id: str, token: str, error: str = None):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE"); self._check_claim(conn, job_id, token)
+            conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                         ("failed" if error else "done", error, time.time(), job_id))
+            conn.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+            conn.execute("COMMIT")
+
+    def get(self, job_id: str, since: int = 0):
+        """回傳工作狀態與第 since 筆之後的結果；找不到時回傳 None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT status, total, done, error, created_at, updated_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None: return None
+            results = conn.execute("SELECT result FROM job_results WHERE job_id = ? AND seq >= ? ORDER BY seq", (job_id, since)).fetchall()
+        return {
+            "job_id": job_id, "status": row[0], "total": row[1], "done": row[2], "error": row[3],
+            "created_at": row[4], "updated_at": row[5], "since": since, "results": [json.loads(r[0]) for r in results],
         }
-        final_receipts.append(receipt)
-    return final_receipts
+
+job_queue = JobQueue(os.path.join(CACHE_FOLDER, 'jobs.db'), JOB_STALE_SECONDS)
+
+def start_job_heartbeat(job_id: str, token: str, interval: float = JOB_HEARTBEAT_INTERVAL) -> tuple:
+    """背景執行緒定期更新 heartbeat (長時間送出 / 辨識大檔案時也不會被誤判為中斷)；
+    回傳 (stop, lost) 兩個 Event：設定 stop 結束更新，工作被其他程序接手時 lost 會被設定"""
+    stop = threading.Event(); lost = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                if not job_queue.heartbeat(job_id, token): lost.set(); return
+            except sqlite3.Error as e: print(f"更新工作 {job_id} 的 heartbeat 失敗: {e}")
+
+    threading.Thread(target=beat, name="job-heartbeat", daemon=True).start()
+    return stop, lost
+
+def execute_job(job: dict):
+    """在工作程序中執行一個工作；背景送出 OCR 的同時依檔案順序整理結果，每完成一個檔案就寫入結果，供前端輪詢部分結果"""
+    job_id = job["id"]; payload = job["payload"]; token = job["token"]
+    stop, lost = start_job_heartbeat(job_id, token)
+    try:
+        if job["kind"] == "upload":
+            entries = [SpooledUpload.from_bytes(filename, data) for filename, data in job_queue.load_files(job_id)]
+            skip_unsupported = False
+        elif job["kind"] == "drive":
+            service = get_drive_service()
+            if not service: raise Exception("無法連接 Google Drive")
+            items = payload.get("selected_files") or list_drive_folder_files(service, payload["folder_id"])
+            entries = iter_drive_downloads(items)
+            skip_unsupported = True
+        else:
+            raise Exception(f"未知的工作類型: {job['kind']}")
+        # 送出前就先寫入總檔案數，略過的檔案最後再扣除
+        total = len(items) if job["kind"] == "drive" else len(entries)
+        job_queue.set_total(job_id, token, total)
+
+        result_set_id = result_store.create(set_id=payload.get("result_set_id"))
+        done = 0; file_index = 0
+        for group in iter_finished_ocr(entries, skip_unsupported=skip_unsupported,
+                                       batch_images=payload.get("gemini_batch", GEMINI_BATCH_MAX_IMAGES)):
+            if lost.is_set(): raise JobClaimLostError(f"工作 {job_id} 已由其他工作程序接手")
+            indexed = [(file_index + i, item) for i, item in enumerate(group) if item[1] is not None or item[2] is not None]
+            file_index += len(group)
+            for (index, _), file_results in zip(indexed, finalize_ocr_files([item for _, item in indexed], result_set_id)):
+                if job_queue.append_results(job_id, token, index, file_results): result_store.append(result_set_id, file_results)
+                done += 1
+        if done != total: job_queue.set_total(job_id, token, done)
+        result_store.finish(result_set_id)
+    finally:
+        stop.set()
+
+def run_job_worker(poll_interval: float = JOB_POLL_INTERVAL):
+    """工作程序主迴圈：持續從佇列取出工作執行"""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"背景工作程序啟動: {worker_id}")
+    # 背景工作的 Gemini 請求優先順序最低；配額只用背景工作的份額，由各工作程序平分 (網站程序使用其餘部分)
+    _gemini_priority.set(GEMINI_PRIORITY_BULK)
+    share = GEMINI_JOB_BUDGET_SHARE / max(JOB_WORKER_PROCESSES, 1)
+    gemini_scheduler.configure(gemini_budget(GEMINI_MAX_RPM, share), gemini_budget(GEMINI_MAX_TPM, share))
+    while True:
+        job = job_queue.claim(worker_id)
+        if job is None:
+            time.sleep(poll_interval); continue
+        print(f"開始執行工作 {job['id']} ({job['kind']})")
+        try:
+            execute_job(job)
+            job_queue.finish(job["id"], job["token"])
+            print(f"工作 {job['id']} 完成")
+        except JobClaimLostError as e:
+            print(f"停止執行: {e}")
+        except Exception as e:
+            traceback.print_exc()
+            try: job_queue.finish(job["id"], job["token"], error=str(e))
+            except JobClaimLostError as lost: print(f"停止執行: {lost}")
+
+_job_workers = []
+_job_workers_lock = threading.Lock()
+
+def ensure_job_workers():
+    """第一次送出工作時，啟動 JOB_WORKER_PROCESSES 個獨立的工作程序 (不佔用 Flask 請求執行緒)"""
+    with _job_workers_lock:
+        _job_workers[:] = [p for p in _job_workers if p.is_alive()]
+        ctx = multiprocessing.get_context("spawn")
+        while len(_job_workers) < JOB_WORKER_PROCESSES:
+            process = ctx.Process(target=run_job_worker, name="ocr-job-worker", daemon=True)
+            process.start(); _job_workers.append(process)
+
+# --- 報表匯出 (GV) ---
+# GV 表頭欄位
+GV_HEADER_ROW = [
+    "序號", "公司別", "發票號碼", "稅籍編號", "統一編號", "記帳點",
+    "發票/憑證類別", "格式代號", "單據憑證日期",
+    "傳票日期", "申報年月", "銷售人統一編號", "銷售人名稱", "課稅別", "進貨折讓區分",
+    "未稅金額", "進項稅額", "金額總計", "進項稅性質別", "扣抵代號",
+    "彙總張數", "彙加註記", "應付立帳號碼", "備註"
+]
+# 序號、格式代號固定靠左
+GV_LEFT_ALIGNED_COLUMNS = (0, 7)
+
+def convert_format_code_to_type(code): return "Q" if str(code) == "22" else "I"
+
+@functools.lru_cache(maxsize=None)
+def cell_style(align: str, font_height: int) -> xlwt.XFStyle:
+    """微軟正黑體、垂直置中的儲存格樣式 (align: left / center / right，font_height 單位為 1/20 pt)；
+    每種組合只建立一次，所有活頁簿共用"""
+    font_content = xlwt.Font()
+    font_content.name = 'Microsoft JhengHei'
+    font_content.height = font_height
+    style = xlwt.XFStyle()
+    alignment = xlwt.Alignment()
+    alignment.horz = {"left": xlwt.Alignment.HORZ_LEFT, "center": xlwt.Alignment.HORZ_CENTER, "right": xlwt.Alignment.HORZ_RIGHT}[align]
+    alignment.vert = xlwt.Alignment.VERT_CENTER
+    style.alignment = alignment
+    style.font = font_content
+    return style
+
+GV_FONT_HEIGHT = 280  # 14pt (20 * 14)
+
+def text_display_width(value) -> int:
+    """估算欄寬用的顯示長度 (中文字算2)"""
+    if value is None: return 0
+    text = value if isinstance(value, str) else str(value)
+    if text.isascii(): return len(text)
+    return len(text) + sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
+
+def gv_row_values(index: int, row_data: dict, account_payable_code) -> list:
+    """將一筆辨識結果轉成 GV 欄位值 (順序同 GV_HEADER_ROW)"""
+    transaction_date = row_data.get("交易日期", "")
+    formatted_date_for_I_str = transaction_date.replace("-", "") if transaction_date else ""
+
+    format_code = row_data.get("格式", 25)
+    try: format_code_int = int(format_code)
+    except (ValueError, TypeError): format_code_int = 25
+
+    try: tax_exclusive = int(row_data.get("未稅金額", 0))
+    except (ValueError, TypeError): tax_exclusive = 0
+    try: tax = int(row_data.get("進項稅額", 0))
+    except (ValueError, TypeError): tax = 0
+    try: total = int(row_data.get("金額總計", 0))
+    except (ValueError, TypeError): total = 0
+
+    return [
+        str(index + 1),                                   # 序號
+        "HD",                                             # 公司別
+        str(row_data.get("統一發票號碼", "")),              # 發票號碼
+        "721401318",                                      # 稅籍編號
+        "03251000",                                       # 統一編號
+        1,                                                # 記帳點
+        convert_format_code_to_type(format_code_int),     # 發票/憑證類別
+        str(format_code_int),                             # 格式代號
+        formatted_date_for_I_str or None,                 # 單據憑證日期
+        None,                                             # 傳票日期
+        None,                                             # 申報年月
+        str(row_data.get("賣方統一編號", "")),              # 銷售人統一編號
+        str(row_data.get("賣方名稱", "")),                  # 銷售人名稱
+        "1",                                              # 課稅別
+        None,                                             # 進貨折讓區分
+        tax_exclusive if tax_exclusive != 0 else None,    # 未稅金額
+        tax if tax != 0 else None,                        # 進項稅額
+        total if total != 0 else None,                    # 金額總計
+        "126200",                                         # 進項稅性質別
+        1,                                                # 扣抵代號
+        0,                                                # 彙總張數
+        "N",                                              # 彙加註記
+        str(account_payable_code) if account_payable_code else None,  # 應付立帳號碼
+        None,                                             # 備註
+    ]
+
+def iter_gv_rows(results: list, account_payable_code):
+    for index, row_data in enumerate(results): yield gv_row_values(index, row_data, account_payable_code)
+
+class XlsSheetWriter:
+    """逐列寫入 xlwt 工作表，寫入時同步累計每欄最大顯示長度，結束時一次設定欄寬"""
+
+    def __init__(self, wb: xlwt.Workbook, sheet_name: str, header: list):
+        self.ws = wb.add_sheet(sheet_name)
+        self.widths = [0] * len(header)
+        self.rows = 0
+        self.style_center = cell_style("center", GV_FONT_HEIGHT)  # 標題
+        self.style_left = cell_style("left", GV_FONT_HEIGHT)      # 文字
+        self.style_right = cell_style("right", GV_FONT_HEIGHT)    # 數字
+        self.write_row(header, is_header=True)
+
+    def write_row(self, values: list, is_header: bool = False):
+        ws_row = self.ws.row(self.rows); widths = self.widths
+        for col_idx, cell_value in enumerate(values):
+            if is_header: current_style = self.style_center
+            elif col_idx in GV_LEFT_ALIGNED_COLUMNS: current_style = self.style_left
+            elif isinstance(cell_value, (int, float)): current_style = self.style_right
+            else: current_style = self.style_left
+            ws_row.write(col_idx, cell_value if cell_value is not None else '', current_style)
+            width = text_display_width(cell_value)
+            if width > widths[col_idx]: widths[col_idx] = width
+        self.rows += 1
+        # 已寫完的列交給 xlwt 壓縮保存，降低大量資料時的記憶體
+        if self.rows % 1000 == 0: self.ws.flush_row_data()
+
+    def finish(self):
+        # xlwt 寬度單位是 1/256 個字元寬度 (上限 65535)
+        for col_idx, max_len in enumerate(self.widths): self.ws.col(col_idx).width = min(256 * (max_len + 2), 65535)
+
+def gv_sheet_name(part: int) -> str: return "PURDATA" if part == 1 else f"PURDATA{part}"
+
+def write_gv_sheets(wb: xlwt.Workbook, rows):
+    """寫入 GV 資料，每 GV_ROWS_PER_SHEET 列換一張 PURDATA 工作表"""
+    sheet = None; part = 0
+    for row in rows:
+        if sheet is None or sheet.rows > GV_ROWS_PER_SHEET:
+            if sheet is not None: sheet.finish()
+            part += 1; sheet = XlsSheetWriter(wb, gv_sheet_name(part), GV_HEADER_ROW)
+        sheet.write_row(row)
+    if sheet is None: sheet = XlsSheetWriter(wb, gv_sheet_name(1), GV_HEADER_ROW)
+    sheet.finish()
+
+def build_gv_xls_zip(rows) -> bytes:
+    """超過單張工作表上限時，每 GV_ROWS_PER_SHEET 列存成一個 .xls，打包成 zip"""
+    rows = iter(rows); output_buffer = io.BytesIO(); part = 0
+    with zipfile.ZipFile(output_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        while True:
+            first = next(rows, None)
+            if first is None: break
+            part += 1
+            wb = xlwt.Workbook(encoding='utf-8')
+            write_gv_sheets(wb, itertools.islice(itertools.chain((first,), rows), GV_ROWS_PER_SHEET))
+            with zf.open(f"GV_output_{part}.xls", 'w') as f: wb.save(f)
+    return output_buffer.getvalue()
+
+def iter_csv_chunks(header: list, rows):
+    """CSV 串流輸出 (UTF-8 BOM，Excel 開啟不會亂碼)，每 EXPORT_CHUNK_ROWS 列送出一次"""
+    buffer = io.StringIO(); writer = csv.writer(buffer)
+    buffer.write('\ufeff'); writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(['' if v is None else v for v in row])
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8'); buffer.seek(0); buffer.truncate()
+    if buffer.tell(): yield buffer.getvalue().encode('utf-8')
+
+# xlsx 串流輸出: 直接以 zipfile 逐段寫出 Office Open XML (inline string)，不需整份活頁簿放在記憶體
+XLSX_MAX_ROWS = 1048576
+XLSX_ILLEGAL_CHARS = dict.fromkeys(c for c in range(32) if c not in (9, 10, 13))
+XLSX_STATIC_PARTS = {
+    "_rels/.rels": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    "xl/styles.xml": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="1"><font><sz val="12"/><name val="Microsoft JhengHei"/></font></fonts>'
+        '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+        '<borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf/></cellStyleXfs>'
+        '<cellXfs count="1"><xf xfId="0"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>',
+}
+
+class _ChunkSink:
+    """zipfile 的輸出目標：只收集寫入的位元組，由產生器取走後送出 (不可 seek，zipfile 會改用 data descriptor)"""
+
+    def __init__(self): self.chunks = []
+    def write(self, data): self.chunks.append(bytes(data)); return len(data)
+    def flush(self): pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks); self.chunks = []
+        return data
+
+def xlsx_cell(ref: str, value) -> str:
+    if value is None or value == '': return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool): return f'<c r="{ref}"><v>{value}</v></c>'
+    text = escape(str(value).translate(XLSX_ILLEGAL_CHARS))
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def iter_xlsx_chunks(sheet_name: str, header: list, rows):
+    """xlsx 串流輸出，每 EXPORT_CHUNK_ROWS 列送出一次；超過 xlsx 列數上限時換到下一張工作表 (PURDATA2 ...)"""
+    letters = [get_excel_column_letter(i) for i in range(len(header))]
+    # 串流寫出時無法回頭調整欄寬，以表頭長度估算
+    cols_xml = "".join(f'<col min="{i}" max="{i}" width="{text_display_width(name) + 4}" customWidth="1"/>' for i, name in enumerate(header, 1))
+    sink = _ChunkSink(); sheet_names = []
+    rows = iter(rows)
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        while True:
+            first = next(rows, None)
+            if first is None and sheet_names: break
+            sheet_names.append(sheet_name if not sheet_names else f"{sheet_name}{len(sheet_names) + 1}")
+            with zf.open(f"xl/worksheets/sheet{len(sheet_names)}.xml", 'w') as f:
+                f.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                         f'<cols>{cols_xml}</cols><sheetData>').encode('utf-8'))
+                sheet_rows = itertools.chain((header,), (first,) if first is not None else (), itertools.islice(rows, XLSX_MAX_ROWS - 2))
+                parts = []
+                for row_idx, row in enumerate(sheet_rows, 1):
+                    parts.append(f'<row r="{row_idx}">' + "".join(xlsx_cell(f"{letters[c]}{row_idx}", v) for c, v in enumerate(row)) + '</row>')
+                    if row_idx % EXPORT_CHUNK_ROWS == 0:
+                        f.write("".join(parts).encode('utf-8')); parts = []
+                        yield sink.drain()
+                f.write(("".join(parts) + '</sheetData></worksheet>').encode('utf-8'))
+            yield sink.drain()
+            if first is None: break
+
+        sheets_xml = "".join(f'<sheet name="{escape(name)}" sheetId="{i}" r:id="rId{i}"/>' for i, name in enumerate(sheet_names, 1))
+        rels_xml = "".join(f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{i}.xml"/>' for i in range(1, len(sheet_names) + 1))
+        overrides_xml = "".join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' for i in range(1, len(sheet_names) + 1))
+        zf.writestr("[Content_Types].xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            f'{overrides_xml}</Types>')
+        zf.writestr("xl/workbook.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets>{sheets_xml}</sheets></workbook>')
+        zf.writestr("xl/_rels/workbook.xml.rels", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'{rels_xml}<Relationship Id="rId{len(sheet_names) + 1}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+            '</Relationships>')
+        for name, content in XLSX_STATIC_PARTS.items(): zf.writestr(name, content)
+    yield sink.drain()
+
+def get_excel_column_letter(col_idx: int) -> str:
+    """0 起算的欄位索引轉成 Excel 欄名 (0 -> A, 26 -> AA)"""
+    letters = ""; col_idx += 1
+    while col_idx: col_idx, remainder = divmod(col_idx - 1, 26); letters = chr(65 + remainder) + letters
+    return letters
+
+# --- 報表匯出 (費用報支，含彙加邏輯) ---
+EXPENSE_HEADERS = [
+    "公司別", "憑證類別", "格式代號", "發票號碼", "記帳點",
+    "統一編號", "單據憑證日期", "銷售人統一編號", "銷售人名稱",
+    "未稅金額", "進項稅金額", "金額總計", "彙加註記", "彙總張數", "進項稅性質別"
+]
+EXPENSE_NUMERIC_COLUMNS = frozenset(EXPENSE_HEADERS.index(h) for h in ("未稅金額", "進項稅金額", "金額總計", "彙總張數"))
+EXPENSE_FONT_HEIGHT = 240  # 12pt (20 * 12)
+# 進項稅額低於此金額的同格式發票彙加成一筆；彙加後 21 -> 26、22 -> 27
+EXPENSE_SMALL_TAX_THRESHOLD = 500
+EXPENSE_AGGREGATED_FORMAT = {21: 26, 22: 27}
+
+def int_or_zero(value) -> int:
+    try: return int(value)
+    except (ValueError, TypeError): return 0
+
+def parse_format_code(value) -> int:
+    try: return int(str(value))
+    except ValueError: return 25
+
+def aggregate_expense_rows(results: list) -> list:
+    """依格式代碼分組 (依首次出現順序)；每組進項稅額 >= 500 的發票逐筆列出，
+    < 500 的彙加成一筆：以 (稅額, 未稅金額, 發票號碼) 最大者為代表 (同值取先出現者)，金額欄位改為加總。
+    每個欄位只解析一次，分組、排序、加總以 pandas 欄位運算完成"""
+    n = len(results)
+    df = pd.DataFrame({
+        "fmt": np.fromiter((parse_format_code(r.get("格式", 25)) for r in results), dtype=np.int64, count=n),
+        "untaxed": np.fromiter((int_or_zero(r.get("未稅金額", 0)) for r in results), dtype=np.int64, count=n),
+        "tax": np.fromiter((int_or_zero(r.get("進項稅額", 0)) for r in results), dtype=np.int64, count=n),
+        "total": np.fromiter((int_or_zero(r.get("金額總計", 0)) for r in results), dtype=np.int64, count=n),
+        "invoice": ["" if r.get("統一發票號碼") is None else str(r.get("統一發票號碼")) for r in results],
+        "pos": np.arange(n),
+    })
+    df["group"] = pd.factorize(df["fmt"])[0]
+    is_small = df["tax"].to_numpy() < EXPENSE_SMALL_TAX_THRESHOLD
+    large = df[~is_small]
+    small = df[is_small]
+
+    # 代表筆: 各組依 稅額、未稅金額、發票號碼 由大到小，同值時保留原順序
+    ranked = small.sort_values(["group", "tax", "untaxed", "invoice", "pos"], ascending=[True, False, False, False, True], kind="stable")
+    representatives = ranked.drop_duplicates("group")[["group", "pos", "fmt"]].set_index("group")
+    sums = small.groupby("group")[["untaxed", "tax", "total"]].sum()
+    representatives = representatives.join(sums).assign(count=small.groupby("group").size())
+
+    # 輸出順序: 依組別，每組先列大額發票 (原順序) 再列彙加代表筆
+    order = np.lexsort((
+        np.concatenate([large["pos"].to_numpy(), np.zeros(len(representatives), dtype=np.int64)]),
+        np.concatenate([np.zeros(len(large), dtype=np.int64), np.ones(len(representatives), dtype=np.int64)]),
+        np.concatenate([large["group"].to_numpy(), representatives.index.to_numpy()]),
+    ))
+    output_rows = [{**results[pos], "_is_aggregated": "N", "_agg_count": 0, "_final_fmt": fmt} for pos, fmt in zip(large["pos"].tolist(), large["fmt"].tolist())]
+    for pos, fmt, untaxed, tax, total, count in representatives[["pos", "fmt", "untaxed", "tax", "total", "count"]].itertuples(index=False, name=None):
+        output_rows.append({**results[pos], "未稅金額": int(untaxed), "進項稅額": int(tax), "金額總計": int(total),
+                            "_is_aggregated": "Y", "_agg_count": int(count), "_final_fmt": EXPENSE_AGGREGATED_FORMAT.get(fmt, fmt)})
+    return [output_rows[i] for i in order]
+
+def expense_row_values(item: dict) -> list:
+    """彙加後的一筆資料轉成費用報支欄位值 (順序同 EXPENSE_HEADERS)"""
+    transaction_date = item.get("交易日期", "")
+    formatted_date = transaction_date.replace("-", "") if transaction_date else ""
+    final_fmt = item.get('_final_fmt', 25)
+    return [
+        "HD",
+        convert_format_code_to_type(final_fmt),
+        final_fmt,
+        item.get("統一發票號碼", ""),
+        1,
+        "03251000",
+        formatted_date,
+        item.get("賣方統一編號", ""),
+        item.get("賣方名稱", ""),
+        item.get("未稅金額", 0),
+        item.get("進項稅額", 0),
+        item.get("金額總計", 0),
+        item.get("_is_aggregated", "N"),
+        item.get("_agg_count", 0),
+        "126200"
+    ]
+
+def build_expense_xls(processed_rows: list) -> bytes:
+    """將彙加後的資料寫成費用報支 .xls"""
+    wb = xlwt.Workbook(encoding='utf-8')
+    ws = wb.add_sheet("ExpenseReport")
+    style_left = cell_style("left", EXPENSE_FONT_HEIGHT); style_right = cell_style("right", EXPENSE_FONT_HEIGHT)
+
+    # 寫入表頭
+    for col_idx, h in enumerate(EXPENSE_HEADERS):
+        ws.write(0, col_idx, h, style_left)
+
+    # 寫入資料
+    for row_idx, item in enumerate(processed_rows, 1):
+        ws_row = ws.row(row_idx)
+        for col_idx, val in enumerate(expense_row_values(item)):
+            if col_idx in EXPENSE_NUMERIC_COLUMNS:
+                try: val = int(val)
+                except (ValueError, TypeError): pass
+                ws_row.write(col_idx, val, style_right)
+            else:
+                ws_row.write(col_idx, str(val), style_left) # 強制轉字串
+        if row_idx % 1000 == 0: ws.flush_row_data()
+
+    # 直接設定一個比較寬的預設值，xlwt 的自動調整比較麻煩
+    for col_idx in range(len(EXPENSE_HEADERS)): ws.col(col_idx).width = 256 * 15 # 預設寬度
+
+    output_buffer = io.BytesIO()
+    wb.save(output_buffer)
+    return output_buffer.getvalue()
+
+# --- 啟動預熱 ---
+def warm_up(delay: float = STARTUP_WARMUP_DELAY):
+    """在背景載入延遲載入的套件並建立 Gemini 模型物件，讓第一個辨識請求不必等待 import"""
+    time.sleep(delay)
+    start = time.perf_counter()
+    for module in LAZY_MODULES:
+        try: module.load()
+        except ImportError as e: print(f"[Warmup Warning] 無法載入 {module._name}: {e}")
+    if GEMINI_API_KEY:
+        try: get_gemini_model()
+        except Exception as e: print(f"[Warmup Warning] 建立 Gemini 模型失敗: {e}")
+    print(f"背景預熱完成，耗時 {time.perf_counter() - start:.2f} 秒")
+
+def start_background_warmup():
+    # 只在主程序預熱；轉圖子程序與背景工作程序也會 import 本檔，不需要
+    if STARTUP_WARMUP and multiprocessing.current_process().name == "MainProcess":
+        threading.Thread(target=warm_up, name="warmup", daemon=True).start()
 
 # --- Routes ---
+@app.before_request
+def start_request_timing():
+    """?timing=1 (或 JSON 的 timing: true) 時收集本次請求的各階段耗時"""
+    g.request_started = time.perf_counter()
+    # 請求執行緒會被重複使用，每次請求都從即時辨識的優先順序開始
+    _gemini_priority.set(GEMINI_PRIORITY_INTERACTIVE)
+    wanted = request.args.get('timing') in ('1', 'true') or (request.get_json(silent=True) or {}).get('timing') is True
+    _request_timing.set(RequestTiming() if wanted else None)
+
+@app.after_request
+def record_request_metrics(response):
+    # 串流回應在此時只送出標頭，耗時只計到開始串流為止
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.inc("invoice_http_requests_total", route=route, status=response.status_code)
+    metrics.observe("invoice_http_request_duration_seconds", time.perf_counter() - g.get("request_started", time.perf_counter()), route=route)
+    timing = _request_timing.get()
+    if timing is not None and timing.stages: response.headers["Server-Timing"] = timing.server_timing_header()
+    if g.get("excluded_duplicates"): response.headers["X-Excluded-Duplicates"] = str(g.excluded_duplicates)
+    if g.get("export_batch_id"): response.headers["X-Export-Batch-Id"] = g.export_batch_id
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    ocr_stats = ocr_cache.stats()
+    extra = {("invoice_ocr_cache_requests_total", (("result", "hit"),)): ocr_stats["hits"],
+             ("invoice_ocr_cache_requests_total", (("result", "miss"),)): ocr_stats["misses"]}
+    return Response(metrics.render(extra), mimetype="text/plain; version=0.0.4")
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
@@ -295,10 +2684,7 @@ def list_drive_files():
         if not service: return jsonify({"error": "無法連接 Google Drive"}), 500
 
         print(f"正在讀取雲端資料夾清單 ID: {folder_id} ...")
-        query = f"'{folder_id}' in parents and (mimeType contains 'image/' or mimeType = 'application/pdf') and trashed = false"
-        # 增加 pageSize 讀取更多檔案 (預設100)
-        results = service.files().list(q=query, pageSize=1000, fields="files(id, name, mimeType)").execute()
-        items = results.get('files', [])
+        items = list_drive_folder_files(service, folder_id)
         return jsonify({"files": items})
     except Exception as e:
         traceback.print_exc()
@@ -312,55 +2698,34 @@ def process_drive_folder():
         # 檢查是否有使用者指定的檔案清單
         selected_files = json_data.get('selected_files') # 預期格式: [{'id': '...', 'name': '...'}, ...]
 
-        downloaded_files = []
+        folder_id = json_data.get('folder_id') or os.getenv('GDRIVE_FOLDER_ID')
+        if not selected_files and not folder_id: return jsonify({"error": "未提供 Folder ID 且 .env 中也未設定"}), 400
         service = get_drive_service()
-        
+        if not service: return jsonify({"error": "無法連接 Google Drive"}), 500
+
         if selected_files:
             # === 新流程：只下載指定的檔案 ===
-            if not service: return jsonify({"error": "無法連接 Google Drive"}), 500
             print(f"收到指定處理檔案: {len(selected_files)} 個")
-            for item in selected_files:
-                try:
-                    fname = download_file_by_id(service, item['id'], item['name'])
-                    downloaded_files.append(fname)
-                except Exception as e:
-                    print(f"下載失敗 {item['name']}: {e}")
+            items = selected_files
         else:
             # === 舊流程：下載資料夾全部 (Fallback) ===
-            folder_id = json_data.get('folder_id') or os.getenv('GDRIVE_FOLDER_ID')
-            if not folder_id: return jsonify({"error": "未提供 Folder ID 且 .env 中也未設定"}), 400
-            downloaded_files = download_files_from_drive_folder(folder_id)
+            print(f"正在讀取雲端資料夾 ID: {folder_id} ...")
+            items = list_drive_folder_files(service, folder_id)
 
-        if not downloaded_files:
+        if not items:
             return jsonify({"error": "雲端資料夾為空、下載失敗或未選擇檔案"}), 404
 
-        all_results = []
-        # 處理檔案 (邏輯維持不變)
-        for filename in downloaded_files:
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            try:
-                mime_type = guess_type(filepath)[0]; raw_receipts = []
-                if mime_type in ["image/jpeg", "image/png", "image/webp"]:
-                    with open(filepath, "rb") as f: image_bytes = f.read()
-                    raw_receipts = extract_data_with_gemini_vision(image_bytes, mime_type)
-                elif mime_type == "application/pdf":
-                    doc = fitz.open(filepath)
-                    for page_num, page in enumerate(doc):
-                        print(f"處理 PDF '{filename}' 的第 {page_num + 1} 頁...")
-                        pix = page.get_pixmap(dpi=PDF_CONVERSION_DPI); img_bytes = pix.tobytes("png")
-                        page_receipts = extract_data_with_gemini_vision(img_bytes, "image/png"); raw_receipts.extend(page_receipts)
-                    doc.close()
-                else: 
-                    print(f"略過非支援檔案: {filename}"); continue
-                    
-                finalized_results = enrich_and_finalize_data(raw_receipts, filename); all_results.extend(finalized_results)
-            except Exception as e:
-                print(f"處理檔案 {filename} 時發生錯誤: {e}"); traceback.print_exc()
-                all_results.append({"來源檔案": filename, "統一發票號碼": f"處理失敗: {e}",})
-            finally:
-                if os.path.exists(filepath): os.remove(filepath)
+        # 下載與辨識管線化：每下載完一個檔案就立即送進 OCR，不必等全部下載完
+        # 整個資料夾匯入的 Gemini 請求排在即時上傳之後
+        _gemini_priority.set(GEMINI_PRIORITY_DRIVE)
+        entries = iter_drive_downloads(items)
+        stream_format = get_stream_format(json_data); batch_images = get_gemini_batch_size(json_data)
+        if stream_format: return stream_response(entries, stream_format, skip_unsupported=True, batch_images=batch_images, total=len(items))
+        pending = submit_ocr_batch(entries, skip_unsupported=True, batch_images=batch_images)
+        result_set_id = uuid.uuid4().hex
+        all_results = finalize_ocr_batch(pending, result_set_id)
 
-        return jsonify({"results": all_results})
+        return jsonify(with_timing({"results": all_results, "result_set_id": result_store.create(all_results, set_id=result_set_id)}))
 
     except Exception as e:
         traceback.print_exc()
@@ -370,166 +2735,128 @@ def process_drive_folder():
 def process_image():
     uploaded_files = request.files.getlist('receipt_image');
     if not uploaded_files or uploaded_files[0].filename == '': return jsonify({"error": "沒有選擇任何檔案"}), 400
-    all_results = []
-    for file in uploaded_files:
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename); file.save(filepath)
-        try:
-            mime_type = guess_type(filepath)[0]; raw_receipts = []
-            if mime_type in ["image/jpeg", "image/png", "image/webp"]:
-                with open(filepath, "rb") as f: image_bytes = f.read()
-                raw_receipts = extract_data_with_gemini_vision(image_bytes, mime_type)
-            elif mime_type == "application/pdf":
-                doc = fitz.open(filepath)
-                for page_num, page in enumerate(doc):
-                    print(f"處理 PDF '{file.filename}' 的第 {page_num + 1} 頁...")
-                    pix = page.get_pixmap(dpi=PDF_CONVERSION_DPI); img_bytes = pix.tobytes("png")
-                    page_receipts = extract_data_with_gemini_vision(img_bytes, "image/png"); raw_receipts.extend(page_receipts)
-                doc.close()
-            else: raise Exception(f"不支援的檔案格式: {mime_type}")
-            finalized_results = enrich_and_finalize_data(raw_receipts, file.filename); all_results.extend(finalized_results)
-        except Exception as e:
-            print(f"--- 處理檔案 {file.filename} 時發生嚴重錯誤 ---"); traceback.print_exc()
-            all_results.append({"來源檔案": file.filename, "統一發票號碼": f"處理失敗: {e}",})
-        finally:
-            if os.path.exists(filepath): os.remove(filepath)
-    return jsonify({"results": all_results})
+    # 先把所有檔案 / 頁面送入執行緒池，再依原始順序收集結果
+    entries = [SpooledUpload.from_stream(file.filename, file.stream) for file in uploaded_files]
+    stream_format = get_stream_format(); batch_images = get_gemini_batch_size()
+    if stream_format: return stream_response(entries, stream_format, batch_images=batch_images)
+    pending = submit_ocr_batch(entries, batch_images=batch_images)
+
+    result_set_id = uuid.uuid4().hex
+    all_results = finalize_ocr_batch(pending, result_set_id)
+    return jsonify(with_timing({"results": all_results, "result_set_id": result_store.create(all_results, set_id=result_set_id)}))
+
+# --- 背景工作 API ---
+@app.route('/jobs/process_image', methods=['POST'])
+def submit_process_image_job():
+    uploaded_files = request.files.getlist('receipt_image');
+    if not uploaded_files or uploaded_files[0].filename == '': return jsonify({"error": "沒有選擇任何檔案"}), 400
+    result_set_id = uuid.uuid4().hex
+    job_id = job_queue.submit("upload", {"gemini_batch": get_gemini_batch_size(), "result_set_id": result_set_id}, [(file.filename, file.read()) for file in uploaded_files])
+    ensure_job_workers()
+    return jsonify({"job_id": job_id, "status": "queued", "result_set_id": result_set_id}), 202
+
+@app.route('/jobs/process_drive_folder', methods=['POST'])
+def submit_process_drive_folder_job():
+    json_data = request.json or {}
+    selected_files = json_data.get('selected_files')
+    folder_id = json_data.get('folder_id') or os.getenv('GDRIVE_FOLDER_ID')
+    if not selected_files and not folder_id: return jsonify({"error": "未提供 Folder ID 且 .env 中也未設定"}), 400
+    result_set_id = uuid.uuid4().hex
+    job_id = job_queue.submit("drive", {"selected_files": selected_files, "folder_id": folder_id, "gemini_batch": get_gemini_batch_size(json_data), "result_set_id": result_set_id})
+    ensure_job_workers()
+    return jsonify({"job_id": job_id, "status": "queued", "result_set_id": result_set_id}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    try: since = max(int(request.args.get('since', 0)), 0)
+    except ValueError: return jsonify({"error": "since 參數必須是整數"}), 400
+    job = job_queue.get(job_id, since)
+    if job is None: return jsonify({"error": "找不到此工作"}), 404
+    return jsonify(job)
+
+def get_export_results(json_data: dict):
+    """匯出資料來源：有 result_set_id 時讀取伺服器端結果集並套用 edits / deleted / added，否則使用 body 中的 results。
+    預設排除已由其他批次匯出的重複發票 (include_duplicates: true 時保留)；回傳 (results, 錯誤回應)"""
+    result_set_id = json_data.get('result_set_id')
+    batch_id = export_batch_id(json_data)
+    if not result_set_id: results = json_data.get('results', [])
+    else:
+        results = result_store.get(str(result_set_id))
+        if results is None: return None, (jsonify({"error": "結果集不存在或已過期，請重新辨識"}), 404)
+        try: results = apply_result_edits(results, json_data.get('edits'), json_data.get('deleted'), json_data.get('added'))
+        except (ValueError, TypeError, AttributeError) as e: return None, (jsonify({"error": f"修改內容格式錯誤: {e}"}), 400)
+    if json_data.get('include_duplicates') is not True:
+        kept = exclude_duplicate_invoices(results, batch_id)
+        # 排除筆數以 X-Excluded-Duplicates 標頭回報；全部都是重複時明確回報錯誤
+        g.excluded_duplicates = len(results) - len(kept)
+        if results and not kept:
+            return None, (jsonify({"error": f"全部 {len(results)} 筆發票皆已由其他批次匯出；如需重新匯出請加上 include_duplicates: true，"
+                                            "或以 DELETE /invoice_index/<result_set_id> 移除先前的匯出紀錄"}), 409)
+        results = kept
+    return results, None
+
+def export_batch_id(json_data: dict) -> str:
+    """本次匯出所屬的批次：result_set_id，或直接送 results 時前端帶的 batch_id；都沒有時以整批發票的索引鍵
+    雜湊為批次，同樣的 results 再匯出 (例如 GV 之後的費用報支檔) 不會被當成重複。以 X-Export-Batch-Id 標頭回傳"""
+    if g.get("export_batch_id") is None:
+        batch_id = json_data.get('result_set_id') or json_data.get('batch_id')
+        if not batch_id:
+            keys = sorted({key for key in map(invoice_key, json_data.get('results') or []) if key is not None})
+            batch_id = "results-" + hashlib.sha256(json.dumps(keys).encode("utf-8")).hexdigest()[:32]
+        g.export_batch_id = str(batch_id)
+    return g.export_batch_id
+
+def record_exported_invoices(json_data: dict, results: list, chunks=None):
+    """匯出成功後把匯出的發票寫入發票索引；chunks 為串流輸出時，全部送出後才寫入 (中途中斷不記錄)"""
+    batch_id = export_batch_id(json_data)
+    if chunks is None: invoice_index.record(results, batch_id); return None
+
+    def recorded_chunks():
+        yield from chunks
+        invoice_index.record(results, batch_id)
+    return recorded_chunks()
+
+@app.route('/invoice_index/<batch_id>', methods=['DELETE'])
+def forget_invoice_batch(batch_id):
+    """從發票索引移除某次匯出 (結果集) 的發票，之後同樣的發票不再被標記為重複"""
+    try: removed = invoice_index.forget(batch_id)
+    except sqlite3.Error as e: return jsonify({"error": f"更新發票索引失敗: {e}"}), 500
+    return jsonify({"batch_id": batch_id, "removed": removed})
 
 @app.route('/generate_gv', methods=['POST'])
 def generate_gv():
-    # --- 修改說明: 使用 xlwt 產生 .xls 檔案 (Excel 97-2003) ---
+    # --- 修改說明: 預設使用 xlwt 產生 .xls 檔案 (Excel 97-2003)；format=csv / xlsx 時改為串流輸出 ---
     json_data = request.json
-    results = json_data.get('results', [])
+    results, error_response = get_export_results(json_data)
+    if error_response: return error_response
     account_payable_code = json_data.get('account_payable_code', '')
 
     if not results: return jsonify({"error": "沒有資料可供下載"}), 400
 
-    def convert_format_code_to_type(code): return "Q" if str(code) == "22" else "I"
-
-    # 表頭欄位
-    header_row = [
-        "序號", "公司別", "發票號碼", "稅籍編號", "統一編號", "記帳點",
-        "發票/憑證類別", "格式代號", "單據憑證日期", 
-        "傳票日期", "申報年月", "銷售人統一編號", "銷售人名稱", "課稅別", "進貨折讓區分", 
-        "未稅金額", "進項稅額", "金額總計", "進項稅性質別", "扣抵代號",
-        "彙總張數", "彙加註記", "應付立帳號碼", "備註" 
-    ]
-
-    data_for_excel = []; data_for_excel.append(header_row)
-
-    # 準備資料
-    for index, row_data in enumerate(results):
-        transaction_date = row_data.get("交易日期", "")
-        formatted_date_for_I_str = transaction_date.replace("-", "") if transaction_date else ""
-        formatted_date_for_I_val = formatted_date_for_I_str if formatted_date_for_I_str else None
-
-        format_code = row_data.get("格式", 25)
-        try: format_code_int = int(format_code)
-        except (ValueError, TypeError): format_code_int = 25
-        format_code_val = str(format_code_int) if format_code_int is not None else None
-
-        try: tax_exclusive = int(row_data.get("未稅金額", 0))
-        except (ValueError, TypeError): tax_exclusive = 0
-        try: tax = int(row_data.get("進項稅額", 0))
-        except (ValueError, TypeError): tax = 0
-        try: total = int(row_data.get("金額總計", 0))
-        except (ValueError, TypeError): total = 0
-
-        gv_dict = {
-            "序號": index + 1,
-            "公司別": "HD",
-            "發票號碼": str(row_data.get("統一發票號碼", "")),
-            "稅籍編號": "721401318",
-            "統一編號": "03251000",
-            "記帳點": 1,
-            "發票/憑證類別": str(convert_format_code_to_type(format_code_int)),
-            "格式代號": format_code_val,
-            "單據憑證日期": formatted_date_for_I_val,
-            "傳票日期": None,
-            "申報年月": None,
-            "銷售人統一編號": str(row_data.get("賣方統一編號", "")),
-            "銷售人名稱": str(row_data.get("賣方名稱", "")),
-            "課稅別": "1",
-            "進貨折讓區分": None,
-            "未稅金額": tax_exclusive if tax_exclusive != 0 else None,
-            "進項稅額": tax if tax != 0 else None,
-            "金額總計": total if total != 0 else None,
-            "進項稅性質別": "126200",
-            "扣抵代號": 1,
-            "彙總張數": 0,
-            "彙加註記": "N",
-            "應付立帳號碼": str(account_payable_code) if account_payable_code else None,
-            "備註": None
-        }
-        
-        gv_dict["序號"] = str(gv_dict["序號"]) if gv_dict["序號"] is not None else None
-        current_row_list = [gv_dict.get(header_name) for header_name in header_row]
-        data_for_excel.append(current_row_list)
-
-    # --- 建立 .xls 檔案 (使用 xlwt) ---
-    wb = xlwt.Workbook(encoding='utf-8')
-    ws = wb.add_sheet("PURDATA")
-
-    # 設定字體與樣式
-    font_content = xlwt.Font()
-    font_content.name = 'Microsoft JhengHei'
-    font_content.height = 280 # 14pt (20 * 14)
-
-    # 置中樣式 (標題)
-    style_center = xlwt.XFStyle()
-    alignment_center = xlwt.Alignment()
-    alignment_center.horz = xlwt.Alignment.HORZ_CENTER
-    alignment_center.vert = xlwt.Alignment.VERT_CENTER
-    style_center.alignment = alignment_center
-    style_center.font = font_content
-
-    # 靠左樣式 (文字)
-    style_left = xlwt.XFStyle()
-    alignment_left = xlwt.Alignment()
-    alignment_left.horz = xlwt.Alignment.HORZ_LEFT
-    alignment_left.vert = xlwt.Alignment.VERT_CENTER
-    style_left.alignment = alignment_left
-    style_left.font = font_content
-
-    # 靠右樣式 (數字)
-    style_right = xlwt.XFStyle()
-    alignment_right = xlwt.Alignment()
-    alignment_right.horz = xlwt.Alignment.HORZ_RIGHT
-    alignment_right.vert = xlwt.Alignment.VERT_CENTER
-    style_right.alignment = alignment_right
-    style_right.font = font_content
-
-    # 寫入資料
-    for row_idx, row_data in enumerate(data_for_excel):
-        for col_idx, cell_value in enumerate(row_data):
-            # 判斷樣式
-            current_style = style_left
-            if row_idx == 0: # 表頭
-                current_style = style_center
-            elif col_idx in [0, 7]: # 序號, 格式代號
-                current_style = style_left
-            elif isinstance(cell_value, (int, float)): # 數字
-                current_style = style_right
-            
-            # 寫入儲存格
-            val_to_write = cell_value if cell_value is not None else ''
-            ws.write(row_idx, col_idx, val_to_write, current_style)
-
-    # 自動調整欄寬 (簡易版估算)
-    for col_idx in range(len(header_row)):
-        max_len = 0
-        for row_data in data_for_excel:
-            val = str(row_data[col_idx]) if row_data[col_idx] is not None else ""
-            # 計算長度 (中文字算2)
-            curr_len = 0
-            for char in val: curr_len += 2 if '\u4e00' <= char <= '\u9fff' else 1
-            if curr_len > max_len: max_len = curr_len
-        
-        # xlwt 寬度單位是 1/256 個字元寬度
-        ws.col(col_idx).width = 256 * (max_len + 2)
-
-    output_buffer = io.BytesIO()
-    wb.save(output_buffer)
-    excel_data = output_buffer.getvalue()
+    export_format = str(request.args.get('format') or json_data.get('format') or 'xls').lower()
+    rows = iter_gv_rows(results, account_payable_code)
+
+    if export_format == 'csv':
+        chunks = record_exported_invoices(json_data, results, timed_chunks("export_gv_csv", iter_csv_chunks(GV_HEADER_ROW, rows)))
+        return Response(stream_with_context(chunks), mimetype="text/csv; charset=utf-8", headers={"Content-Disposition": "attachment;filename=GV_output.csv"})
+    if export_format == 'xlsx':
+        chunks = record_exported_invoices(json_data, results, timed_chunks("export_gv_xlsx", iter_xlsx_chunks("PURDATA", GV_HEADER_ROW, rows)))
+        return Response(stream_with_context(chunks), mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={"Content-Disposition": "attachment;filename=GV_output.xlsx"})
+    if export_format != 'xls': return jsonify({"error": f"不支援的匯出格式: {export_format}"}), 400
+
+    # 超過 .xls 列數上限時: split=files 改為多個 .xls 打包成 zip，否則 (預設) 換到下一張 PURDATA 工作表
+    if str(request.args.get('split') or json_data.get('split') or 'sheets').lower() == 'files' and len(results) > GV_ROWS_PER_SHEET:
+        with stage_timer("export_gv_xls"): zip_data = build_gv_xls_zip(rows)
+        record_exported_invoices(json_data, results)
+        return Response(zip_data, mimetype="application/zip", headers={"Content-Disposition": "attachment;filename=GV_output.zip"})
+
+    with stage_timer("export_gv_xls"):
+        wb = xlwt.Workbook(encoding='utf-8')
+        write_gv_sheets(wb, rows)
+        output_buffer = io.BytesIO()
+        wb.save(output_buffer)
+        excel_data = output_buffer.getvalue()
+    record_exported_invoices(json_data, results)
 
     # 回傳 .xls MIME type
     return Response(excel_data, mimetype="application/vnd.ms-excel", headers={"Content-Disposition": "attachment;filename=GV_output.xls"})
@@ -539,151 +2866,31 @@ def generate_gv():
 def generate_expense_report():
     # --- 修改說明: 使用 xlwt 產生 .xls 檔案 (Excel 97-2003) ---
     json_data = request.json
-    results = json_data.get('results', [])
+    results, error_response = get_export_results(json_data)
+    if error_response: return error_response
     if not results: return jsonify({"error": "沒有資料可供下載"}), 400
 
-    def convert_format_code_to_type(code): return "Q" if str(code) == "22" else "I"
-
-    # 1. 依照格式代碼分組 (邏輯維持不變)
-    groups = {} 
-    for row in results:
-        fmt_str = str(row.get("格式", 25))
-        try: fmt = int(fmt_str)
-        except: fmt = 25
-        if fmt not in groups: groups[fmt] = []
-        groups[fmt].append(row)
-
-    processed_rows = []
-
-    # 2. 處理每一組格式代碼 (邏輯維持不變)
-    for fmt, items in groups.items():
-        small_tax_items = [] 
-        large_tax_items = [] 
-
-        for item in items:
-            try: tax = int(item.get("進項稅額", 0))
-            except: tax = 0
-            if tax < 500: small_tax_items.append(item)
-            else: large_tax_items.append(item)
-
-        for item in large_tax_items:
-            item['_is_aggregated'] = "N"; item['_agg_count'] = 0; item['_final_fmt'] = fmt
-            processed_rows.append(item)
-
-        if small_tax_items:
-            sum_tax_exclusive = 0; sum_tax = 0; sum_total = 0
-            small_tax_items.sort(key=lambda x: (
-                int(x.get("進項稅額", 0) if x.get("進項稅額") is not None else 0),
-                int(x.get("未稅金額", 0) if x.get("未稅金額") is not None else 0),
-                x.get("統一發票號碼", "")
-            ), reverse=True)
-            representative = small_tax_items[0].copy() 
-
-            for s_item in small_tax_items:
-                try: v1 = int(s_item.get("未稅金額", 0)); sum_tax_exclusive += v1
-                except: pass
-                try: v2 = int(s_item.get("進項稅額", 0)); sum_tax += v2
-                except: pass
-                try: v3 = int(s_item.get("金額總計", 0)); sum_total += v3
-                except: pass
-            
-            representative["未稅金額"] = sum_tax_exclusive
-            representative["進項稅額"] = sum_tax
-            representative["金額總計"] = sum_total
-            representative['_is_aggregated'] = "Y"
-            representative['_agg_count'] = len(small_tax_items)
-            
-            if fmt == 21: representative['_final_fmt'] = 26
-            elif fmt == 22: representative['_final_fmt'] = 27
-            else: representative['_final_fmt'] = fmt 
-
-            processed_rows.append(representative)
+    # 1~2. 依格式代碼分組並彙加小額稅額 (向量化處理)
+    with stage_timer("export_expense_aggregate"): processed_rows = aggregate_expense_rows(results)
 
     # 3. 準備 Excel 輸出 (.xls)
-    headers = [
-        "公司別", "憑證類別", "格式代號", "發票號碼", "記帳點", 
-        "統一編號", "單據憑證日期", "銷售人統一編號", "銷售人名稱", 
-        "未稅金額", "進項稅金額", "金額總計", "彙加註記", "彙總張數", "進項稅性質別"
-    ]
-
-    wb = xlwt.Workbook(encoding='utf-8')
-    ws = wb.add_sheet("ExpenseReport")
-
-    # 設定字體 (12pt)
-    font_content = xlwt.Font()
-    font_content.name = 'Microsoft JhengHei'
-    font_content.height = 240 # 12pt (20 * 12)
-
-    # 靠左樣式
-    style_left = xlwt.XFStyle()
-    alignment_left = xlwt.Alignment()
-    alignment_left.horz = xlwt.Alignment.HORZ_LEFT
-    alignment_left.vert = xlwt.Alignment.VERT_CENTER
-    style_left.alignment = alignment_left
-    style_left.font = font_content
-
-    # 靠右樣式
-    style_right = xlwt.XFStyle()
-    alignment_right = xlwt.Alignment()
-    alignment_right.horz = xlwt.Alignment.HORZ_RIGHT
-    alignment_right.vert = xlwt.Alignment.VERT_CENTER
-    style_right.alignment = alignment_right
-    style_right.font = font_content
-
-    # 寫入表頭
-    for col_idx, h in enumerate(headers):
-        ws.write(0, col_idx, h, style_left)
-
-    # 寫入資料
-    for row_idx, item in enumerate(processed_rows, 1):
-        transaction_date = item.get("交易日期", "")
-        formatted_date = transaction_date.replace("-", "") if transaction_date else ""
-        final_fmt = item.get('_final_fmt', 25)
-
-        row_values = [
-            "HD", 
-            convert_format_code_to_type(final_fmt), 
-            final_fmt, 
-            item.get("統一發票號碼", ""), 
-            1, 
-            "03251000", 
-            formatted_date, 
-            item.get("賣方統一編號", ""), 
-            item.get("賣方名稱", ""), 
-            item.get("未稅金額", 0), 
-            item.get("進項稅額", 0), 
-            item.get("金額總計", 0), 
-            item.get("_is_aggregated", "N"), 
-            item.get("_agg_count", 0), 
-            "126200" 
-        ]
-
-        for col_idx, val in enumerate(row_values):
-            current_style = style_left
-            if headers[col_idx] in ["未稅金額", "進項稅金額", "金額總計", "彙總張數"]:
-                current_style = style_right
-                try: val = int(val)
-                except: pass
-            else:
-                val = str(val) # 強制轉字串
-
-            ws.write(row_idx, col_idx, val, current_style)
-
-    # 自動調整欄寬
-    for col_idx in range(len(headers)):
-        max_len = len(str(headers[col_idx])) * 2 # 表頭長度
-        for r_idx, item in enumerate(processed_rows):
-            # 簡易估算，這裡不需要太精準，只要夠寬即可
-            pass 
-        # 直接設定一個比較寬的預設值，xlwt 的自動調整比較麻煩
-        ws.col(col_idx).width = 256 * 15 # 預設寬度
-
-    output_buffer = io.BytesIO()
-    wb.save(output_buffer)
-    excel_data = output_buffer.getvalue()
+    with stage_timer("export_expense_xls"): excel_data = build_expense_xls(processed_rows)
+    record_exported_invoices(json_data, results)
 
     return Response(excel_data, mimetype="application/vnd.ms-excel", headers={"Content-Disposition": "attachment;filename=Expense_Report.xls"})
 
+start_background_warmup()
+
 if __name__ == '__main__':
-    print("--- 發票批次辨識與剖析程式 (v52.0 - 相容舊版 Excel .xls) ---")
-    app.run(port=5000, debug=True)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        # 單獨啟動背景工作程序: python app1.py worker
+        run_job_worker()
+    elif len(sys.argv) > 2 and sys.argv[1] == 'import-registry':
+        # 匯入財政部稅籍登記資料集: python app1.py import-registry BGMOPEN1.csv [編碼]
+        started = time.perf_counter()
+        try: count = import_registry_csv(sys.argv[2], encoding=sys.argv[3] if len(sys.argv) > 3 else "utf-8-sig")
+        except (OSError, ValueError) as e: print(f"離線稅籍索引匯入失敗: {e}"); sys.exit(1)
+        print(f"離線稅籍索引匯入完成: {count} 筆，耗時 {time.perf_counter() - started:.1f} 秒 -> {REGISTRY_INDEX_PATH}")
+    else:
+        print("--- 發票批次辨識與剖析程式 (v52.0 - 相容舊版 Excel .xls) ---")
+        app.run(port=5000, debug=True)
\ No newline at end of file
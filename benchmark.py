@@ -0,0 +1,333 @@
+# benchmark.py
+# 離線效能測試：以可重現的假 Gemini / 稅籍 API / Google Drive 取代外部服務，
+# 量測 /process_image、/process_drive_folder、/generate_gv、/generate_expense_report 在不同批次大小下的
+# 吞吐量 (files/s)、延遲 p50 / p95 與記憶體峰值，不消耗 Gemini 額度也不連線政府 API。
+#
+# 用法: python benchmark.py --sizes 1,10,50 --repeat 5 --gemini-latency 0.8 --gemini-error-rate 0.02
+#       python benchmark.py --startup 10   (冷啟動: import 時間與第一個回應的時間)
+import os
+import io
+import sys
+import subprocess
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import resource
+import threading
+import tracemalloc
+import contextlib
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="發票辨識服務離線效能測試")
+    parser.add_argument("--routes", default="process_image,process_drive_folder,generate_gv,generate_expense_report",
+                        help="要測試的路由 (逗號分隔)")
+    parser.add_argument("--sizes", default="1,10,50", help="辨識路由的批次檔案數 (逗號分隔)")
+    parser.add_argument("--export-sizes", default="100,1000,10000", help="匯出路由的資料筆數 (逗號分隔)")
+    parser.add_argument("--repeat", type=int, default=5, help="每個情境重複次數 (延遲百分位數以此計算)")
+    parser.add_argument("--pdf-ratio", type=float, default=0.3, help="語料中 PDF 檔案的比例")
+    parser.add_argument("--pdf-pages", type=int, default=3, help="每個 PDF 的頁數")
+    parser.add_argument("--text-pdf-ratio", type=float, default=0.0, help="PDF 中帶有電子發票文字層 (走文字層快速路徑) 的比例")
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="假 Gemini 每次呼叫的延遲 (秒)")
+    parser.add_argument("--gemini-jitter", type=float, default=0.2, help="假 Gemini 延遲的隨機浮動比例")
+    parser.add_argument("--gemini-upload-mbps", type=float, default=0.0,
+                        help="模擬上傳頻寬 (Mbit/s)，假 Gemini 依送出的影像大小加上傳輸時間 (0 = 不模擬)")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0, help="假 Gemini 回傳 429 / 503 (會被重試) 的機率")
+    parser.add_argument("--registry-latency", type=float, default=0.1, help="假稅籍 API 每次查詢的延遲 (秒)")
+    parser.add_argument("--registry-error-rate", type=float, default=0.0, help="假稅籍 API 回傳 5xx 的機率")
+    parser.add_argument("--drive-latency", type=float, default=0.05, help="假 Drive 每個檔案的下載延遲 (秒)")
+    parser.add_argument("--drive-error-rate", type=float, default=0.0, help="假 Drive 下載失敗的機率")
+    parser.add_argument("--sellers", type=int, default=50, help="語料中不同賣方統編的數量")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--json", dest="json_path", help="另外將結果寫成 JSON 檔 (方便與上次結果比較)")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+                        help="不追蹤記憶體峰值 (tracemalloc 會拖慢執行，只比較速度時可關閉)")
+    parser.add_argument("--startup", type=int, default=0, metavar="N",
+                        help="改為量測冷啟動: 以全新的 Python 程序啟動 N 次 (不執行路由測試)")
+    parser.add_argument("--verbose", action="store_true", help="保留應用程式本身的輸出訊息")
+    return parser.parse_args(argv)
+
+def make_valid_vats(count: int, rng: random.Random, is_valid_vat_number) -> list:
+    vats = set()
+    while len(vats) < count:
+        vat = "".join(rng.choice("0123456789") for _ in range(8))
+        if is_valid_vat_number(vat): vats.add(vat)
+    return sorted(vats)
+
+def make_receipt(seed_bytes: bytes, sellers: list) -> dict:
+    """依圖片內容雜湊產生固定的假辨識結果 (同一張圖永遠得到同樣的結果)"""
+    digest = hashlib.sha256(seed_bytes).digest()
+    rng = random.Random(digest)
+    prefix = rng.choice(["AB", "CD", "EF", "GH", "JK", "LM", "NP", "QR", "ST", "UV"])
+    return {
+        "invoice_number": f"{prefix}{rng.randrange(10 ** 8):08d}",
+        "date": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "time": f"{rng.randint(8, 21):02d}:{rng.randint(0, 59):02d}:00",
+        "seller_vat": rng.choice(sellers),
+        "buyer_vat": "03251000",
+        "total_amount": str(rng.choice([rng.randint(10, 2000), rng.randint(2000, 50000)])),
+    }
+
+class FakeGeminiError(Exception):
+    """模擬 Gemini 的暫時性錯誤 (帶 HTTP 狀態碼，與 google.api_core 例外相同由 code 屬性判斷是否重試)"""
+
+    def __init__(self, code: int):
+        super().__init__(f"{code} fake Gemini error"); self.code = code
+
+class FakeGeminiResponse:
+    def __init__(self, text: str): self.text = text; self.usage_metadata = None
+
+class FakeGemini:
+    """假 Gemini 模型 (取代 GenerativeModel.generate_content)：固定延遲 (含浮動) 後回傳依圖片內容決定的結果，
+    依 error_rate 拋出 503 / 429，讓應用程式的排程、重試與逐頁失敗回報照常運作"""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float, sellers: list, seed: int, upload_mbps: float = 0.0):
+        self.latency = latency; self.jitter = jitter; self.error_rate = error_rate; self.sellers = sellers
+        self.upload_mbps = upload_mbps
+        self.rng = random.Random(seed); self.lock = threading.Lock(); self.calls = 0; self.images = 0; self.bytes = 0
+
+    def generate_content(self, parts: list) -> FakeGeminiResponse:
+        images = [part["data"] for part in parts if isinstance(part, dict)]
+        payload_bytes = sum(len(image_bytes) for image_bytes in images)
+        with self.lock:
+            self.calls += 1; self.images += len(images); self.bytes += payload_bytes
+            failed = self.rng.random() < self.error_rate
+            status = self.rng.choice((429, 503))
+            delay = self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter))
+        if self.upload_mbps > 0: delay += payload_bytes * 8 / (self.upload_mbps * 1e6)
+        time.sleep(max(delay, 0))
+        if failed: raise FakeGeminiError(status)
+        receipts = []
+        for index, image_bytes in enumerate(images):
+            receipt = make_receipt(image_bytes, self.sellers)
+            if len(images) > 1: receipt["image_index"] = index
+            receipts.append(receipt)
+        return FakeGeminiResponse(json.dumps({"receipts": receipts}, ensure_ascii=False))
+
+class FakeRegistry:
+    """假稅籍查詢 (取代 query_fia / query_g0v)：依 error_rate 拋出 5xx 例外，讓斷路器照常運作"""
+
+    def __init__(self, name: str, latency: float, error_rate: float, seed: int, http_error):
+        self.name = name; self.latency = latency; self.error_rate = error_rate; self.http_error = http_error
+        self.rng = random.Random(seed); self.lock = threading.Lock(); self.calls = 0
+
+    def __call__(self, vat_number: str):
+        with self.lock:
+            self.calls += 1; failed = self.rng.random() < self.error_rate
+        time.sleep(self.latency)
+        if failed: raise self.http_error("HTTP 503")
+        return {"name": f"{self.name}測試股份有限公司{vat_number[-3:]}", "address": f"臺北市測試路{int(vat_number[-3:])}號"}
+
+class FakeDriveRequest:
+    def __init__(self, result): self.result = result
+    def execute(self): return self.result
+
+class FakeDriveFiles:
+    def __init__(self, service): self.service = service
+
+    def list(self, q=None, pageSize=1000, pageToken=None, fields=None):
+        start = int(pageToken or 0); files = self.service.listing[start:start + pageSize]
+        result = {"files": files}
+        if start + pageSize < len(self.service.listing): result["nextPageToken"] = str(start + pageSize)
+        return FakeDriveRequest(result)
+
+class FakeDriveService:
+    """假 Drive Service：files().list() 支援分頁；下載由 download() 取代 download_file_by_id"""
+
+    def __init__(self, latency: float, error_rate: float, seed: int):
+        self.latency = latency; self.error_rate = error_rate
+        self.rng = random.Random(seed); self.lock = threading.Lock()
+        self.listing = []; self.contents = {}
+
+    def load(self, corpus: list):
+        self.listing = []; self.contents = {}
+        for index, (name, data, mime_type) in enumerate(corpus):
+            file_id = f"fake-{index}-{hashlib.sha1(data).hexdigest()[:8]}"
+            self.listing.append({"id": file_id, "name": name, "mimeType": mime_type}); self.contents[file_id] = data
+
+    def files(self): return FakeDriveFiles(self)
+
+    def download(self, service, file_id, file_name):
+        with self.lock: failed = self.rng.random() < self.error_rate
+        time.sleep(self.latency)
+        if failed: raise IOError(f"模擬下載失敗: {file_name}")
+        return app1.SpooledUpload.from_bytes(file_name, self.contents[file_id])
+
+def make_corpus(count: int, pdf_ratio: float, pdf_pages: int, salt: str, rng: random.Random,
+                text_pdf_ratio: float = 0.0, sellers: list = ()) -> list:
+    """以 PyMuPDF 產生假發票圖片 / PDF，回傳 (檔名, bytes, mime_type) 串列；salt 讓每輪內容不同，避免命中辨識快取
+    text_pdf_ratio 比例的 PDF 改為軟體產生的電子發票證明聯 (有可解析的文字層)"""
+    corpus = []
+    for index in range(count):
+        is_pdf = rng.random() < pdf_ratio
+        is_text_pdf = is_pdf and sellers and rng.random() < text_pdf_ratio
+        doc = fitz.open()
+        for page_num in range(pdf_pages if is_pdf else 1):
+            page = doc.new_page(width=300, height=420)
+            if is_text_pdf:
+                receipt = make_receipt(f"{salt}-{index}-{page_num}".encode(), sellers)
+                page.insert_text((20, 40), f"電子發票證明聯\n發票號碼 {receipt['invoice_number']}\n{receipt['date']} {receipt['time']}\n"
+                                 f"總計 {receipt['total_amount']}\n賣方 {receipt['seller_vat']}", fontname="china-t", fontsize=11)
+                continue
+            page.insert_text((20, 40), f"INVOICE {salt}-{index}-{page_num}", fontsize=14)
+            for line in range(12):
+                page.insert_text((20, 80 + line * 24), f"ITEM {rng.randint(1, 999):03d}  x{rng.randint(1, 9)}  {rng.randint(10, 9999)}", fontsize=10)
+            page.draw_rect(fitz.Rect(20, 370, 280, 400), color=(0, 0, 0))
+        if is_pdf:
+            corpus.append((f"bench_{salt}_{index}.pdf", doc.tobytes(), "application/pdf"))
+        else:
+            corpus.append((f"bench_{salt}_{index}.png", doc[0].get_pixmap(dpi=150).tobytes("png"), "image/png"))
+        doc.close()
+    return corpus
+
+def make_export_results(count: int, sellers: list, seed: int) -> list:
+    """產生匯出路由用的辨識結果 (走與正式流程相同的 build_receipt)"""
+    rows = []
+    for index in range(count):
+        receipt = app1.build_receipt(make_receipt(f"{seed}-{index}".encode(), sellers), f"bench_{index}.png")
+        receipt["賣方名稱"] = f"測試股份有限公司{receipt['賣方統一編號'][-3:]}"
+        rows.append(receipt)
+    return rows
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    if not ordered: return 0.0
+    k = (len(ordered) - 1) * q; f = int(k); c = min(f + 1, len(ordered) - 1)
+    return ordered[f] + (ordered[c] - ordered[f]) * (k - f)
+
+def measure(run, repeat: int, units: int) -> dict:
+    """執行 repeat 次 run()，回傳 吞吐量、延遲 p50 / p95 與 Python 配置記憶體峰值"""
+    latencies = []; peak = 0
+    for i in range(repeat):
+        prepared = run.prepare(i)
+        if tracemalloc.is_tracing(): tracemalloc.reset_peak()
+        start = time.perf_counter()
+        run(prepared)
+        latencies.append(time.perf_counter() - start)
+        if tracemalloc.is_tracing(): peak = max(peak, tracemalloc.get_traced_memory()[1])
+    total = sum(latencies)
+    return {
+        "units": units, "repeat": repeat, "throughput": units * repeat / total if total else 0.0,
+        "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+        "peak_mb": peak / (1024 * 1024) if tracemalloc.is_tracing() else None,
+    }
+
+class Scenario:
+    """一個 路由 × 批次大小 的測試情境：prepare(i) 在計時外準備資料，__call__ 送出請求並檢查回應"""
+
+    def __init__(self, client, route: str, size: int, args, sellers: list, drive: FakeDriveService):
+        self.client = client; self.route = route; self.size = size; self.args = args
+        self.sellers = sellers; self.drive = drive; self.rng = random.Random(args.seed + size)
+
+    def prepare(self, i: int):
+        salt = f"{self.size}-{i}-{time.time_ns()}"
+        if self.route == "process_image":
+            return make_corpus(self.size, self.args.pdf_ratio, self.args.pdf_pages, salt, self.rng, self.args.text_pdf_ratio, self.sellers)
+        if self.route == "process_drive_folder":
+            self.drive.load(make_corpus(self.size, self.args.pdf_ratio, self.args.pdf_pages, salt, self.rng, self.args.text_pdf_ratio, self.sellers))
+            return None
+        return make_export_results(self.size, self.sellers, f"{self.args.seed}-{salt}")
+
+    def __call__(self, prepared):
+        if self.route == "process_image":
+            data = {"receipt_image": [(io.BytesIO(content), name) for name, content, _ in prepared]}
+            response = self.client.post("/process_image", data=data, content_type="multipart/form-data")
+        elif self.route == "process_drive_folder":
+            response = self.client.post("/process_drive_folder", json={"folder_id": "bench-folder"})
+        else:
+            response = self.client.post(f"/{self.route}", json={"results": prepared})
+        response.get_data()
+        if response.status_code != 200: raise RuntimeError(f"/{self.route} 回應 {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+# 在全新程序中 import app1 並取得首頁；之後再載入所有延遲載入的套件，量出「第一個辨識請求」還需額外付出的時間
+STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
+import app1
+imported = time.perf_counter()
+status = app1.app.test_client().get('/').status_code
+first_response = time.perf_counter()
+app1.warm_up(delay=0)
+print(json.dumps({"import": imported - start, "first_response": first_response - start,
+                  "lazy_load": time.perf_counter() - first_response, "status": status}))
+"""
+
+def run_startup_benchmark(runs: int, json_path: str = None) -> dict:
+    """冷啟動量測：每次都是全新的直譯器 (含直譯器本身啟動時間的 wall 也一併列出)"""
+    env = dict(os.environ, CACHE_FOLDER=os.path.join(tempfile.mkdtemp(prefix="invoice-bench-"), "cache"),
+               STARTUP_WARMUP="0", JOB_WORKER_PROCESSES="0")
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, "-c", STARTUP_PROBE], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   env=env, capture_output=True, text=True)
+        wall = time.perf_counter() - start
+        if completed.returncode != 0: raise RuntimeError(f"啟動失敗:\n{completed.stderr[-2000:]}")
+        sample = json.loads(completed.stdout.strip().splitlines()[-1]); sample["wall"] = wall
+        samples.append(sample)
+    summary = {}
+    for key in ("import", "first_response", "lazy_load", "wall"):
+        values = [sample[key] for sample in samples]
+        summary[key] = {"min": min(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95)}
+        print(f"{key:<16} min={summary[key]['min'] * 1000:>8.1f}ms  p50={summary[key]['p50'] * 1000:>8.1f}ms  p95={summary[key]['p95'] * 1000:>8.1f}ms")
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f: json.dump({"startup": summary, "samples": samples}, f, ensure_ascii=False, indent=2)
+    return summary
+
+def main(argv=None):
+    global app1, fitz
+    args = parse_args(argv)
+    if args.startup: return run_startup_benchmark(args.startup, args.json_path)
+    # 使用獨立的暫存快取目錄，不影響正式快取，也避免命中上次的結果
+    workdir = tempfile.mkdtemp(prefix="invoice-bench-")
+    os.environ["CACHE_FOLDER"] = os.path.join(workdir, "cache")
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark-fake-key")
+    os.environ["JOB_WORKER_PROCESSES"] = "0"
+    import fitz
+    import app1
+
+    rng = random.Random(args.seed)
+    sellers = make_valid_vats(args.sellers, rng, app1.is_valid_vat_number)
+    gemini = FakeGemini(args.gemini_latency, args.gemini_jitter, args.gemini_error_rate, sellers, args.seed, args.gemini_upload_mbps)
+    fia = FakeRegistry("財政部", args.registry_latency, args.registry_error_rate, args.seed + 1, app1.requests.HTTPError)
+    g0v = FakeRegistry("g0v", args.registry_latency, args.registry_error_rate, args.seed + 2, app1.requests.HTTPError)
+    drive = FakeDriveService(args.drive_latency, args.drive_error_rate, args.seed + 3)
+    app1._gemini_model = gemini
+    app1.query_fia = fia; app1.query_g0v = g0v
+    app1.get_drive_service = lambda: drive
+    app1.download_file_by_id = drive.download
+
+    client = app1.app.test_client()
+    routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+    ocr_sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    export_sizes = [int(s) for s in args.export_sizes.split(",") if s.strip()]
+
+    report = []
+    if args.trace_memory: tracemalloc.start()
+    for route in routes:
+        for size in (export_sizes if route.startswith("generate_") else ocr_sizes):
+            scenario = Scenario(client, route, size, args, sellers, drive)
+            sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+            with sink: result = measure(scenario, args.repeat, size)
+            result.update({"route": f"/{route}", "size": size})
+            report.append(result)
+            print(f"{result['route']:<28} size={size:<6} {result['throughput']:>10.1f} {'rows' if route.startswith('generate_') else 'files'}/s"
+                  f"  p50={result['p50'] * 1000:>9.1f}ms  p95={result['p95'] * 1000:>9.1f}ms"
+                  + (f"  peak={result['peak_mb']:>8.1f}MB" if result['peak_mb'] is not None else ""), flush=True)
+    if args.trace_memory: tracemalloc.stop()
+
+    summary = {
+        "args": vars(args), "results": report,
+        "gemini_calls": gemini.calls, "gemini_images": gemini.images, "gemini_bytes": gemini.bytes, "registry_calls": {"fia": fia.calls, "g0v": g0v.calls},
+        "ocr_cache": app1.ocr_cache.stats(), "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    print(f"Gemini 呼叫 {gemini.calls} 次 / {gemini.images} 張圖片 / {gemini.bytes / 1048576:.1f}MB，稅籍查詢 財政部 {fia.calls} 次、g0v {g0v.calls} 次，"
+          f"程序 RSS 峰值 {summary['max_rss_mb']:.1f}MB")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f: json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""測試共用設定：在 import app1 之前設定環境變數 (獨立的暫存快取目錄、不啟動背景工作程序、不開轉圖子程序)，
+並以 benchmark.py 的假 Gemini / 假稅籍查詢 / 假 Drive 取代外部服務。"""
+import os
+import random
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ["CACHE_FOLDER"] = os.path.join(tempfile.mkdtemp(prefix="invoice-tests-"), "cache")
+os.environ.setdefault("GOOGLE_API_KEY", "test-fake-key")
+os.environ["JOB_WORKER_PROCESSES"] = "0"
+os.environ["STARTUP_WARMUP"] = "0"
+os.environ["RASTER_MAX_PROCESSES"] = "1"
+os.environ["RASTER_MAX_PAGES_IN_MEMORY"] = "4"
+os.environ["REGISTRY_MAX_REQUESTS_PER_SEC"] = "1000"
+
+import fitz  # noqa: E402
+import app1  # noqa: E402
+import benchmark  # noqa: E402
+
+# benchmark.py 平常在 main() 才 import 這兩個模組
+benchmark.app1 = app1
+benchmark.fitz = fitz
+
+@pytest.fixture(scope="session")
+def sellers():
+    return benchmark.make_valid_vats(20, random.Random(1234), app1.is_valid_vat_number)
+
+@pytest.fixture
+def fakes(monkeypatch, sellers):
+    """安裝假 Gemini 與假稅籍查詢，回傳 (gemini, fia, g0v)；各測試可再調整延遲 / 錯誤率"""
+    gemini = benchmark.FakeGemini(0.05, 0.0, 0.0, sellers, 1)
+    fia = benchmark.FakeRegistry("財政部", 0.0, 0.0, 2, app1.requests.HTTPError)
+    g0v = benchmark.FakeRegistry("g0v", 0.0, 0.0, 3, app1.requests.HTTPError)
+    monkeypatch.setattr(app1, "_gemini_model", gemini)
+    monkeypatch.setattr(app1, "query_fia", fia)
+    monkeypatch.setattr(app1, "query_g0v", g0v)
+    return gemini, fia, g0v
+
+@pytest.fixture
+def corpus(request, sellers):
+    """產生內容唯一 (不會命中其他測試辨識快取) 的假發票檔案：corpus(count, pdf_ratio=0.0, pdf_pages=1)"""
+    rng = random.Random(request.node.name)
+
+    def make(count: int, pdf_ratio: float = 0.0, pdf_pages: int = 1):
+        return benchmark.make_corpus(count, pdf_ratio, pdf_pages, f"{request.node.name}-{rng.random()}", rng)
+    return make
+
+@pytest.fixture
+def client():
+    return app1.app.test_client()
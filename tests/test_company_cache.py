@@ -0,0 +1,59 @@
+"""公司資料快取：查到 / 查無資料各自的有效期限、程序內 LRU 與 SQLite 的分工、查詢流程只在快取失效時連線。"""
+import time
+
+import pytest
+
+import app1
+
+class FakeClock:
+    """取代 app1.time：time() 回傳可調整的時間，其餘照常使用 time 模組"""
+
+    def __init__(self): self.now = 1_000_000.0
+    def time(self): return self.now
+    def __getattr__(self, name): return getattr(time, name)
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock(); monkeypatch.setattr(app1, "time", fake)
+    return fake
+
+@pytest.fixture
+def cache(tmp_path):
+    return app1.CompanyInfoCache(str(tmp_path / "company_cache.db"), ttl=100, negative_ttl=10, lru_size=2)
+
+def test_found_entries_expire_after_ttl(cache, clock, tmp_path):
+    cache.put("28080623", {"name": "甲公司", "address": "臺北市"})
+    clock.now += 99
+    assert cache.get("28080623") == {"name": "甲公司", "address": "臺北市"}
+    # 其他程序 (新的 LRU) 從 SQLite 讀到同一筆
+    other = app1.CompanyInfoCache(cache.db_path, ttl=100, negative_ttl=10, lru_size=2)
+    assert other.get("28080623") == {"name": "甲公司", "address": "臺北市"}
+    clock.now += 2
+    assert cache.get("28080623") is None and other.get("28080623") is None
+
+def test_not_found_entries_use_negative_ttl(cache, clock):
+    cache.put("12345675", {"name": app1.COMPANY_NOT_FOUND_NAME, "address": ""})
+    cache.put("87654321", {"name": "N/A", "address": ""})
+    clock.now += 9
+    assert cache.get("12345675") == {"name": app1.COMPANY_NOT_FOUND_NAME, "address": ""}
+    clock.now += 2
+    assert cache.get("12345675") is None and cache.get("87654321") is None
+
+def test_lru_is_bounded_and_falls_back_to_sqlite(cache, clock):
+    for vat in ("00000001", "00000002", "00000003"): cache.put(vat, {"name": f"公司{vat}", "address": ""})
+    assert list(cache._lru) == ["00000002", "00000003"]
+    assert cache.get("00000001") == {"name": "公司00000001", "address": ""}
+    assert list(cache._lru) == ["00000003", "00000001"]
+    # 回傳的是複本，修改不會影響快取內容
+    cache.get("00000001")["name"] = "改過"
+    assert cache.get("00000001")["name"] == "公司00000001"
+
+def test_lookup_queries_registry_only_when_cache_misses(cache, clock, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app1, "company_cache", cache)
+    monkeypatch.setattr(app1, "fetch_company_info_from_registry", lambda vat: calls.append(vat) or {"name": app1.COMPANY_NOT_FOUND_NAME, "address": ""})
+    assert app1.lookup_company_info("12345675") == ({"name": app1.COMPANY_NOT_FOUND_NAME, "address": ""}, False)
+    assert app1.lookup_company_info("12345675")[1] is True and calls == ["12345675"]
+    clock.now += 11  # 查無資料的快取過期後重新查詢 (新設立的公司可能已有資料)
+    app1.lookup_company_info("12345675")
+    assert calls == ["12345675", "12345675"]
@@ -0,0 +1,40 @@
+"""Drive 資料夾：完整分頁列出檔案、略過不支援的檔案。"""
+import json
+import time
+
+import app1
+import benchmark
+
+def test_stream_drive_folder_pages_listing_and_skips_unsupported(fakes, corpus, client, monkeypatch):
+    drive = benchmark.FakeDriveService(0.01, 0.0, 4)
+    files = corpus(5)
+    drive.load(files + [("notes.txt", b"not an invoice", "text/plain")])
+    monkeypatch.setattr(app1, "get_drive_service", lambda: drive)
+    monkeypatch.setattr(app1, "download_file_by_id", drive.download)
+    # 每頁只列 2 筆，只讀第一頁時會漏掉檔案
+    list_files = benchmark.FakeDriveFiles.list
+    monkeypatch.setattr(benchmark.FakeDriveFiles, "list", lambda self, **kwargs: list_files(self, **dict(kwargs, pageSize=2)))
+    response = client.post("/process_drive_folder?stream=ndjson", json={"folder_id": "test-folder"})
+    events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [event["file"] for event in events if event["type"] == "progress" and "file" in event] == [name for name, _, _ in files]
+    assert events[-1]["type"] == "done" and events[-1]["total"] == len(files)
+    assert events[-2]["total"] == len(files)  # 略過的 notes.txt 已從預計總數扣除
+
+def test_drive_downloads_are_bounded_and_released_on_early_exit(corpus, monkeypatch):
+    drive = benchmark.FakeDriveService(0.01, 0.0, 5)
+    drive.load(corpus(10))
+    started = []; opened = []
+
+    def download(service, file_id, file_name):
+        started.append(file_id); upload = drive.download(service, file_id, file_name); opened.append(upload)
+        return upload
+    monkeypatch.setattr(app1, "get_drive_service", lambda: drive)
+    monkeypatch.setattr(app1, "download_file_by_id", download)
+    downloads = app1.iter_drive_downloads(drive.listing, max_pending=2)
+    first = next(downloads)
+    assert first.filename == drive.listing[0]["name"]
+    time.sleep(0.1)
+    assert len(started) <= 3  # 呼叫端還沒取用時，下載中 / 待取用的檔案不超過 max_pending
+    # 提前結束時，已下載但還沒取用的檔案由 iter_drive_downloads 釋放
+    downloads.close(); first.close()
+    assert opened and all(upload._refs == 0 for upload in opened)
@@ -0,0 +1,106 @@
+"""費用報支彙加：向量化版本與舊版 (dict 分組 + 排序) 在隨機資料上的輸出完全相同；無法解析的金額視為 0。"""
+import copy
+import random
+
+import pytest
+
+import app1
+
+def legacy_aggregate(results: list) -> list:
+    """舊版 generate_expense_report 的分組與彙加 (原樣保留作為比對基準)"""
+    groups = {}
+    for row in results:
+        fmt_str = str(row.get("格式", 25))
+        try: fmt = int(fmt_str)
+        except: fmt = 25  # noqa: E722
+        if fmt not in groups: groups[fmt] = []
+        groups[fmt].append(row)
+
+    processed_rows = []
+    for fmt, items in groups.items():
+        small_tax_items = []
+        large_tax_items = []
+        for item in items:
+            try: tax = int(item.get("進項稅額", 0))
+            except: tax = 0  # noqa: E722
+            if tax < 500: small_tax_items.append(item)
+            else: large_tax_items.append(item)
+
+        for item in large_tax_items:
+            item['_is_aggregated'] = "N"; item['_agg_count'] = 0; item['_final_fmt'] = fmt
+            processed_rows.append(item)
+
+        if small_tax_items:
+            sum_tax_exclusive = 0; sum_tax = 0; sum_total = 0
+            small_tax_items.sort(key=lambda x: (
+                int(x.get("進項稅額", 0) if x.get("進項稅額") is not None else 0),
+                int(x.get("未稅金額", 0) if x.get("未稅金額") is not None else 0),
+                x.get("統一發票號碼", "")
+            ), reverse=True)
+            representative = small_tax_items[0].copy()
+            for s_item in small_tax_items:
+                try: v1 = int(s_item.get("未稅金額", 0)); sum_tax_exclusive += v1
+                except: pass  # noqa: E722
+                try: v2 = int(s_item.get("進項稅額", 0)); sum_tax += v2
+                except: pass  # noqa: E722
+                try: v3 = int(s_item.get("金額總計", 0)); sum_total += v3
+                except: pass  # noqa: E722
+            representative["未稅金額"] = sum_tax_exclusive
+            representative["進項稅額"] = sum_tax
+            representative["金額總計"] = sum_total
+            representative['_is_aggregated'] = "Y"
+            representative['_agg_count'] = len(small_tax_items)
+            if fmt == 21: representative['_final_fmt'] = 26
+            elif fmt == 22: representative['_final_fmt'] = 27
+            else: representative['_final_fmt'] = fmt
+            processed_rows.append(representative)
+    return processed_rows
+
+def random_rows(rng: random.Random, count: int) -> list:
+    """稅額集中在 500 上下、發票號碼與金額只有少數幾種，讓代表筆的比較常出現同值"""
+    rows = []
+    for index in range(count):
+        tax = rng.choice([0, 1, 25, 499, 500, 501, rng.randint(0, 2000)])
+        untaxed = rng.choice([tax * 20, 1000, rng.randint(0, 40000)])
+        rows.append({
+            "統一發票號碼": rng.choice(["AB00000001", "AB00000002", "ZZ99999999", f"CD{index:08d}", ""]),
+            "格式": rng.choice([21, 22, 25, "21", "22", "25", 26, "abc"]),
+            "交易日期": f"2025-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+            "賣方統一編號": rng.choice(["28080623", "04595257"]), "賣方名稱": f"公司{index}",
+            "未稅金額": rng.choice([untaxed, str(untaxed)]), "進項稅額": rng.choice([tax, str(tax)]),
+            "金額總計": rng.choice([untaxed + tax, str(untaxed + tax)]),
+            "來源檔案": f"file{index}.png",
+        })
+    return rows
+
+@pytest.mark.parametrize("seed", range(30))
+def test_matches_legacy_aggregation(seed):
+    rng = random.Random(seed)
+    rows = random_rows(rng, rng.choice([1, 2, 5, 40, 300]))
+    expected = legacy_aggregate(copy.deepcopy(rows))
+    actual = app1.aggregate_expense_rows(rows)
+    assert actual == expected
+    assert [app1.expense_row_values(row) for row in actual] == [app1.expense_row_values(row) for row in expected]
+
+def test_unparseable_amounts_count_as_zero():
+    # 舊版排序時對無法解析的金額呼叫 int() 會直接拋出例外；現在視為 0
+    rows = [{"統一發票號碼": "AB00000001", "格式": 21, "未稅金額": "abc", "進項稅額": "", "金額總計": "1,050"},
+            {"統一發票號碼": "AB00000002", "格式": 21, "未稅金額": 100, "進項稅額": 5, "金額總計": 105},
+            {"統一發票號碼": "AB00000003", "格式": 21, "未稅金額": 12000, "進項稅額": "n/a", "金額總計": 12600}]
+    with pytest.raises(ValueError):
+        legacy_aggregate(copy.deepcopy(rows))
+    [aggregated] = app1.aggregate_expense_rows(rows)
+    assert aggregated["統一發票號碼"] == "AB00000002"  # 其餘兩筆稅額視為 0，代表筆為稅額最大者
+    assert (aggregated["未稅金額"], aggregated["進項稅額"], aggregated["金額總計"]) == (12100, 5, 12705)
+    assert (aggregated["_is_aggregated"], aggregated["_agg_count"], aggregated["_final_fmt"]) == ("Y", 3, 26)
+
+def test_expense_report_route_writes_aggregated_rows(client):
+    xlrd = pytest.importorskip("xlrd")  # 只用來讀回 .xls，執行環境不需要
+    rows = random_rows(random.Random(99), 50)
+    response = client.post("/generate_expense_report", json={"results": rows, "include_duplicates": True})
+    assert response.status_code == 200
+    sheet = xlrd.open_workbook(file_contents=response.data).sheet_by_name("ExpenseReport")
+    expected = legacy_aggregate(copy.deepcopy(rows))
+    assert sheet.nrows == len(expected) + 1
+    assert [sheet.cell_value(r, 3) for r in range(1, sheet.nrows)] == [row["統一發票號碼"] for row in expected]
+    assert [int(sheet.cell_value(r, 10)) for r in range(1, sheet.nrows)] == [int(row["進項稅額"]) for row in expected]
@@ -0,0 +1,66 @@
+"""多圖批次模式：依 image_index 把結果分回每張圖片 / 每一頁，回應無法對應時改為逐張辨識。"""
+import io
+import json
+
+import app1
+import benchmark
+
+class ScriptedGemini:
+    """依序回傳預先寫好的回應 (receipts 串列)，並記錄每次請求的圖片數"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses); self.image_counts = []
+
+    def generate_content(self, parts):
+        self.image_counts.append(sum(1 for part in parts if isinstance(part, dict)))
+        return benchmark.FakeGeminiResponse(json.dumps({"receipts": self.responses.pop(0)}))
+
+def image_bytes(corpus, count):
+    return [data for _, data, _ in corpus(count)]
+
+def test_batch_response_is_split_by_image_index(corpus, monkeypatch):
+    images = image_bytes(corpus, 3)
+    # 回應順序打亂、第 1 張有兩張發票、第 2 張沒有發票
+    model = ScriptedGemini([{"invoice_number": "B", "image_index": 0}, {"invoice_number": "A", "image_index": "0"},
+                            {"invoice_number": "C", "image_index": 2}])
+    monkeypatch.setattr(app1, "_gemini_model", model)
+    per_image = app1.extract_data_with_gemini_vision_batch([(data, "image/png") for data in images])
+    assert per_image == [[{"invoice_number": "B"}, {"invoice_number": "A"}], [], [{"invoice_number": "C"}]]
+    assert model.image_counts == [3]
+
+def test_batch_without_valid_image_index_falls_back_to_single_images(corpus, monkeypatch, sellers):
+    images = image_bytes(corpus, 2)
+    bad_batch = [{"invoice_number": "A", "image_index": 5}]
+    monkeypatch.setattr(app1, "_gemini_model", ScriptedGemini(bad_batch))
+    assert app1.extract_data_with_gemini_vision_batch([(data, "image/png") for data in images]) is None
+    model = ScriptedGemini(bad_batch, [benchmark.make_receipt(images[0], sellers)], [benchmark.make_receipt(images[1], sellers)])
+    monkeypatch.setattr(app1, "_gemini_model", model)
+    futures = [app1.Future() for _ in images]
+    app1.run_gemini_batch([(None, data, "image/png", future) for data, future in zip(images, futures)])
+    assert [future.result()[0]["invoice_number"] for future in futures] == [benchmark.make_receipt(data, sellers)["invoice_number"] for data in images]
+    assert model.image_counts == [2, 1, 1]
+
+def test_batcher_groups_images_and_resolves_each_future(fakes, corpus, sellers):
+    gemini, _, _ = fakes
+    images = image_bytes(corpus, 7)
+    batcher = app1.GeminiBatcher(3, max_wait=0.05)
+    futures = [batcher.submit(None, data, "image/png") for data in images]
+    results = [future.result(timeout=5) for future in futures]
+    assert results == [[benchmark.make_receipt(data, sellers)] for data in images]
+    assert gemini.calls == 3 and gemini.images == 7  # 3 + 3 + 等待逾時送出的最後 1 張
+
+def test_batched_processing_matches_single_image_results(fakes, corpus, client, monkeypatch, tmp_path):
+    gemini, _, _ = fakes
+    files = corpus(3) + corpus(2, pdf_ratio=1.0, pdf_pages=3)
+
+    def process(batch):
+        # 每次使用新的辨識快取，兩種模式都實際呼叫 Gemini
+        monkeypatch.setattr(app1, "ocr_cache", app1.OcrResultCache(str(tmp_path / f"ocr_{batch}.db"), 100))
+        data = {"receipt_image": [(io.BytesIO(content), name) for name, content, _ in files], "gemini_batch": str(batch)}
+        body = client.post("/process_image", data=data, content_type="multipart/form-data").get_json()
+        return [(r["來源檔案"], r["統一發票號碼"], r["金額總計"]) for r in body["results"]]
+
+    single = process(0); single_calls = gemini.calls
+    batched = process(4)
+    assert batched == single and len(single) == 9  # 每個檔案 / 每一頁都拿回自己的結果
+    assert gemini.calls - single_calls < single_calls
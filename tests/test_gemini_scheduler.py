@@ -0,0 +1,98 @@
+"""Gemini 排程：依優先順序取得額度、429 暫停整個排程、可重試錯誤的指數退避與最終失敗。"""
+import json
+import threading
+import time
+
+import pytest
+
+import app1
+import benchmark
+
+def test_waiting_requests_are_served_by_priority():
+    scheduler = app1.GeminiScheduler(rpm=600, tpm=0)  # 每 0.1 秒補 1 次額度
+    scheduler._requests = 0.0
+    order = []
+
+    def request(name, priority):
+        scheduler.acquire(1, priority); order.append(name)
+
+    threads = [threading.Thread(target=request, args=(f"bulk{i}", app1.GEMINI_PRIORITY_BULK)) for i in range(2)]
+    threads.append(threading.Thread(target=request, args=("drive", app1.GEMINI_PRIORITY_DRIVE)))
+    threads += [threading.Thread(target=request, args=(f"web{i}", app1.GEMINI_PRIORITY_INTERACTIVE)) for i in range(2)]
+    for thread in threads: thread.start(); time.sleep(0.01)
+    for thread in threads: thread.join()
+    # 先到的背景工作也要讓給之後才到的即時請求；同優先順序依到達順序
+    assert order == ["web0", "web1", "drive", "bulk0", "bulk1"]
+
+def test_token_budget_and_settle_delay_requests():
+    scheduler = app1.GeminiScheduler(rpm=0, tpm=6000)  # 每秒補 100 tokens
+    started = time.monotonic()
+    scheduler.acquire(5000); scheduler.settle(5000, 6000)  # 實際用量較多，bucket 變成 0
+    scheduler.acquire(20)
+    assert 0.15 <= time.monotonic() - started < 1.0
+
+def test_pause_blocks_every_request():
+    scheduler = app1.GeminiScheduler(rpm=0, tpm=0)
+    scheduler.pause(0.2)
+    started = time.monotonic(); scheduler.acquire(1)
+    assert time.monotonic() - started >= 0.19
+
+def test_budget_split_keeps_unlimited_and_minimum_one():
+    assert app1.gemini_budget(0, 0.5) == 0
+    assert app1.gemini_budget(100, 0.25) == 25
+    assert app1.gemini_budget(2, 0.1) == 1
+
+def test_backoff_delay_uses_full_jitter_within_cap(monkeypatch):
+    monkeypatch.setattr(app1, "GEMINI_BACKOFF_BASE", 1.0); monkeypatch.setattr(app1, "GEMINI_BACKOFF_MAX", 8.0)
+    for attempt, cap in ((0, 1.0), (2, 4.0), (5, 8.0)):
+        delays = [app1.gemini_backoff_delay(attempt) for _ in range(200)]
+        assert all(0 <= delay <= cap for delay in delays) and max(delays) > cap / 2
+
+class FlakyGemini:
+    """先依序拋出 errors 中的例外，之後回傳固定結果"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors); self.calls = 0
+
+    def generate_content(self, parts):
+        self.calls += 1
+        if self.errors: raise self.errors.pop(0)
+        return benchmark.FakeGeminiResponse(json.dumps({"receipts": [{"invoice_number": "AB12345678"}]}))
+
+@pytest.fixture
+def retries(monkeypatch):
+    """記錄每次重試前的退避 (不實際等待)，並換上不限額度的獨立排程器"""
+    delays = []
+    monkeypatch.setattr(app1, "gemini_backoff_delay", lambda attempt: delays.append(attempt) or 0.0)
+    monkeypatch.setattr(app1, "gemini_scheduler", app1.GeminiScheduler(0, 0))
+    monkeypatch.setattr(app1, "GEMINI_MAX_RETRIES", 3)
+    return delays
+
+def test_retryable_errors_are_retried_with_backoff(retries, monkeypatch):
+    model = FlakyGemini(benchmark.FakeGeminiError(503), ConnectionError("reset"), ValueError("bad json"))
+    monkeypatch.setattr(app1, "_gemini_model", model)
+    assert app1.extract_data_with_gemini_vision(b"image", "image/png") == [{"invoice_number": "AB12345678"}]
+    assert model.calls == 4 and retries == [0, 1, 2]
+
+def test_rate_limit_pauses_whole_scheduler(retries, monkeypatch):
+    monkeypatch.setattr(app1, "gemini_backoff_delay", lambda attempt: 0.2)
+    monkeypatch.setattr(app1, "_gemini_model", FlakyGemini(benchmark.FakeGeminiError(429)))
+    started = time.monotonic()
+    app1.extract_data_with_gemini_vision(b"image", "image/png")
+    assert app1.gemini_scheduler._paused_until > started
+    # 其他執行緒的請求也要等暫停結束
+    other_started = time.monotonic(); app1.gemini_scheduler.pause(0.1); app1.gemini_scheduler.acquire(1)
+    assert time.monotonic() - other_started >= 0.09
+
+def test_non_retryable_and_exhausted_errors_raise(retries, monkeypatch):
+    model = FlakyGemini(benchmark.FakeGeminiError(400))
+    monkeypatch.setattr(app1, "_gemini_model", model)
+    with pytest.raises(app1.GeminiExtractionError):
+        app1.extract_data_with_gemini_vision(b"image", "image/png")
+    assert model.calls == 1 and retries == []
+
+    model = FlakyGemini(*[benchmark.FakeGeminiError(503)] * 10)
+    monkeypatch.setattr(app1, "_gemini_model", model)
+    with pytest.raises(app1.GeminiExtractionError):
+        app1.extract_data_with_gemini_vision(b"image", "image/png")
+    assert model.calls == 4 and retries == [0, 1, 2]
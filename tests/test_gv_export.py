@@ -0,0 +1,82 @@
+"""GV 匯出：超過單張上限時換到 PURDATA2+ 工作表或拆成多個 .xls (zip)，CSV / xlsx 串流輸出的內容與格式。"""
+import csv
+import io
+import zipfile
+
+import openpyxl
+import pytest
+
+import app1
+
+def gv_results(count: int) -> list:
+    return [{"統一發票號碼": f"AB{index:08d}", "格式": 21 if index % 2 else 22, "交易日期": "2025-05-27",
+             "賣方統一編號": "28080623", "賣方名稱": f"測試公司{index}", "未稅金額": 100 * index, "進項稅額": 5 * index,
+             "金額總計": 105 * index} for index in range(1, count + 1)]
+
+def export(client, export_format: str, results: list, **extra):
+    body = dict(extra, results=results, include_duplicates=True, account_payable_code="AP-1")
+    response = client.post(f"/generate_gv?format={export_format}", json=body, buffered=True)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response
+
+@pytest.fixture
+def small_sheets(monkeypatch):
+    """每張工作表 3 列 (xlsx 含表頭 4 列)，串流每 2 列送出一次"""
+    monkeypatch.setattr(app1, "GV_ROWS_PER_SHEET", 3)
+    monkeypatch.setattr(app1, "XLSX_MAX_ROWS", 4)
+    monkeypatch.setattr(app1, "EXPORT_CHUNK_ROWS", 2)
+
+def xls_sheets(data: bytes) -> dict:
+    xlrd = pytest.importorskip("xlrd")  # 只用來讀回 .xls，執行環境不需要
+    book = xlrd.open_workbook(file_contents=data)
+    return {sheet.name: [sheet.row_values(r) for r in range(sheet.nrows)] for sheet in book.sheets()}
+
+def test_xls_rolls_over_to_purdata_sheets(client, small_sheets):
+    sheets = xls_sheets(export(client, "xls", gv_results(8)).data)
+    assert list(sheets) == ["PURDATA", "PURDATA2", "PURDATA3"]
+    assert all(rows[0] == app1.GV_HEADER_ROW for rows in sheets.values())
+    assert [len(rows) - 1 for rows in sheets.values()] == [3, 3, 2]
+    assert [row[2] for rows in sheets.values() for row in rows[1:]] == [f"AB{index:08d}" for index in range(1, 9)]
+
+def test_xls_split_files_zips_one_workbook_per_part(client, small_sheets):
+    response = export(client, "xls", gv_results(7), split="files")
+    assert response.mimetype == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+        assert zf.namelist() == ["GV_output_1.xls", "GV_output_2.xls", "GV_output_3.xls"]
+        parts = [xls_sheets(zf.read(name)) for name in zf.namelist()]
+    assert all(list(part) == ["PURDATA"] for part in parts)
+    assert [len(part["PURDATA"]) - 1 for part in parts] == [3, 3, 1]
+    # 序號跨檔案連續
+    assert [row[0] for part in parts for row in part["PURDATA"][1:]] == [str(index) for index in range(1, 8)]
+
+def test_xls_within_limit_stays_single_sheet(client, small_sheets):
+    assert list(xls_sheets(export(client, "xls", gv_results(3), split="files").data)) == ["PURDATA"]
+
+def test_csv_stream_has_bom_header_and_all_rows(client, small_sheets):
+    results = gv_results(5)
+    data = export(client, "csv", results).data
+    assert data.startswith("\ufeff".encode("utf-8"))
+    rows = list(csv.reader(io.StringIO(data.decode("utf-8-sig"))))
+    assert rows[0] == app1.GV_HEADER_ROW
+    assert rows[1:] == [["" if v is None else str(v) for v in app1.gv_row_values(i, r, "AP-1")] for i, r in enumerate(results)]
+
+def test_csv_chunks_split_every_export_chunk_rows(small_sheets):
+    chunks = list(app1.iter_csv_chunks(["a", "b"], ([i, None] for i in range(5))))
+    assert len(chunks) == 3
+    assert b"".join(chunks).decode("utf-8") == "\ufeffa,b\r\n0,\r\n1,\r\n2,\r\n3,\r\n4,\r\n"
+
+def test_xlsx_stream_parses_and_rolls_over(client, small_sheets):
+    results = gv_results(7)
+    book = openpyxl.load_workbook(io.BytesIO(export(client, "xlsx", results).data), read_only=True)
+    assert book.sheetnames == ["PURDATA", "PURDATA2", "PURDATA3"]
+    sheets = [list(book[name].iter_rows(values_only=True)) for name in book.sheetnames]
+    assert all(list(rows[0]) == app1.GV_HEADER_ROW for rows in sheets)
+    assert [len(rows) - 1 for rows in sheets] == [3, 3, 1]
+    data_rows = [row for rows in sheets for row in rows[1:]]
+    assert [row[2] for row in data_rows] == [r["統一發票號碼"] for r in results]
+    assert data_rows[0][15:18] == (100, 5, 105) and data_rows[0][22] == "AP-1"  # 金額為數字儲存格
+
+def test_xlsx_empty_rows_still_valid_workbook(small_sheets):
+    data = b"".join(app1.iter_xlsx_chunks("PURDATA", app1.GV_HEADER_ROW, iter(())))
+    book = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+    assert book.sheetnames == ["PURDATA"] and list(book["PURDATA"].iter_rows(values_only=True)) == [tuple(app1.GV_HEADER_ROW)]
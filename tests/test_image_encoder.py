@@ -0,0 +1,95 @@
+"""送出前的影像編碼：縮到長邊上限、依設定選擇格式、幾乎無彩色時轉灰階、超過大小上限時逐步縮小；影像設定納入辨識快取鍵。"""
+import io
+
+import fitz
+import numpy as np
+import pytest
+
+import app1
+
+def make_png(width: int, height: int, gray: bool = False, noise: int = 24, seed: int = 0) -> bytes:
+    """左右兩塊不同顏色的底色加上雜訊 (gray=True 時三個通道相同)"""
+    rng = np.random.default_rng(seed)
+    pixels = np.zeros((height, width, 3), dtype=np.int16)
+    pixels[:, :width // 2] = (200, 40, 40); pixels[:, width // 2:] = (40, 60, 200)
+    pixels += rng.integers(-noise, noise + 1, (height, width, 1 if gray else 3), dtype=np.int16)
+    if gray: pixels[:] = pixels.mean(axis=2, keepdims=True).astype(np.int16)
+    samples = np.clip(pixels, 0, 255).astype(np.uint8).tobytes()
+    return fitz.Pixmap(fitz.csRGB, width, height, samples, 0).tobytes("png")
+
+def decoded(payload: bytes) -> fitz.Pixmap:
+    return fitz.Pixmap(payload)
+
+def first_page(image_bytes: bytes):
+    """開啟成單頁文件，並回傳原始像素大小的倍率 (頁面大小依圖片 DPI 換算)"""
+    doc = fitz.open(stream=image_bytes, filetype="png")
+    page = doc[0]; info = page.get_image_info()[0]
+    return doc, page, max(info["width"], info["height"]) / max(page.rect.width, page.rect.height)
+
+def test_large_photo_is_downscaled_and_shrinks(monkeypatch):
+    monkeypatch.setattr(app1, "GEMINI_IMAGE_FORMAT", "auto")
+    original = make_png(3000, 2000)
+    payload, mime_type = app1.prepare_upload_image(original, "image/png")
+    pix = decoded(payload)
+    assert mime_type in ("image/jpeg", "image/png") and len(payload) < len(original)
+    assert max(pix.width, pix.height) <= app1.GEMINI_IMAGE_LONG_EDGE and pix.width / pix.height == pytest.approx(1.5, rel=0.01)
+
+@pytest.mark.parametrize("image_format, mime_type", [("jpeg", "image/jpeg"), ("png", "image/png")])
+def test_format_setting_selects_encoder(monkeypatch, image_format, mime_type):
+    monkeypatch.setattr(app1, "GEMINI_IMAGE_FORMAT", image_format)
+    doc, page, zoom = first_page(make_png(800, 600))
+    try: payload, payload_mime = app1.encode_page_image(page, zoom)
+    finally: doc.close()
+    assert payload_mime == mime_type
+    assert payload.startswith(b"\xff\xd8" if image_format == "jpeg" else b"\x89PNG")
+
+def test_auto_picks_smaller_encoding(monkeypatch):
+    monkeypatch.setattr(app1, "GEMINI_IMAGE_FORMAT", "auto")
+    doc, page, zoom = first_page(make_png(800, 600))
+    try:
+        payload, _ = app1.encode_page_image(page, zoom)
+        sizes = []
+        for image_format in ("jpeg", "png"):
+            monkeypatch.setattr(app1, "GEMINI_IMAGE_FORMAT", image_format); sizes.append(len(app1.encode_page_image(page, zoom)[0]))
+    finally: doc.close()
+    assert len(payload) == min(sizes)
+
+def test_gray_images_are_sent_in_grayscale(monkeypatch):
+    monkeypatch.setattr(app1, "GEMINI_IMAGE_FORMAT", "png")
+    for gray, channels in ((True, 1), (False, 3)):
+        doc, page, zoom = first_page(make_png(400, 300, gray=gray))
+        try: payload, _ = app1.encode_page_image(page, zoom)
+        finally: doc.close()
+        assert decoded(payload).n == channels
+
+def test_payload_over_budget_is_scaled_down(monkeypatch):
+    monkeypatch.setattr(app1, "GEMINI_IMAGE_FORMAT", "png"); monkeypatch.setattr(app1, "GEMINI_IMAGE_MIN_LONG_EDGE", 200)
+    doc, page, zoom = first_page(make_png(1600, 1200, noise=80))
+    try:
+        unlimited, _ = app1.encode_page_image(page, zoom, 1600, 10 ** 9)
+        payload, _ = app1.encode_page_image(page, zoom, 1600, len(unlimited) // 4)
+    finally: doc.close()
+    assert len(payload) <= len(unlimited) // 4 and decoded(payload).width < 1600
+    assert decoded(unlimited).width == 1600
+
+def test_original_format_and_undecodable_images_pass_through(monkeypatch):
+    original = make_png(300, 200)
+    monkeypatch.setattr(app1, "GEMINI_IMAGE_FORMAT", "original")
+    assert app1.prepare_upload_image(original, "image/png") == (original, "image/png")
+    monkeypatch.setattr(app1, "GEMINI_IMAGE_FORMAT", "auto")
+    assert app1.prepare_upload_image(b"not an image", "image/jpeg") == (b"not an image", "image/jpeg")
+
+def test_image_settings_are_part_of_cache_key(fakes, corpus, client, monkeypatch):
+    gemini, _, _ = fakes
+    files = corpus(2)
+
+    def process():
+        data = {"receipt_image": [(io.BytesIO(content), name) for name, content, _ in files]}
+        assert client.post("/process_image", data=data, content_type="multipart/form-data").status_code == 200
+
+    process(); process()
+    assert gemini.calls == 2  # 第二次命中快取
+    # 調整影像設定後送出的影像不同，不沿用舊設定的辨識結果
+    monkeypatch.setattr(app1, "OCR_IMAGE_SETTINGS", app1.OCR_IMAGE_SETTINGS + ":changed")
+    process()
+    assert gemini.calls == 4
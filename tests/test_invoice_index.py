@@ -0,0 +1,65 @@
+"""發票索引：匯出後才標記跨批次重複、匯出時排除重複、移除匯出紀錄、中斷的串流匯出不記錄。"""
+import io
+
+import app1
+
+def process(client, files):
+    data = {"receipt_image": [(io.BytesIO(content), name) for name, content, _ in files]}
+    return client.post("/process_image", data=data, content_type="multipart/form-data").get_json()
+
+def export_gv(client, result_set_id, **extra):
+    # 串流匯出在最後一段送出後才寫入發票索引，測試需讀完整個回應
+    return client.post("/generate_gv?format=csv", json=dict(extra, result_set_id=result_set_id), buffered=True)
+
+def test_duplicates_flagged_only_after_export(fakes, corpus, client):
+    files = corpus(3)
+    first = process(client, files)
+    second = process(client, files)
+    # 只辨識、尚未匯出的批次不算重複
+    assert not any(app1.INVOICE_DUPLICATE_FIELD in r for r in first["results"] + second["results"])
+
+    response = export_gv(client, first["result_set_id"])
+    assert response.status_code == 200 and response.get_data(as_text=True).count("\n") == len(files) + 1
+    assert export_gv(client, first["result_set_id"]).status_code == 200  # 同一結果集重新匯出不算重複
+
+    third = process(client, files)
+    assert all(app1.INVOICE_DUPLICATE_FIELD in r for r in third["results"])
+    # 其他結果集已匯出的發票在匯出時排除 (以匯出當下的索引為準，包含辨識時尚未匯出的 second)
+    response = export_gv(client, second["result_set_id"])
+    assert response.status_code == 409 and response.headers["X-Excluded-Duplicates"] == str(len(files))
+    assert export_gv(client, second["result_set_id"], include_duplicates=True).status_code == 200
+
+def test_forget_batch_allows_export_again(fakes, corpus, client):
+    files = corpus(2)
+    first = process(client, files); second = process(client, files + corpus(1))
+    assert export_gv(client, first["result_set_id"]).status_code == 200
+    response = export_gv(client, second["result_set_id"])
+    assert response.status_code == 200 and response.headers["X-Excluded-Duplicates"] == "2"
+
+    forgotten = client.delete(f"/invoice_index/{first['result_set_id']}").get_json()
+    assert forgotten == {"batch_id": first["result_set_id"], "removed": 2}
+    assert not any(app1.INVOICE_DUPLICATE_FIELD in r for r in process(client, files)["results"])
+    response = export_gv(client, second["result_set_id"], deleted=[2])
+    assert response.status_code == 200 and "X-Excluded-Duplicates" not in response.headers
+
+def test_interrupted_stream_export_is_not_recorded(fakes, corpus, client):
+    files = corpus(2)
+    first = process(client, files)
+    response = client.post("/generate_gv?format=csv", json={"result_set_id": first["result_set_id"]})
+    response.close()  # 下載中斷，沒有送完最後一段
+    assert not any(app1.INVOICE_DUPLICATE_FIELD in r for r in process(client, files)["results"])
+
+def test_results_body_exports_of_same_batch_are_not_duplicates(fakes, corpus, client):
+    # 結果集過期時前端改送整批 results：同一批先匯出 GV 再匯出費用報支檔不應被當成重複
+    rows = process(client, corpus(3))["results"]
+    response = client.post("/generate_gv", json={"results": rows}, buffered=True)
+    assert response.status_code == 200
+    assert client.post("/generate_expense_report", json={"results": rows}, buffered=True).status_code == 200
+    # 前端帶回 X-Export-Batch-Id 時，改過內容的同一批也不算重複
+    edited = [dict(row, 備註="改過") for row in rows[:2]]
+    response = client.post("/generate_expense_report", json={"results": edited, "batch_id": response.headers["X-Export-Batch-Id"]}, buffered=True)
+    assert response.status_code == 200 and "X-Excluded-Duplicates" not in response.headers
+    # 其他批次 (不同的 results) 仍會排除已匯出的發票
+    other = process(client, corpus(1))["results"]
+    response = client.post("/generate_gv", json={"results": rows[:1] + other}, buffered=True)
+    assert response.status_code == 200 and response.headers["X-Excluded-Duplicates"] == "1"
@@ -0,0 +1,58 @@
+"""背景工作佇列：完整執行、心跳避免慢工作被接手、接手後拒絕舊工作程序的寫入與重複寫入。"""
+import threading
+import time
+
+import pytest
+
+import app1
+
+def test_job_runs_to_completion(fakes, corpus, monkeypatch, tmp_path):
+    queue = app1.JobQueue(str(tmp_path / "jobs.db"), stale_seconds=60)
+    monkeypatch.setattr(app1, "job_queue", queue)
+    files = corpus(4, pdf_ratio=0.5, pdf_pages=2)
+    job_id = queue.submit("upload", {"result_set_id": "job-set"}, [(name, data) for name, data, _ in files])
+    job = queue.claim("worker-1")
+    app1.execute_job(job)
+    queue.finish(job_id, job["token"])
+    status = queue.get(job_id)
+    assert (status["status"], status["total"], status["done"]) == ("done", 4, 4)
+    assert [r["來源檔案"] for r in status["results"]] == [r["來源檔案"] for r in app1.result_store.get("job-set")]
+
+def test_job_heartbeat_prevents_reclaim_of_slow_job(fakes, corpus, monkeypatch, tmp_path):
+    gemini, _, _ = fakes
+    gemini.latency = 1.5
+    queue = app1.JobQueue(str(tmp_path / "jobs.db"), stale_seconds=1)
+    monkeypatch.setattr(app1, "job_queue", queue)
+    start_heartbeat = app1.start_job_heartbeat
+    monkeypatch.setattr(app1, "start_job_heartbeat", lambda job_id, token: start_heartbeat(job_id, token, interval=0.2))
+    job_id = queue.submit("upload", {}, [(name, data) for name, data, _ in corpus(1)])
+    job = queue.claim("worker-1")
+    runner = threading.Thread(target=app1.execute_job, args=(job,)); runner.start()
+    time.sleep(1.2)
+    assert queue.claim("worker-2") is None  # 還在辨識中，沒有被誤判為中斷
+    runner.join()
+    queue.finish(job_id, job["token"])
+    assert queue.get(job_id)["done"] == 1
+
+def test_job_reclaim_rejects_stale_worker_and_append_is_idempotent(tmp_path):
+    queue = app1.JobQueue(str(tmp_path / "jobs.db"), stale_seconds=0.05)
+    job_id = queue.submit("upload", {}, [("a.png", b"a"), ("b.png", b"b")])
+    first = queue.claim("worker-1")
+    assert queue.append_results(job_id, first["token"], 0, [{"來源檔案": "a.png"}])
+    assert not queue.append_results(job_id, first["token"], 0, [{"來源檔案": "a.png"}])
+    assert queue.get(job_id)["done"] == 1 and len(queue.get(job_id)["results"]) == 1
+
+    time.sleep(0.1)
+    second = queue.claim("worker-2")
+    assert second["id"] == job_id and second["token"] != first["token"]
+    assert queue.get(job_id)["done"] == 0 and queue.get(job_id)["results"] == []
+    with pytest.raises(app1.JobClaimLostError):
+        queue.append_results(job_id, first["token"], 1, [{"來源檔案": "b.png"}])
+    assert not queue.heartbeat(job_id, first["token"]) and queue.heartbeat(job_id, second["token"])
+
+    for index, name in enumerate(["a.png", "b.png", "b.png"]):
+        queue.append_results(job_id, second["token"], min(index, 1), [{"來源檔案": name}])
+    queue.finish(job_id, second["token"])
+    status = queue.get(job_id)
+    assert (status["status"], status["done"]) == ("done", 2)
+    assert [r["來源檔案"] for r in status["results"]] == ["a.png", "b.png"]
@@ -0,0 +1,44 @@
+"""辨識結果快取：超過上限淘汰最久未使用的資料、命中 / 未命中計數、重新上傳相同內容時不再呼叫 Gemini。"""
+import io
+import time
+
+import app1
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = app1.OcrResultCache(str(tmp_path / "ocr_cache.db"), max_entries=3)
+    for key in ("a", "b", "c"):
+        cache.put(key, [{"invoice_number": key}]); time.sleep(0.01)
+    assert cache.get("a") == [{"invoice_number": "a"}]  # 讀取會更新最後使用時間
+    time.sleep(0.01)
+    cache.put("d", [{"invoice_number": "d"}])
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in ("a", "c", "d")] == [[{"invoice_number": key}] for key in ("a", "c", "d")]
+
+def test_counts_hits_and_misses_and_skips_unsettled_results(tmp_path):
+    cache = app1.OcrResultCache(str(tmp_path / "ocr_cache.db"), max_entries=10)
+    cache.put("empty", [])  # 空結果可能是辨識失敗，不快取
+    cache.put(None, [{"invoice_number": "x"}])  # 兩階段辨識的第一階段沒有鍵
+    cache.put("k", [{"invoice_number": "k"}])
+    assert cache.get("empty") is None and cache.get("k") is not None and cache.get("missing") is None
+    assert cache.stats() == {"hits": 1, "misses": 2}
+
+def test_make_key_depends_on_every_part():
+    base = app1.ocr_cache.make_key("image", "abc", "png:1600")
+    assert base == app1.ocr_cache.make_key("image", "abc", "png:1600")
+    assert len({base, app1.ocr_cache.make_key("image", "abd", "png:1600"), app1.ocr_cache.make_key("image", "abc", "jpeg:1600"),
+                app1.ocr_cache.make_key("pdf", "abc", "png:1600")}) == 4
+
+def test_reupload_skips_gemini(fakes, corpus, client):
+    gemini, _, _ = fakes
+    files = corpus(2) + corpus(1, pdf_ratio=1.0, pdf_pages=2)
+
+    def process():
+        data = {"receipt_image": [(io.BytesIO(content), name) for name, content, _ in files]}
+        return client.post("/process_image", data=data, content_type="multipart/form-data").get_json()["results"]
+
+    first = process(); calls = gemini.calls; hits = app1.ocr_cache.stats()["hits"]
+    assert calls >= 4
+    second = process()
+    assert gemini.calls == calls  # 圖片與 PDF 每一頁都命中快取
+    assert app1.ocr_cache.stats()["hits"] - hits == 4
+    assert [(r["統一發票號碼"], r["金額總計"]) for r in second] == [(r["統一發票號碼"], r["金額總計"]) for r in first]
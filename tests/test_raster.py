@@ -0,0 +1,40 @@
+"""PDF 轉圖：程序池逐頁轉圖在名額不足時仍依頁序產生全部頁面，名額最後全部歸還。"""
+import threading
+
+import pytest
+
+import app1
+
+@pytest.fixture(autouse=True)
+def raster_pool(monkeypatch):
+    """測試環境預設不開轉圖子程序；這裡改用 2 個子程序的程序池，測試結束後關閉"""
+    monkeypatch.setattr(app1, "RASTER_MAX_PROCESSES", 2)
+    monkeypatch.setattr(app1, "_raster_pool", None)
+    yield
+    if app1._raster_pool is not None: app1._raster_pool.shutdown()
+
+@pytest.mark.parametrize("slots", [1, 2, 6])
+def test_pool_rasterizes_all_pages_in_order_under_slot_pressure(corpus, monkeypatch, slots):
+    name, data, _ = corpus(1, pdf_ratio=1.0, pdf_pages=12)[0]
+    semaphore = threading.BoundedSemaphore(slots)
+    monkeypatch.setattr(app1, "raster_page_slots", semaphore)
+    upload = app1.SpooledUpload.from_bytes(name, data)
+    try:
+        pages = []
+        for page_num, img_bytes, _ in app1.iter_pdf_page_images(upload, list(range(12)), dpi=36):
+            assert img_bytes
+            pages.append(page_num); semaphore.release()
+    finally:
+        upload.close()
+    assert pages == list(range(12))
+    assert all(semaphore.acquire(blocking=False) for _ in range(slots))  # 名額全數歸還
+
+def test_pool_releases_slots_when_consumer_stops_early(corpus, monkeypatch):
+    name, data, _ = corpus(1, pdf_ratio=1.0, pdf_pages=8)[0]
+    semaphore = threading.BoundedSemaphore(3)
+    monkeypatch.setattr(app1, "raster_page_slots", semaphore)
+    upload = app1.SpooledUpload.from_bytes(name, data)
+    pages = app1.iter_pdf_page_images(upload, list(range(8)), dpi=36)
+    assert next(pages)[0] == 0
+    semaphore.release(); pages.close(); upload.close()
+    assert all(semaphore.acquire(blocking=False) for _ in range(3))
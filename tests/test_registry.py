@@ -0,0 +1,119 @@
+"""稅籍查詢：以本機 http.server 假扮財政部 / g0v，測試連線重複使用、斷路器 (開路、冷卻略過、半開試探、復原) 與對沖查詢。"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app1
+
+class StubRegistry:
+    """每個來源的行為：ok (回傳資料)、missing (404)、error (503)；delay 為回應前等待秒數"""
+
+    def __init__(self):
+        self.modes = {"fia": "ok", "g0v": "ok"}; self.delays = {"fia": 0.0, "g0v": 0.0}
+        self.calls = {"fia": 0, "g0v": 0}; self.ports = {"fia": set(), "g0v": set()}
+        self.lock = threading.Lock()
+
+    def respond(self, handler):
+        upstream, vat = handler.path.strip("/").split("/")
+        with self.lock:
+            self.calls[upstream] += 1; self.ports[upstream].add(handler.client_address[1])
+            mode = self.modes[upstream]; delay = self.delays[upstream]
+        time.sleep(delay)
+        if mode == "ok" and upstream == "fia": status, body = 200, {"businessNm": f"財政部公司ＡＢＣ{vat[-3:]}", "businessAddress": "臺北市測試路１號"}
+        elif mode == "ok": status, body = 200, {"data": {"財政部": {"營業人名稱": f"g0v公司{vat[-3:]}"}}}
+        elif mode == "missing": status, body = 404, {}
+        else: status, body = 503, {}
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json"); handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers(); handler.wfile.write(payload)
+
+@pytest.fixture
+def registry(monkeypatch):
+    """啟動本機假稅籍伺服器，並換上獨立的斷路器 (門檻 3 次、冷卻 0.3 秒)"""
+    stub = StubRegistry()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive，才能確認同一執行緒重複使用連線
+        def do_GET(self): stub.respond(self)
+        def log_message(self, *args): pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler); server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(app1, "FIA_API_URL", base + "/fia/{vat}")
+    monkeypatch.setattr(app1, "G0V_API_URL", base + "/g0v/{vat}")
+    monkeypatch.setattr(app1, "fia_breaker", app1.CircuitBreaker("財政部 API", 3, 0.3, "fia"))
+    monkeypatch.setattr(app1, "g0v_breaker", app1.CircuitBreaker("g0v API", 3, 0.3, "g0v"))
+    monkeypatch.setattr(app1, "REGISTRY_HEDGE_DELAY", 0.0)
+    yield stub
+    server.shutdown(); server.server_close()
+
+def test_queries_parse_responses_and_reuse_connection(registry):
+    assert app1.query_fia("12345678") == {"name": "財政部公司ABC678", "address": "臺北市測試路1號"}
+    assert app1.query_g0v("12345678") == {"name": "g0v公司678", "address": ""}
+    for _ in range(4): app1.query_fia("12345678")
+    assert registry.calls["fia"] == 5 and len(registry.ports["fia"]) == 1  # 同一執行緒的 Session 保留 keep-alive 連線
+    registry.modes["fia"] = "missing"
+    assert app1.query_fia("12345678") is None
+    registry.modes["fia"] = "error"
+    with pytest.raises(app1.requests.HTTPError):
+        app1.query_fia("12345678")
+
+def test_breaker_opens_skips_during_cooldown_and_recovers(registry):
+    registry.modes["fia"] = "error"
+    for _ in range(3):
+        assert app1.fetch_company_info_from_registry("12345678")["name"] == "g0v公司678"
+    assert registry.calls["fia"] == 3 and app1.fia_breaker.opened_at is not None
+
+    # 開路: 冷卻期間不再連線財政部，直接改查 g0v
+    for _ in range(3): app1.fetch_company_info_from_registry("12345678")
+    assert registry.calls["fia"] == 3 and registry.calls["g0v"] == 6
+
+    # 冷卻結束後只放行一次試探；試探失敗立即再開路
+    time.sleep(0.35)
+    app1.fetch_company_info_from_registry("12345678"); app1.fetch_company_info_from_registry("12345678")
+    assert registry.calls["fia"] == 4
+
+    # 試探成功後關閉斷路器，之後照常查詢財政部
+    registry.modes["fia"] = "ok"
+    time.sleep(0.35)
+    for _ in range(3):
+        assert app1.fetch_company_info_from_registry("12345678")["name"] == "財政部公司ABC678"
+    assert registry.calls["fia"] == 7 and registry.calls["g0v"] == 8
+    assert (app1.fia_breaker.failures, app1.fia_breaker.opened_at) == (0, None)
+
+def test_breaker_half_open_admits_single_probe():
+    breaker = app1.CircuitBreaker("測試", 2, 0.1, "test")
+    breaker.record_failure(); assert breaker.allow()
+    breaker.record_failure(); assert not breaker.allow()
+    time.sleep(0.15)
+    admitted = []
+    threads = [threading.Thread(target=lambda: admitted.append(breaker.allow())) for _ in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert admitted.count(True) == 1
+
+def test_both_sources_down_returns_not_found(registry):
+    registry.modes.update(fia="error", g0v="missing")
+    assert app1.fetch_company_info_from_registry("12345678") == {"name": app1.COMPANY_NOT_FOUND_NAME, "address": ""}
+
+def test_hedged_lookup_takes_first_valid_answer(registry, monkeypatch):
+    monkeypatch.setattr(app1, "REGISTRY_HEDGE_DELAY", 0.05)
+    # 財政部在對沖延遲內回應: 不查 g0v
+    assert app1.fetch_company_info_from_registry("12345678")["name"] == "財政部公司ABC678"
+    assert registry.calls == {"fia": 1, "g0v": 0}
+
+    # 財政部太慢: 同時查 g0v，採用先回來的有效結果，不等財政部
+    registry.delays["fia"] = 1.0
+    started = time.perf_counter()
+    assert app1.fetch_company_info_from_registry("12345678")["name"] == "g0v公司678"
+    assert time.perf_counter() - started < 0.5 and registry.calls["g0v"] == 1
+
+    # 較快的 g0v 查無資料時，等財政部的有效結果
+    registry.modes["g0v"] = "missing"; registry.delays["fia"] = 0.3
+    assert app1.fetch_company_info_from_registry("12345678")["name"] == "財政部公司ABC678"
+    assert registry.calls["g0v"] == 2
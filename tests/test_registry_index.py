@@ -0,0 +1,48 @@
+"""離線稅籍索引：CSV 匯入 (標題說明列、重複統編、過長名稱) 與 mmap 查詢。"""
+import os
+
+import pytest
+
+import app1
+
+def write_csv(path, rows, title_lines=("財政部全國營業(稅籍)登記資料集", "資料日期: 114/05/01")):
+    lines = list(title_lines) + ["統一編號,營業人名稱,營業地址,資本額"] + [",".join(row) for row in rows]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8-sig")
+    return str(path)
+
+def test_import_and_lookup(tmp_path):
+    long_name = "A" + "測" * 30000  # 超過 64 KB，且 0xFFFF 位元組的位置會切在中文字中間
+    csv_path = write_csv(tmp_path / "registry.csv", [
+        ("28080623", "甲公司", "臺北市中正區1號", "100"),
+        ("04595257", long_name, "高雄市", "0"),
+        ("28080623", "甲公司 (重複)", "新北市", "0"),
+        ("1234567", "統編不足 8 碼", "", ""),
+        ("03251000", "乙公司", "", "")])
+    index_path = str(tmp_path / "registry.bin")
+    assert app1.import_registry_csv(csv_path, index_path) == 3
+    index = app1.RegistryIndex(index_path)
+    assert index.get("28080623") == {"name": "甲公司", "address": "臺北市中正區1號"}  # 重複統編保留第一筆
+    assert index.get("03251000") == {"name": "乙公司", "address": ""}
+    truncated = index.get("04595257")
+    assert truncated["name"] == long_name[:len(truncated["name"])] and len(truncated["name"].encode("utf-8")) <= 0xFFFF
+    assert len(truncated["name"]) == 1 + (0xFFFF - 1) // 3 and truncated["address"] == ""
+    assert index.get("12345678") is None and index.get("1234567") is None
+    # 索引中的每一筆字串都是完整的 UTF-8 (截斷不會切在字元中間)
+    _, mm, _, offsets, lengths, strings_start = index._open()
+    for offset, length in zip(offsets.tolist(), lengths.tolist()):
+        mm[strings_start + offset:strings_start + offset + length].decode("utf-8")
+
+def test_reimport_is_picked_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(app1, "REGISTRY_INDEX_RECHECK_SECONDS", 0)
+    index_path = str(tmp_path / "registry.bin")
+    app1.import_registry_csv(write_csv(tmp_path / "a.csv", [("28080623", "舊名稱", "", "")]), index_path)
+    index = app1.RegistryIndex(index_path)
+    assert index.get("28080623")["name"] == "舊名稱"
+    app1.import_registry_csv(write_csv(tmp_path / "b.csv", [("28080623", "新名稱", "", "")]), index_path)
+    os.utime(index_path, ns=(0, os.stat(index_path).st_mtime_ns + 10 ** 9))
+    assert index.get("28080623")["name"] == "新名稱"
+
+def test_import_rejects_csv_without_header(tmp_path):
+    csv_path = tmp_path / "bad.csv"; csv_path.write_text("vat,name\n28080623,甲公司\n", encoding="utf-8")
+    with pytest.raises(ValueError):
+        app1.import_registry_csv(str(csv_path), str(tmp_path / "bad.bin"))
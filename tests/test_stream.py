@@ -0,0 +1,46 @@
+"""串流輸出：逐檔回傳的順序、首筆結果不等整批送出、/process_image 的完整回應。"""
+import io
+import json
+import time
+
+import app1
+
+def read_stream(entries, **kwargs):
+    """執行 stream_ocr_results，回傳 [(收到的秒數, 事件)]"""
+    started = time.perf_counter(); events = []
+    with app1.app.test_request_context():
+        for chunk in app1.stream_ocr_results(entries, "ndjson", **kwargs):
+            events.append((time.perf_counter() - started, json.loads(chunk)))
+    return events
+
+def uploads(files):
+    return [app1.SpooledUpload.from_bytes(name, data) for name, data, _ in files]
+
+def test_stream_keeps_file_order(fakes, corpus):
+    files = corpus(12, pdf_ratio=0.3, pdf_pages=2)
+    events = read_stream(uploads(files))
+    progress = [event["file"] for _, event in events if event["type"] == "progress" and "file" in event]
+    assert progress == [name for name, _, _ in files]
+    sources = [event["result"]["來源檔案"] for _, event in events if event["type"] == "result"]
+    assert sources == sorted(sources, key=[name for name, _, _ in files].index)
+    done = events[-1][1]
+    assert done["type"] == "done" and done["total"] == len(files) and done["count"] == len(sources)
+    assert app1.result_store.get(done["result_set_id"]) is not None
+
+def test_stream_first_result_does_not_wait_for_whole_batch(fakes, corpus):
+    gemini, _, _ = fakes
+    gemini.latency = 0.2
+    # 圖片在前、長 PDF 在後：PDF 頁面受 RASTER_MAX_PAGES_IN_MEMORY=4 限制，要等前面的頁面辨識完才能繼續送出
+    image = corpus(1)[0]; pdf = corpus(1, pdf_ratio=1.0, pdf_pages=24)[0]
+    events = read_stream(uploads([image, pdf]))
+    assert events[0][1]["type"] == "progress" and events[0][1]["total"] == 2
+    first_at, first = next((at, event) for at, event in events if event["type"] == "result")
+    assert first["result"]["來源檔案"] == image[0]
+    finished_at = events[-1][0]
+    assert first_at < finished_at / 2, (first_at, finished_at)
+
+def test_process_image_route_returns_all_results(fakes, corpus, client):
+    files = corpus(3)
+    data = {"receipt_image": [(io.BytesIO(content), name) for name, content, _ in files]}
+    body = client.post("/process_image", data=data, content_type="multipart/form-data").get_json()
+    assert [r["來源檔案"] for r in body["results"]] == [name for name, _, _ in files]
@@ -0,0 +1,62 @@
+"""PDF 文字層快速路徑：電子發票證明聯文字的規則解析 (期別標頭、民國年、全形數字、金額標籤)，無法確定時交給影像辨識。"""
+import random
+
+import fitz
+import pytest
+
+import app1
+import benchmark
+
+E_INVOICE = """電子發票證明聯
+114年05-06月
+MW-25046739
+2025-05-27 14:30:12
+隨機碼:1234   總計:465
+賣方 28080623   買方 04595257
+"""
+
+def test_parses_e_invoice_certificate():
+    assert app1.parse_invoice_text(E_INVOICE) == [{
+        "invoice_number": "MW25046739", "date": "2025-05-27", "time": "14:30:12",
+        "seller_vat": "28080623", "buyer_vat": "04595257", "total_amount": 465}]
+
+def test_period_header_is_not_a_date():
+    # 「114年05-06月」是期別，不是 114-05-06；真正的交易日期在後面
+    text = E_INVOICE.replace("2025-05-27 14:30:12", "交易日期 114/06/03 09:05")
+    receipt = app1.parse_invoice_text(text)[0]
+    assert (receipt["date"], receipt["time"]) == ("2025-06-03", "09:05:00")
+    # 只有期別、沒有交易日期時無法確定，交給影像辨識
+    assert app1.parse_invoice_text(E_INVOICE.replace("2025-05-27 14:30:12", "")) is None
+
+def test_full_width_text_and_labelled_unknown_prefix():
+    text = ("電子發票證明聯\n發票號碼：ＡＢ１２３４５６７８\n民國114年5月27日\n"
+            "營業人統編：２８０８０６２３\n合計 100\n總計 ＮＴ＄１，２３４\n")
+    assert app1.parse_invoice_text(text) == [{
+        "invoice_number": "AB12345678", "date": "2025-05-27", "time": "",
+        "seller_vat": "28080623", "buyer_vat": "N/A", "total_amount": 1234}]
+
+def test_uncertain_pages_fall_back_to_vision():
+    # 兩張發票 (對帳單明細)、沒有金額、賣方不唯一、未知字軌且沒有標籤
+    assert app1.parse_invoice_text(E_INVOICE + "MW-25046740 總計:100\n") is None
+    assert app1.parse_invoice_text(E_INVOICE.replace("總計:465", "")) is None
+    assert app1.parse_invoice_text(E_INVOICE.replace("賣方 28080623   買方 04595257", "28080623   04595257")) is None
+    assert app1.parse_invoice_text(E_INVOICE.replace("MW-25046739", "ZZ25046739")) is None
+
+def test_text_pdf_skips_rasterization_and_gemini(fakes, sellers, monkeypatch):
+    gemini, _, _ = fakes
+    real_iter_pages = app1.iter_pdf_page_images
+
+    def iter_pages(upload, page_numbers, *args):
+        if page_numbers: pytest.fail(f"文字層解析成功的頁面不應轉圖: {page_numbers}")
+        return real_iter_pages(upload, page_numbers, *args)
+    monkeypatch.setattr(app1, "iter_pdf_page_images", iter_pages)
+    files = benchmark.make_corpus(2, 1.0, 2, "text-layer", random.Random(7), text_pdf_ratio=1.0, sellers=sellers)
+    doc = fitz.open(stream=files[0][1], filetype="pdf")
+    try: parsed = app1.parse_pdf_text_layer(doc)
+    finally: doc.close()
+    expected = benchmark.make_receipt(b"text-layer-0-0", sellers)
+    assert parsed[0][0]["invoice_number"] == expected["invoice_number"] and parsed[0][0]["seller_vat"] == expected["seller_vat"]
+
+    with app1.app.test_request_context():
+        results = app1.finalize_ocr_batch(app1.submit_ocr_batch([app1.SpooledUpload.from_bytes(name, data) for name, data, _ in files]))
+    assert gemini.calls == 0 and len(results) == 4
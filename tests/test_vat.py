@@ -0,0 +1,25 @@
+"""統編修正：候選依替換成本排序，未確認時只採用單一 '8' / '6' -> '0'，整批修正優先採用已確認存在的候選。"""
+import app1
+
+def test_vat_candidates_ranked_by_cost():
+    # '6' -> '0' (成本 1) 排在 '9' -> '0' (成本 1.5) 前面，單一替換排在多個替換前面
+    assert app1.vat_correction_candidates("66988572") == ["06988572", "66908572", "66008572", "66080572"]
+    assert app1.vat_correction_candidates("28080623") == ["28080623"]  # 本身有效
+    assert app1.vat_correction_candidates("2808062") == []
+
+def test_vat_auto_correction_only_single_8_or_6():
+    assert app1.correct_vat_number("28680623") == "28080623"  # 單一 '6' -> '0'，與舊版相同直接修正
+    assert app1.correct_vat_number("66988572") == "06988572"
+    # 需要兩個替換或 '9' -> '0' 的候選未經確認時維持原值
+    assert app1.correct_vat_numbers(["28686623", "04796669"]) == [("28686623", ["28080623"]), ("04796669", ["04706660"])]
+
+def test_batch_vat_correction_prefers_confirmed_candidate(monkeypatch):
+    known = {"28080623", "04706660", "66908572"}
+    monkeypatch.setattr(app1, "is_known_company", lambda vat: vat in known)
+    batch = [([{"seller_vat": "28686623", "buyer_vat": "04796669"}], "a.png"),
+             ([{"seller_vat": "66988572", "buyer_vat": "28080623"}], "b.png")]
+    assert app1.correct_batch_vats(batch) == {
+        "28686623": "28080623", "04796669": "04706660", "66988572": "66908572", "28080623": "28080623"}
+    known.clear()
+    assert app1.correct_batch_vats(batch) == {
+        "28686623": "28686623", "04796669": "04796669", "66988572": "06988572", "28080623": "28080623"}